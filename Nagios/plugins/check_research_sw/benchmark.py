@@ -0,0 +1,274 @@
+#!/usr/bin/python
+
+'''
+Copyright 2016 - CANARIE Inc. All rights reserved
+
+Synopsis: benchmark check_research_sw.py against a local stand-in for the
+          science.canarie.ca status web service
+
+Blob Hash: $Id$
+
+-------------------------------------------------------------------------------
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, 
+   this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, 
+   this list of conditions and the following disclaimer in the documentation 
+   and/or other materials provided with the distribution.
+
+3. The name of the author may not be used to endorse or promote products 
+   derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY CANARIE Inc. "AS IS" AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+
+Theory of Operations:
+
+A mock web service (see mock_server.py) is started in this process with the
+latency, error rates and payload shapes given on the command line, and the
+plugin is pointed at it. The following are then measured:
+
+a) cold_start: wall time of complete check_research_sw.py processes, each
+   checking one resource, as NRPE would run them. The time taken to start the
+   interpreter alone and to start it and load the module are measured too, so
+   the cost of each can be told apart.
+
+b) single_check: latency of individual checks made from this process, each
+   with a new connection like a check run by NRPE has to make.
+
+c) batch: throughput of batch mode (check_research_sw.check_resources).
+
+d) daemon: latency and throughput of checks answered by daemon mode through
+   check_research_sw_client.query().
+
+e) async: throughput of check_research_sw_async.py, when run with Python 3.
+
+Latencies are summarised as mean, 50th/90th/99th percentile and maximum, in
+seconds. The results, along with the settings and Python version used, are
+written as JSON to the file given with '--output' so that releases can be
+compared. '--baseline' compares this run with an earlier results file.
+
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import check_research_sw
+import check_research_sw_client
+import mock_server
+
+# The plugin itself, run as a separate process for cold start measurements
+plugin = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_research_sw.py')
+
+
+def summarise(samples):
+    ''' Summarise a list of latencies, in seconds '''
+
+    if not samples:
+        return {'runs': 0}
+
+    return {'runs': len(samples),
+            'mean': sum(samples) / len(samples),
+            'p50': check_research_sw.percentile(samples, 50),
+            'p90': check_research_sw.percentile(samples, 90),
+            'p99': check_research_sw.percentile(samples, 99),
+            'max': max(samples)}
+
+
+
+def time_process(command, runs):
+    ''' Run a command 'runs' times and return the wall time of each run '''
+
+    samples = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull)
+            samples.append(time.time() - start)
+
+    return samples
+
+
+
+def bench_cold_start(python, server, runs, transport):
+    ''' Measure complete plugin processes (a) '''
+
+    directory = os.path.dirname(plugin)
+    check = [python, plugin, '--urlbase', server.urlbase, '--transport', transport, '49']
+
+    return {'interpreter': summarise(time_process([python, '-c', 'pass'], runs)),
+            'import': summarise(time_process([python, '-c', 'import sys; sys.path.insert(0, {0!r}); '
+                                                            'import check_research_sw'.format(directory)], runs)),
+            'check': summarise(time_process(check, runs))}
+
+
+
+def bench_single_check(checks, transport):
+    ''' Measure checks that each make a new connection (b) '''
+
+    samples = []
+    for i in range(checks):
+        start = time.time()
+        check_research_sw.check_resource(i + 1, check_research_sw.make_transport(transport).get)
+        samples.append(time.time() - start)
+
+    return summarise(samples)
+
+
+
+def bench_batch(size, workers, transport):
+    ''' Measure batch mode throughput (c) '''
+
+    start = time.time()
+    results = check_research_sw.check_resources(range(1, size + 1), workers, transport=transport)
+    elapsed = time.time() - start
+
+    return {'resources': len(results), 'workers': workers, 'seconds': elapsed, 'per_second': len(results) / elapsed}
+
+
+
+def bench_daemon(checks, workers, transport):
+    ''' Measure checks answered by daemon mode (d) '''
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'check.sock')
+    server = check_research_sw.make_daemon(path, workers, transport=transport)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    try:
+        samples = []
+        start = time.time()
+        for i in range(checks):
+            before = time.time()
+            check_research_sw_client.query(path, i + 1)
+            samples.append(time.time() - before)
+        elapsed = time.time() - start
+
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        shutil.rmtree(directory)
+
+    result = summarise(samples)
+    result['per_second'] = checks / elapsed
+    return result
+
+
+
+def bench_async(size, concurrency):
+    ''' Measure check_research_sw_async.py throughput (e) '''
+
+    try:
+        import asyncio
+        import check_research_sw_async
+    except (ImportError, SyntaxError):
+        return None     # needs Python 3
+
+    async_checker = check_research_sw_async.AsyncChecker(concurrency, concurrency, rate=0)
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        asyncio.run(check_research_sw_async.run(range(1, size + 1), async_checker, devnull))
+        elapsed = time.time() - start
+
+    return {'resources': size, 'concurrency': concurrency, 'seconds': elapsed, 'per_second': size / elapsed}
+
+
+
+def compare(results, baseline, prefix=''):
+    ''' Print each number in 'results' next to the same one in 'baseline' '''
+
+    for key in sorted(results):
+        value, old = results[key], (baseline or {}).get(key)
+
+        if isinstance(value, dict):
+            compare(value, old if isinstance(old, dict) else None, prefix + key + '.')
+
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            print('{0:40} {1:12.4f} {2:12.4f} {3:+8.1f}%'.format(prefix + key, value, old, 100.0 * (value - old) / old))
+
+        elif isinstance(value, (int, float)):
+            print('{0:40} {1:12.4f}'.format(prefix + key, value))
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark check_research_sw.py against a local mock web service')
+    parser.add_argument('-o', '--output', help='write the results to this file as JSON')
+    parser.add_argument('--baseline', help='compare the results with this earlier results file')
+    parser.add_argument('--python', default=sys.executable, help='interpreter used to run the plugin (default: %(default)s)')
+    parser.add_argument('--transport', default=check_research_sw.default_transport, choices=sorted(check_research_sw.transports),
+                        help='transport used by the plugin (default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=20, help='number of plugin processes started (default: %(default)s)')
+    parser.add_argument('--checks', type=int, default=200, help='number of single checks (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=400, help='number of resources in a batch (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=check_research_sw.default_workers,
+                        help='concurrency of batch, daemon and async modes (default: %(default)s)')
+    parser.add_argument('--shape', default='mixed', choices=['mixed'] + mock_server.mixed_shapes,
+                        help='payload returned by the mock web service (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.01, help='mock web service latency in seconds (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.005, help='random variation in latency (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with HTTP 500')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of requests that take an extra second')
+    args = parser.parse_args()
+
+    config = mock_server.MockConfig(args.shape, args.latency, args.jitter, args.error_rate, slow_rate=args.slow_rate)
+    server = mock_server.start(config)
+    check_research_sw.urlbase = server.urlbase
+
+    try:
+        results = {'cold_start': bench_cold_start(args.python, server, args.runs, args.transport),
+                   'single_check': bench_single_check(args.checks, args.transport),
+                   'batch': bench_batch(args.batch_size, args.workers, args.transport),
+                   'daemon': bench_daemon(args.checks, args.workers, args.transport)}
+
+        async_results = bench_async(args.batch_size, args.workers)
+        if async_results is not None:
+            results['async'] = async_results
+
+    finally:
+        mock_server.stop(server)
+
+    report = {'settings': vars(args),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+              'results': results}
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    compare(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+# -----------------------------------------------------------------------------
+if  __name__ =='__main__':
+    main()
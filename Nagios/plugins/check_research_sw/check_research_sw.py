@@ -77,157 +77,4058 @@ expected by Nagios and returned. The rules are as follows:
 8) If either the lastUpdate or pollingInterval items are missing from the web
    service response, a WARNING status is returned (assuming the status is OK). 
    This is likely a version mismatch.
+
+9) Performance data is written after the message, following a '|' as Nagios
+   expects: the time taken to connect, to receive the first byte of the
+   response and to complete the request, the size of the response and the
+   age of the status (seconds since lastUpdate). Optional thresholds on the
+   request time and the age raise the exit code to WARNING or CRITICAL.
+
+10) Optionally, the age of the status is also compared with the resource's
+   pollingInterval. A resource that hasn't been polled for more than a given
+   number of intervals, which usually means its poller has stopped, is
+   reported as WARNING or CRITICAL even if its last status was OK.
    
+Several resources can be checked in a single run (batch mode) by giving more
+than one id on the command line, or by reading ids from a file or stdin with
+'--file'. The requests are then issued concurrently from a small pool of
+threads sharing one HTTP session, so connections to the web service are re-used
+rather than set up again for each resource. The rules above are applied to each
+resource in turn. The first line of output summarises the batch and is followed
+by one line per resource; the exit code is the worst of the individual ones.
+
+With '--bulk', a batch asks for the status of many resources in one request to
+a bulk endpoint (bulk_path below) instead of one request per resource. Each
+status in the answer goes through the same rules as a single response would.
+Resources missing from the answer, or all of them if the bulk request fails,
+are fetched one at a time as usual, so the results never depend on how they
+were fetched. The statuses in a bulk answer are evaluated evaluate_chunk at a
+time by evaluate_statuses(), which pulls status, lastUpdate, pollingInterval
+and message out of each into columns, works out all the exit codes in one pass
+and builds each message with a single join. Its results are identical to those
+of evaluate_status() on each status in turn.
+
+To keep the cost of each Nagios check down, the script can also be left running
+as a daemon ('--daemon') that listens on a Unix domain socket and keeps its
+connections to the web service open between checks. The thin client in
+check_research_sw_client.py takes the same command line as this script, passes
+the id to the daemon and writes out the answer exactly as this script would.
+
+The web service only refreshes the status of a resource once every
+pollingInterval. With '--cache-dir', successful responses are kept on disk and
+shared by every process using the same directory until lastUpdate +
+pollingInterval has passed. For a short while after that, checks are still
+answered from the cache while a fresh copy is fetched in the background.
+
+Requests are made through a 'transport'. The default one is a small client
+built on the http.client and ssl modules, which loads much more quickly than
+the 'requests' module; '--transport requests' uses 'requests' instead. Either
+way, errors are reported with the same messages. Only the modules needed by
+the path actually taken are loaded, and a command line consisting of a single
+id is parsed without loading argparse.
+
+Normally each request is tried once and given timeout_sec seconds. With
+'--timeout', the whole check is given that long instead (it should match the
+'-t' given to check_nrpe), and connection errors, timeouts and 5xx responses
+are retried after a short random wait for as long as the time allows. With
+'--hedge', a request that is slow compared with the ones before it gets a
+second copy sent alongside it. Either way, a check that still fails is
+reported just as it would be after a single attempt.
+
+If the web service can't be reached at all, every check would otherwise wait
+for its full timeout. With '--circuit', checks share a circuit breaker through
+a small state file: after several connection errors or timeouts in a row the
+circuit opens and checks are reported as CRITICAL straight away, without a
+request being made. Every so often a single check is let through to find out
+whether the web service is back.
+
+For Prometheus, '--exporter' checks the resources given every '--interval'
+seconds and serves the results as metrics on /metrics: the exit code and age
+of each resource, a histogram of response times and counts of errors by type.
+A scrape is answered from the results of the latest round of checks, so it
+never causes a request to the web service.
+
+Rather than checking everything every '--interval' seconds, the exporter, and
+the daemon with '--cache-dir', can be given '--schedule'. Each resource is
+then fetched just after the web service is due to have polled it again
+(lastUpdate + pollingInterval, plus a little random jitter), as worked out
+by a Scheduler, so requests are only made when there can be something new
+and are spread out instead of all arriving at once. The daemon keeps the
+cache up to date this way for the ids it is given.
+
+With '--history-dir', the result of every check (its time, exit code,
+response time and the age of the status) is kept in a small memory mapped
+file per resource holding the most recent checks (see History). The
+availability and flap rate of a resource are then added to the performance
+data of a single check, and '--report' summarises the history instead of
+checking anything.
+
+With '--passive' or '--passive-spool', a batch is submitted to Nagios as
+passive check results, one service per resource, instead of being run as an
+active check per resource. Each result is the line a single check of that
+resource would print, with its exit code. Results are buffered and written
+to the external command file, or as a check result file in Nagios'
+check_result_path, once 'passive_batch' of them are waiting or the oldest
+has waited 'passive_flush_sec' seconds (see PassiveWriter).
+
+With '--changes-only FILE' as well, a resource is only submitted when its
+result has changed since it was last submitted, or when it hasn't been
+submitted for '--heartbeat' seconds, so that Nagios' freshness checks still
+see it. A result is compared by a short fingerprint of its exit code and
+its message, leaving out the parts that change from one check to the next
+(timestamps and measurements); the fingerprints are kept in FILE between
+runs (see ChangeFilter).
+
+More than one base URL can be given with '--urlbase' (mirrors, alternate
+front ends, a local caching proxy). Each request then goes to the endpoint
+that has been answering fastest, going by a smoothed latency, and skips
+those whose smoothed error rate is too high. If the request fails, the next
+endpoint is tried within the same check, as long as there's time left. The
+measurements can be shared by every check through '--endpoint-state' (see
+Endpoints).
+
+With '--group NAME', the resources given (or those listed for NAME in a
+'--group-file') are checked together as a roll-up: all of them at once, so
+that the check takes about as long as the slowest of them, and the group is
+given a single exit code by a rule (the worst of the members by default, a
+quorum of OK members or a percentage of them; see rollup()). The first line
+of output sums up the group and each member gets a line of its own in the
+long output.
+
+Polling can be shared between several hosts with '--shard-nodes', the
+names of all of them, and '--shard-node', the name of this one. Each host
+then only checks (in a batch, as passive checks, from the exporter or on
+the daemon's schedule) the ids that belong to it by consistent hashing, so
+that adding or removing a host only moves about 1/N of the resources (see
+HashRing). '--coverage' shows how the ids are shared out, and that each
+belongs to exactly one host.
+
+'--profile' breaks the time a check took down into phases (interpreter
+startup, imports, argument parsing, setup, DNS lookup, TCP and TLS
+handshakes, waiting for the web service, download, JSON decoding and
+evaluation) and writes them to stderr or appends them as a JSON line to a
+file, leaving stdout and the exit code alone (see Profile).
+
 '''
 
-import requests
-import argparse
-import httplib
+import time
+import_started = time.time()
+
+# Only modules that are cheap to load are imported here. Anything heavier
+# ('requests', argparse, ssl, the thread pool, ...) is imported by the code
+# that needs it, so that a single check doesn't pay for what it doesn't use.
+import codecs
+import collections
+import errno
+import fcntl
+import heapq
+import json
+import math
+import os
+import re
+import signal
+import socket
+import struct
+import sys
+import threading
+
+try:
+    import httplib
+    from urlparse import urljoin, urlsplit
+    string_types = basestring
+except ImportError:
+    import http.client as httplib   # Python 3
+    from urllib.parse import urljoin, urlsplit
+    string_types = str
+
+# Number of seconds it took to load the modules above. Kept so that startup
+# time can be measured; test.py also checks that the common single check path
+# doesn't load 'requests' or argparse.
+import_seconds = time.time() - import_started
 
 # URL of the web service we need to call. Conveniently defined at the top of this file
 urlbase = 'https://science.canarie.ca/researchsoftware/rs'
 
+# The Profile of the check being made, set by main() with '--profile', and
+# the clock it's timed with: monotonic where Python has one (3.3 and later)
+profile = None
+clock = getattr(time, 'monotonic', time.time)
+
+# The Endpoints requests are spread over when more than one base URL is
+# given, set by main(). Requests for URLs under urlbase then go to whichever
+# of them is answering best (see make_transport()).
+endpoints = None
+
 
 # These are the various exit codes we support, along with human-readable strings.
 # Exit codes are returned to the Nagios daemon
 codelist = {'DEPENDENT':4, 'UNKNOWN':3, 'OK':0, 'WARNING':1, 'CRITICAL':2}
 
-def check_status(response):
-    ''' Ensure that the 'status' element is present in the JSON response from the web service
-    
-        If present, it must be set to 'OK' or 'UNKNOWN'. If status is set to
-        something else or missing altogether, set our exit code to 'CRITICAL', If
-        the status is set to UNKNOWN, set exit code to WARNING to indicate to
-        Nagios that there may be a problem.
+# The exit codes above ranked from best to worst. Used to work out the overall
+# exit code when several resources are checked in a single run.
+severity = ['OK', 'DEPENDENT', 'UNKNOWN', 'WARNING', 'CRITICAL']
+
+# Number of seconds to wait for the web service before giving up on a request
+timeout_sec = 5
+
+# Number of resources checked concurrently when running as a batch
+default_workers = 10
+
+# Number of bytes read at a time from a response that is processed as it
+# arrives (see JSONStream)
+stream_chunk = 65536
+
+# Path, relative to urlbase, of the endpoint that returns the status of many
+# resources in one response (see '--bulk'), and the most ids asked for in a
+# single request so that URLs stay a reasonable length
+bulk_path = '/resources/status'
+bulk_chunk = 200
+
+# Number of statuses in a bulk response evaluated together by
+# evaluate_statuses(). Larger amortises more per-status work; smaller gets the
+# first results out sooner.
+evaluate_chunk = 100
+
+# Transport used to talk to the web service: 'http' is a lean client built on
+# the http.client and ssl modules, 'requests' uses the 'requests' module (and
+# honours its proxy settings). See the transports dictionary below.
+default_transport = 'http'
+
+# Number of redirects followed before giving up, the same as 'requests'
+max_redirects = 30
+
+# With a time budget for each check (see '--timeout'), failed requests are
+# tried again up to this many times. The wait before each retry is a random
+# time up to retry_backoff seconds, doubling with each retry but never more
+# than retry_backoff_max, and a retry is only made if at least
+# deadline_margin seconds would be left for it. That much time is also kept
+# back from the budget for writing out the result.
+default_retries = 2
+retry_backoff = 0.1
+retry_backoff_max = 1.0
+deadline_margin = 0.5
+
+# With a circuit breaker (see '--circuit'), this many connection errors or
+# timeouts in a row mean the web service is taken to be unreachable. Requests
+# then fail straight away until circuit_reset_sec seconds have passed, when a
+# single request is let through to see whether it's back.
+circuit_failures = 5
+circuit_reset_sec = 30
+
+# With more than one base URL (see Endpoints): the weight given to each new
+# measurement in the smoothed latency and error rate of an endpoint, the error
+# rate above which it's avoided, how long until it's given another chance, and
+# how often the state shared through '--endpoint-state' is brought up to date
+endpoint_alpha = 0.3
+endpoint_max_errors = 0.5
+endpoint_retry_sec = 30
+endpoint_sync_sec = 1
+
+# A hedged request (see '--hedge') is only sent once this many response times
+# have been seen, and only the most recent hedge_window of them are kept
+hedge_min_samples = 20
+hedge_window = 200
+
+# Responses are kept in the cache (see '--cache-dir') until the web service is
+# due to poll the resource again, but never for less than this many seconds
+cache_min_ttl = 60
+
+# Number of seconds an expired response can still be used to answer a check
+# while a fresh copy is fetched in the background
+cache_stale_sec = 300
+
+# The measurements written as Nagios performance data: the label, which is
+# also the key used in the dictionary filled in by check_resource(), the unit
+# of measure and how the measurement is described when it crosses a threshold.
+perf_items = [('connect', 's', 'Connect time'),        # DNS lookup and TCP/TLS set up
+              ('ttfb', 's', 'Time to first byte'),
+              ('time', 's', 'Response time'),          # total time taken by the request
+              ('size', 'B', 'Response size'),          # size of the response body
+              ('age', 's', 'Status age'),              # seconds since lastUpdate
+              ('availability', '%', 'Availability'),   # from the history, see '--history-dir'
+              ('flapping', '%', 'Flap rate')]
+
+# How often, in seconds, the Prometheus exporter (see '--exporter') checks
+# its resources, and the upper bounds of the buckets of its histogram of
+# response times
+exporter_interval = 60
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# With '--schedule', each resource is fetched again a random time of up to
+# schedule_jitter seconds after the web service is next due to poll it, so
+# that requests are spread out rather than all made at once
+schedule_jitter = 30
+
+# Number of points each poller has on the consistent hash ring ('--shard-nodes').
+# More points share the resources out more evenly.
+shard_replicas = 160
+
+# Layout of the files kept by History (see '--history-dir'): a header, then a
+# ring of fixed size records. The header holds a marker, the version of the
+# layout, the size of a record, the number of records in the ring and the
+# number of records ever written. Each record holds the time of a check, its
+# exit code, the response time and the age of the status, either of which is
+# NaN if it isn't known.
+history_header = struct.Struct('<4sHHIQ')
+history_record = struct.Struct('<dB3xff')
+history_marker = b'RSWH'
+history_version = 1
+
+# Number of checks kept for each resource (two weeks' worth at one check every
+# five minutes) and the period, in seconds, history is summarised over
+history_capacity = 4096
+history_window = 86400
+
+# Number of history files kept open at once. Each takes two file descriptors
+# (the file and its memory map), so the least recently used is closed when
+# another is needed rather than letting a large batch run out of them.
+history_open = 64
+
+# Service description passive check results are submitted for, formatted
+# with the resource id (see '--passive-service'), and when they're written out:
+# once this many are waiting, or once the oldest has waited this many seconds
+passive_service = 'Research Software {id}'
+passive_batch = 100
+passive_flush_sec = 5
+
+# With '--changes-only', a result that hasn't changed is still submitted if
+# it was last submitted this many seconds ago
+heartbeat_sec = 3600
+
+# Parts of a message that change from one check to the next without the
+# result having changed: timestamps, measurements over a threshold and how
+# long ago a stale status was updated. They're left out of fingerprints.
+volatile_text = re.compile(r'\d{4}-\d\d-\d\dT[\d:.]+Z?'
+                           r'|[\d.]+[a-zA-Z%]*(?= over (warning|critical) threshold)'
+                           r'|(?<=not updated for )[\ddhms ]+(?=,)')
+
+# Unix domain socket the daemon listens on. check_research_sw_client.py uses
+# the same default.
+default_socket = '/tmp/check_research_sw.sock'
+
+
+class CommunicationsError(Exception):
+    ''' Raised by a transport when the web service request can't be completed
+
+        Transports translate their own errors into one of the subclasses
+        below, so that they're all reported in the same way whichever
+        transport is used.
     '''
-    
-    code = 'CRITICAL'
-    if 'status' in response:
-        if response['status'] == 'OK':
-            code = 'OK'
 
-        elif response['status'] == 'UNKNOWN':
-            code = 'WARNING'
+class ConnectionFailed(CommunicationsError):
+    ''' Couldn't connect, or the connection was lost '''
 
-    # If the status in response was 'ERROR', there is something wrong with the
-    # service and we leave the return code at 'CRITICAL'
+class TimedOut(CommunicationsError):
+    ''' The web service took too long to answer '''
 
-    return code
-	
-	
-	
-def check_response (response, code, msg):
-    ''' Check the lastUpdate and pollingInterval JSON elements
-    
-        If they're both there, exit code is OK. If one or both are missing,
-        it's not a fatal error but something is mis-configured so set exit code
-        to WARNING. Of course, if the exit code was already set to CRITICAL as a
-        result of checking the status element of the JSON response, don't
-        change it. 
-        
-        While we're checking these fields, add information to the human-readable
-        message we're writing to stdout for Nagios to display.
+class TooManyRedirects(CommunicationsError):
+    ''' The request was redirected more than max_redirects times '''
+
+class HTTPFailure(CommunicationsError):
+    ''' Some other HTTP level error '''
+
+class CircuitOpen(CommunicationsError):
+    ''' The web service has been unreachable, so no request was made (see CircuitBreaker) '''
+
+
+# How each of the errors above is reported, most specific first. ValueError
+# is raised by r.json() when the response isn't valid JSON.
+error_messages = [(ValueError, 'Invalid response'),
+                  (ConnectionFailed, 'Connection error'),
+                  (TimedOut, 'Timeout'),
+                  (TooManyRedirects, 'Too many redirects'),
+                  (HTTPFailure, 'HTTP error'),
+                  (CircuitOpen, 'Portal unreachable - circuit open'),
+                  (CommunicationsError, 'Unknown communications error')]    # catch all
+
+
+
+class Response(object):
+    ''' A response from the web service
+
+        It has just enough of the requests "response" class for the rest of
+        this script to work with it whichever transport fetched it.
     '''
 
-    retcode = 'OK'
+    def __init__(self, status_code, headers, content, timings=None):
+        self.status_code = status_code
+        self.headers = headers      # names in lower case
+        self.content = content
+        self.timings = timings or {}    # see HTTPTransport.get()
+        self.stream = None
 
-    if 'lastUpdate' in response:
-        msg += ' - Last update: {0}'.format(response['lastUpdate'])
-    else:
-        retcode = 'WARNING';
-			
-    if 'meta' in response:
-        if 'pollingInterval' in response['meta']:
-            msg += ' - Polling: {0}'.format(response['meta']['pollingInterval'])
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        # A UnicodeDecodeError is a ValueError too, which is what we want
+        return json.loads(self.content.decode('utf-8'))
+
+    def iter_content(self, chunk_size=None):
+        ''' The body in pieces, as they arrive if the request was made with stream=True '''
+        return self.stream if self.content is None else [self.content]
+
+    def close(self):
+        ''' Stop reading a streamed body, giving up the connection '''
+        if self.stream is not None:
+            self.stream.close()
+
+
+
+class CachedResponse(Response):
+    ''' A successful response kept by a StatusCache, with its JSON payload already decoded '''
+
+    def __init__(self, payload, size=None):
+        Response.__init__(self, httplib.OK, {}, None)
+        self.payload = payload
+        self.size = size    # of the body it was decoded from
+
+    def json(self):
+        return self.payload
+
+
+
+class HTTPTransport(object):
+    ''' Fetch responses using the http.client (httplib) and ssl modules
+
+        This is much quicker to load than the 'requests' module, which matters
+        when a process only makes one request. Up to 'connections' connections
+        are kept open for re-use, so it can be shared by several threads.
+    '''
+
+    def __init__(self, connections=1):
+        import ssl
+        self.ssl = ssl
+        self.context = ssl.create_default_context()
+        self.connections = connections
+        self.idle = {}      # (scheme, host, port) -> open connections not in use
+        self.lock = threading.Lock()
+
+
+    def connect(self, key, timeout):
+        ''' Return a connection to the host in 'key' and whether it has been used before '''
+
+        with self.lock:
+            if self.idle.get(key):
+                conn = self.idle[key].pop()
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return (conn, True)
+
+        scheme, host, port = key
+        if scheme == 'https':
+            return (httplib.HTTPSConnection(host, port, timeout=timeout, context=self.context), False)
+        return (httplib.HTTPConnection(host, port, timeout=timeout), False)
+
+
+    def open(self, key, conn):
+        ''' Connect 'conn' to the host in 'key'
+
+            Does what conn.connect() would, but returns the time the DNS
+            lookup and the TCP and (for https) TLS handshakes took.
+        '''
+
+        scheme, host, port = key
+
+        started = time.time()
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        resolved = time.time()
+
+        for (n, (family, socktype, proto, canonname, address)) in enumerate(addresses):
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.settimeout(conn.timeout)
+                sock.connect(address)
+                break
+            except socket.error:
+                sock.close()
+                if n == len(addresses) - 1:
+                    raise   # none of the addresses worked
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connected = time.time()
+        timings = {'dns': resolved - started, 'tcp': connected - resolved}
+
+        if scheme == 'https':
+            sock = self.context.wrap_socket(sock, server_hostname=host)
+            timings['tls'] = time.time() - connected
+
+        conn.sock = sock
+        return timings
+
+
+    def release(self, key, conn, resp):
+        ''' Keep a connection whose response has been read for the next request '''
+
+        if resp.will_close:
+            conn.close()
         else:
-            retcode = 'WARNING';
+            with self.lock:
+                self.idle.setdefault(key, []).append(conn)
+                if len(self.idle[key]) > self.connections:
+                    self.idle[key].pop(0).close()
 
-    else:
-        retcode = 'WARNING'
 
-    # There will be a message in the response if the service has not yet been
-    # polled
-    if 'message' in response:
-        msg += ' - Details: {0}'.format(response['message'])
+    def body(self, url, key, conn, resp):
+        ''' Read the body of a response a piece at a time, then release the connection '''
 
-		
-    # If the exit code has previously been set to something other than OK, don't change it.
-    if code in ['CRITICAL', 'WARNING']:
-        retcode = code
+        done = False
+        try:
+            while True:
+                chunk = resp.read(stream_chunk)
+                if not chunk:
+                    break
+                yield chunk
+            done = True
 
-    return (retcode, msg)
-	
+        except socket.timeout:
+            raise TimedOut(url)
 
+        except (socket.error, httplib.HTTPException) as e:
+            raise ConnectionFailed(str(e))
 
-# Build up the URL used to retrieve status information
-def main():
+        finally:
+            if done:
+                self.release(key, conn, resp)
+            else:
+                conn.close()    # part of the response is still unread
 
-    code = 'CRITICAL'   # assume badness until we learn otherwise
-    timeout_sec = 5
-    message = 'Research Software'
 
-    try:
-        # Build up command line parser
-        parser = argparse.ArgumentParser()
-        parser.add_argument('id', type=int, help='numeric identifier of the resource of interest')
+    def request(self, url, timeout, headers, stream=False):
+        ''' Issue a single GET request
 
-        args = parser.parse_args()
-    
-        url = '{0}/resource/{1}/status'.format(urlbase, args.id)
+            With 'stream', the body is left to be read through the response's
+            iter_content() instead of being read here.
+        '''
 
-    
-        # If we get this far, we know the component type and id. Add them to the
-        # human readable message we're returning to the Nagios daemon in stdout
-        message += ' resource {0}'.format(args.id)
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
 
-        # Make a request to the web service that tells us about the status of 
-        # the specified software component (ie. service or platform).
-        r = requests.get(url, timeout=timeout_sec)
-   
-        # If the HTTP transaction was successful ...
-        if r.status_code == httplib.OK:
-            
-            # Set exit code based on status field returned in the JSON response.
-            # The call to r.json() will raise a ValueError exception if the response
-            # does not contain valid JSON
-            code = check_status (r.json())
-	    	    
-            # Adjust the exit code as necessary based on the other fields in
-            # the JSON response and add to the human-readable message we'll
-            # be returning via stdout.
-            code, message = check_response (r.json(), code, message)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        request_headers = {'Accept': 'application/json', 'User-Agent': 'check_research_sw'}
+        request_headers.update(headers or {})
+
+        while True:
+            conn, reused = self.connect(key, timeout)
+            started = time.time()
+            try:
+                timings = self.open(key, conn) if conn.sock is None else {}
+                connected = time.time()
+
+                conn.request('GET', path, headers=request_headers)
+                sent = time.time()
+                resp = conn.getresponse()
+                first_byte = time.time()
 
+                content = None if stream else resp.read()
+                break
+
+            except socket.timeout:
+                conn.close()
+                raise TimedOut(url)
+
+            # A certificate that doesn't match the host name is a ValueError
+            # in Python 2, not an SSLError, so it's dealt with here
+            except self.ssl.CertificateError as e:
+                conn.close()
+                raise ConnectionFailed(str(e))
+
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                if reused:
+                    continue    # the server closed an idle connection; try a new one
+                if isinstance(e, self.ssl.SSLError) and 'timed out' in str(e):
+                    raise TimedOut(url)
+                raise ConnectionFailed(str(e))
+
+        timings.update({'connect': connected - started, 'wait': first_byte - sent, 'first_byte': first_byte})
+        r = Response(resp.status, dict((k.lower(), v) for (k, v) in resp.getheaders()), content, timings)
+
+        if stream:
+            r.stream = self.body(url, key, conn, resp)
         else:
-            # Bad HTTP response code. Update message on stdout appropriately
-            message += ' - HTTP response status code {0}'.format(r.status_code)
+            self.release(key, conn, resp)
 
+        return r
 
-    # Catch any exceptions raised during the above processing and adjust the
-    # outgoing human readable message accordingly.
-    except SystemExit:
-	    message += ' - Usage error'      # raised by argparse
-	    code = 'WARNING'
 
-    except ValueError:
-        message += ' - Invalid response' # raised by requests.get
+    def get(self, url, timeout=timeout_sec, headers=None, stream=False):
+        ''' GET a URL, following redirects like requests.get() does
+
+            The timings of the response are filled in with the time taken to
+            connect (DNS lookup, TCP and TLS handshakes, zero for a connection
+            that was re-used), each of those separately for a new connection,
+            the time spent waiting for the response once the request was sent,
+            the time to the first byte of the response and the total time, all
+            in seconds. With 'stream', the total time doesn't include reading
+            the body.
+        '''
+
+        started = time.time()
+        spent = {'connect': 0}
+
+        for _ in range(max_redirects + 1):
+            r = self.request(url, timeout, headers, stream)
+            for key in ('connect', 'dns', 'tcp', 'tls'):
+                if key in r.timings:
+                    spent[key] = spent.get(key, 0) + r.timings[key]
+            if not (300 <= r.status_code < 400 and 'location' in r.headers):
+                spent.update({'wait': r.timings['wait'], 'ttfb': r.timings['first_byte'] - started,
+                              'total': time.time() - started})
+                r.timings = spent
+                return r
+            for _ in r.iter_content():
+                pass    # read the rest of a redirect so the connection can be re-used
+            url = urljoin(url, r.headers['location'])
+
+        raise TooManyRedirects(url)
+
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn in connections:
+                    conn.close()
+            self.idle = {}
+
+
+
+class RequestsTransport(object):
+    ''' Fetch responses using the 'requests' module
+
+        A single request is made with requests.get(). When more than one
+        connection is wanted, a requests.Session is used so that they are
+        kept open and re-used.
+    '''
+
+    def __init__(self, connections=1):
+        import requests
+        self.requests = requests
+        self.session = None
+
+        if connections > 1:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+
+    def error(self, e):
+        ''' The CommunicationsError matching an exception raised by 'requests' '''
+
+        exceptions = self.requests.exceptions
+
+        if isinstance(e, exceptions.ConnectionError):
+            return ConnectionFailed(str(e))
+
+        if isinstance(e, exceptions.Timeout):
+            return TimedOut(str(e))
+
+        if isinstance(e, exceptions.TooManyRedirects):
+            return TooManyRedirects(str(e))
+
+        if isinstance(e, exceptions.HTTPError):
+            return HTTPFailure(str(e))
+
+        return CommunicationsError(str(e))
+
+
+    def body(self, r):
+        ''' Read the body of a streamed response, translating exceptions '''
+
+        try:
+            for chunk in r.iter_content(stream_chunk):
+                yield chunk
+
+        except self.requests.exceptions.RequestException as e:
+            raise self.error(e)
+
+        finally:
+            r.close()
+
+
+    def get(self, url, timeout=timeout_sec, headers=None, stream=False):
+        ''' GET a URL, translating the exceptions raised by 'requests'
+
+            With 'stream', the response is a Response whose body is read
+            through iter_content() as it arrives.
+        '''
+
+        kwargs = {'headers': headers} if headers else {}
+        if stream:
+            kwargs['stream'] = True
+
+        try:
+            started = time.time()
+            r = (self.session or self.requests).get(url, timeout=timeout, **kwargs)
+
+            # 'requests' doesn't say how long it took to connect, but it does
+            # time how long the server took to answer
+            timings = {'total': time.time() - started}
+            if hasattr(r, 'elapsed'):
+                timings['ttfb'] = r.elapsed.total_seconds()
+
+        except self.requests.exceptions.RequestException as e:
+            raise self.error(e)
+
+        if stream:
+            streamed = Response(r.status_code, dict((k.lower(), v) for (k, v) in r.headers.items()), None, timings)
+            streamed.stream = self.body(r)
+            return streamed
+
+        r.timings = timings
+        return r
+
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+
+
+# The transports that can be selected with '--transport'
+transports = {'http': HTTPTransport, 'requests': RequestsTransport}
+
+
+
+class RetryPolicy(object):
+    ''' Make requests within a time budget, retrying or hedging them as needed
+
+        Each request may take at most 'budget' seconds in all, less
+        deadline_margin. Connection errors, timeouts and 5xx responses are
+        retried up to 'retries' times, after a random back off, as long as
+        there's time left. No attempt is given longer than the timeout it's
+        asked for or the time left.
+
+        If 'hedge' is a percentile (such as 95), an attempt that hasn't been
+        answered by then, going by the response times seen so far, gets a
+        second request sent alongside it and whichever answers first is used.
+        Streamed requests aren't hedged.
+
+        When all attempts fail, the last error is raised or the last response
+        returned, so failures are reported exactly as they would have been
+        without retries.
+    '''
+
+    def __init__(self, budget=timeout_sec, retries=default_retries, hedge=None):
+        self.budget = budget
+        self.retries = retries
+        self.hedge = hedge
+        self.latencies = []     # the most recent response times, oldest first
+        self.lock = threading.Lock()
+
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+            del self.latencies[:-hedge_window]
+
+
+    def hedge_after(self):
+        ''' Seconds after which an unanswered attempt is hedged, or None '''
+
+        with self.lock:
+            if self.hedge is None or len(self.latencies) < hedge_min_samples:
+                return None
+            return percentile(self.latencies, self.hedge)
+
+
+    def call(self, get, url, timeout, headers, stream):
+        ''' Make one request, remembering how long it took if it succeeded '''
+
+        kwargs = {'headers': headers} if headers else {}
+        if stream:
+            kwargs['stream'] = True
+
+        started = time.time()
+        r = get(url, timeout=timeout, **kwargs)
+        if r.status_code < 500:
+            self.record(time.time() - started)
+
+        return r
+
+
+    def attempt(self, get, url, timeout, headers, stream):
+        ''' Make one attempt at a request, hedging it if it takes too long '''
+
+        delay = None if stream else self.hedge_after()
+        if delay is None or delay >= timeout:
+            return self.call(get, url, timeout, headers, stream)
+
+        try:
+            from Queue import Queue, Empty
+        except ImportError:
+            from queue import Queue, Empty  # Python 3
+
+        answers = Queue()
+
+        # Any exception is passed back to be raised here, as without an answer
+        # on the queue the wait below would never end
+        def send():
+            try:
+                answers.put((self.call(get, url, timeout, headers, stream), None))
+            except Exception as e:
+                answers.put((None, e))
+
+        def start():
+            thread = threading.Thread(target=send)
+            thread.daemon = True    # a request still going when we're done is abandoned
+            thread.start()
+
+        start()
+        try:
+            r, error = answers.get(timeout=delay)
+            sent = 1
+        except Empty:
+            start()
+            r, error = answers.get()
+            sent = 2
+
+        # If the first answer is a failure, see whether the other one is better
+        if sent == 2 and (error is not None or r.status_code >= 500):
+            r, error = answers.get()
+
+        if error is not None:
+            raise error
+        return r
+
+
+    def get(self, get, url, timeout=timeout_sec, headers=None, stream=False):
+        ''' GET a URL with 'get', a transport's get method, following this policy '''
+
+        import random
+
+        deadline = time.time() + self.budget - deadline_margin
+
+        for retry in range(self.retries + 1):
+            left = deadline - time.time()
+            try:
+                r = self.attempt(get, url, max(0.1, min(timeout, left)), headers, stream)
+                if r.status_code < 500:
+                    return r
+                failure = None
+
+            except (ConnectionFailed, TimedOut) as e:
+                r, failure = None, e
+
+            backoff = random.uniform(0, min(retry_backoff_max, retry_backoff * 2 ** retry))
+            if retry == self.retries or deadline - time.time() - backoff < deadline_margin:
+                break
+
+            if stream and r is not None:
+                r.close()   # give up the connection to the bad response
+            time.sleep(backoff)
+
+        if failure is not None:
+            raise failure
+        return r
+
+
+
+class PolicyTransport(object):
+    ''' A transport whose requests follow a RetryPolicy '''
+
+    def __init__(self, transport, policy):
+        self.transport = transport
+        self.policy = policy
+
+    def get(self, url, timeout=timeout_sec, headers=None, stream=False):
+        return self.policy.get(self.transport.get, url, timeout, headers, stream)
+
+    def close(self):
+        self.transport.close()
+
+
+
+class CircuitBreaker(object):
+    ''' Stop sending requests to a web service that can't be reached
+
+        The state is kept in the file 'path' so that it is shared by every
+        process using it; the file is replaced atomically and changed only
+        while holding a lock on 'path'.lock. While the web service answers,
+        the file is only ever read.
+
+        After 'failures' connection errors or timeouts in a row, the circuit
+        opens: requests raise CircuitOpen without a connection being made.
+        Once it has been open for 'reset' seconds, the next request is let
+        through as a probe while any others keep failing. If the probe gets
+        an answer, of any kind, the circuit closes again; if not, it stays
+        open for another 'reset' seconds.
+    '''
+
+    def __init__(self, path, failures=circuit_failures, reset=circuit_reset_sec):
+        self.path = path
+        self.failures = failures
+        self.reset = reset
+
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+
+        except (IOError, OSError, ValueError):
+            return {}   # no failures recorded
+
+
+    def write(self, state):
+        import tempfile
+
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as f:
+                json.dump(state, f)
+            os.rename(temp, self.path)
 
-    except requests.exceptions.ConnectionError:
-        message += ' - Connection error'
+        except (IOError, OSError):
+            if os.path.exists(temp):
+                os.remove(temp)
 
-    except requests.exceptions.Timeout:
-        message += ' - Timeout'
 
-    except requests.exceptions.TooManyRedirects:
-        message += ' - Too many redirects'	
+    def update(self, change):
+        ''' Apply 'change' to the state while holding the lock, and return its result '''
+
+        try:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                state = self.read()
+                result = change(state)
+                self.write(state)
+                return result
+
+        except (IOError, OSError):
+            return None     # nowhere to keep the state, so the circuit stays closed
+
+
+    def allow(self):
+        ''' Whether a request may be made now '''
+
+        now = time.time()
+        state = self.read()
+        if not state.get('opened'):
+            return True
+
+        def probe(state):
+            # Only one process gets to probe, and only after 'reset' seconds
+            if not state.get('opened') or now - max(state['opened'], state.get('probing') or 0) >= self.reset:
+                state['probing'] = now
+                return True
+            return False
+
+        return now - state['opened'] >= self.reset and self.update(probe)
+
+
+    def succeeded(self):
+        ''' Record that the web service answered '''
+
+        if self.read():
+            self.update(lambda state: state.clear())
+
+
+    def failed(self):
+        ''' Record a connection error or timeout '''
+
+        def count(state):
+            state['failures'] = state.get('failures', 0) + 1
+            if state['failures'] >= self.failures or state.get('probing'):
+                state['opened'] = time.time()
+                state['probing'] = None
+
+        self.update(count)
+
+
+
+class CircuitTransport(object):
+    ''' A transport whose requests go through a CircuitBreaker '''
+
+    def __init__(self, transport, breaker):
+        self.transport = transport
+        self.breaker = breaker
+
+    def get(self, url, timeout=timeout_sec, headers=None, stream=False):
+        if not self.breaker.allow():
+            raise CircuitOpen(url)
+
+        kwargs = {'headers': headers} if headers else {}
+        if stream:
+            kwargs['stream'] = True
+
+        try:
+            r = self.transport.get(url, timeout=timeout, **kwargs)
+        except (ConnectionFailed, TimedOut):
+            self.breaker.failed()
+            raise
+
+        self.breaker.succeeded()
+        return r
+
+    def close(self):
+        self.transport.close()
+
+
+
+class Profile(object):
+    ''' How long each phase of a check took, for '--profile'
+
+        mark() is called as each phase ends, and the phase is taken to have
+        started when the one before it ended. Only the thread that created
+        the Profile is timed, so marks made by the threads of a batch don't
+        get mixed in. The interpreter startup and imports, which are over by
+        the time it's created, are worked out from when the process started
+        and import_seconds. 'last' (by clock()) and 'started' (by time.time())
+        are when the first phase started, if that was before now.
+    '''
+
+    def __init__(self, last=None, started=None):
+        self.thread = threading.current_thread()
+        self.phases = []    # (name, seconds), in order
+        self.last = clock() if last is None else last
+        self.started = time.time() if started is None else started
+
+        startup = self.startup()
+        if startup is not None:
+            self.phases.append(('startup', startup))
+        self.phases.append(('imports', import_seconds))
+
+
+    def startup(self):
+        ''' Seconds from when the process started until the imports did, where that can be known '''
+
+        try:
+            with open('/proc/self/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open('/proc/uptime') as f:
+                uptime = float(f.read().split()[0])
+            now = time.time()
+
+        except (IOError, OSError, IndexError, ValueError):
+            return None     # not Linux
+
+        # Both are measured from boot, to the nearest 1/100th of a second
+        process_started = now - (uptime - float(fields[19]) / os.sysconf('SC_CLK_TCK'))
+        return max(0.0, import_started - process_started)
+
+
+    def mark(self, phase, parts=None):
+        ''' Record the end of 'phase'
+
+            'parts' can break the phase down further: it's a list of (name,
+            seconds) tuples, and whatever time they don't account for is put
+            down to 'phase' itself.
+        '''
+
+        if threading.current_thread() is not self.thread:
+            return
+
+        now = clock()
+        seconds = now - self.last
+        self.last = now
+
+        for (name, part) in parts or []:
+            self.phases.append((name, part))
+            seconds -= part
+        self.phases.append((phase, max(0.0, seconds)))
+
+
+    def total(self):
+        return sum(seconds for (name, seconds) in self.phases)
+
+
+    def format(self):
+        ''' The phases as lines of text '''
+
+        lines = ['{0:<10} {1:>9.6f}s'.format(name, seconds) for (name, seconds) in self.phases]
+        return ['check_research_sw profile:'] + ['  ' + line for line in lines] + \
+               ['  {0:<10} {1:>9.6f}s'.format('total', self.total())]
+
+
+    def write(self, path, **details):
+        ''' Write the phases to stderr ('-') or append them to the file 'path' as a JSON line
+
+            'details' are added to the JSON object. Errors are ignored so
+            that profiling never gets in the way of the check itself.
+        '''
+
+        try:
+            if path == '-':
+                sys.stderr.write('\n'.join(self.format()) + '\n')
+                return
+
+            record = dict(details, time=self.started, total=self.total(), phases=dict(self.phases),
+                          order=[name for (name, seconds) in self.phases])
+            with open(path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+        except (IOError, OSError):
+            pass
+
+
+
+def mark(phase, parts=None):
+    ''' Record the end of a phase of the check in the Profile, if there is one '''
+
+    if profile is not None:
+        profile.mark(phase, parts)
+
+
+
+class Endpoints(object):
+    ''' Equivalent base URLs for the web service, and how well each is answering
+
+        For each URL, a smoothed (exponentially weighted) latency and error
+        rate are kept. order() puts the healthy ones first, and those with
+        the lowest latency for each successful request (the latency divided
+        by the success rate) first among them; an endpoint is unhealthy while
+        its error rate is over endpoint_max_errors, until endpoint_retry_sec
+        seconds after it last failed. One that hasn't been tried yet counts
+        as fastest, so that it gets measured, and one that has only ever
+        failed as slowest. Otherwise, ties go to the URL given first.
+
+        With a 'path', the measurements are shared through that file with
+        every other process using it: it's read when we start, and brought up
+        to date (keeping whichever measurements of each endpoint are newest)
+        after every failure, and after a success at most every
+        endpoint_sync_sec seconds.
+    '''
+
+    def __init__(self, urls, path=None):
+        self.urls = list(urls)
+        self.path = path
+        self.lock = threading.Lock()
+        self.stats = dict((url, {'latency': None, 'errors': 0.0, 'failed': 0, 'updated': 0}) for url in self.urls)
+        self.synced = 0
+
+        if path is not None:
+            self.merge(self.read())
+
+
+    def order(self, now=None):
+        ''' The URLs, the one to try first first '''
+
+        now = time.time() if now is None else now
+
+        def key(n):
+            stats = self.stats[self.urls[n]]
+            healthy = stats['errors'] <= endpoint_max_errors or now - stats['failed'] >= endpoint_retry_sec
+            latency = stats['latency']
+            if latency is None:
+                latency = float('inf') if stats['failed'] else 0.0
+            return (not healthy, latency / max(1 - stats['errors'], 0.001), n)
+
+        with self.lock:
+            return [self.urls[n] for n in sorted(range(len(self.urls)), key=key)]
+
+
+    def record(self, url, latency=None, now=None):
+        ''' Record a request to the endpoint 'url': how long it took, or None if it failed '''
+
+        now = time.time() if now is None else now
+
+        with self.lock:
+            stats = self.stats[url]
+            if latency is None:
+                stats['errors'] += endpoint_alpha * (1 - stats['errors'])
+                stats['failed'] = now
+            else:
+                stats['errors'] -= endpoint_alpha * stats['errors']
+                stats['latency'] = latency if stats['latency'] is None else \
+                    stats['latency'] + endpoint_alpha * (latency - stats['latency'])
+            stats['updated'] = now
+
+            if self.path is None or (latency is not None and now - self.synced < endpoint_sync_sec):
+                return
+            if latency is not None:
+                self.synced = now
+
+        self.sync()
+
+
+    def merge(self, state):
+        ''' Take on the measurements in 'state' that are newer than ours, and return the newest of each '''
+
+        with self.lock:
+            for url in self.urls:
+                theirs = state.get(url)
+                if isinstance(theirs, dict) and theirs.get('updated', 0) > self.stats[url]['updated']:
+                    self.stats[url].update(theirs)
+                state[url] = dict(self.stats[url])
+
+        return state
+
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            return state if isinstance(state, dict) else {}
+
+        except (IOError, OSError, ValueError):
+            return {}   # nothing measured yet
+
+
+    def sync(self):
+        ''' Bring the shared state file and our measurements up to date with each other '''
+
+        import tempfile
+
+        try:
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                state = self.merge(self.read())
+
+                handle, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+                try:
+                    with os.fdopen(handle, 'w') as f:
+                        json.dump(state, f)
+                    os.rename(temp, self.path)
+                except (IOError, OSError):
+                    os.remove(temp)
+
+        except (IOError, OSError):
+            pass    # nowhere to share them, so they stay our own
+
+
+
+class EndpointTransport(object):
+    ''' A transport that sends requests for URLs under urlbase to the best of several Endpoints
+
+        The endpoints are tried in the order Endpoints.order() gives until
+        one answers without a connection error, timeout or 5xx status, all
+        within the time the request was given. Each attempt gets an equal
+        share of the time left between it and the endpoints after it, so one
+        that hangs can't use up the time the others need. If none answers,
+        the last error is raised, or the last 5xx response returned.
+    '''
+
+    def __init__(self, transport, endpoints):
+        self.transport = transport
+        self.endpoints = endpoints
+
+    def get(self, url, timeout=timeout_sec, headers=None, stream=False):
+        kwargs = {'headers': headers} if headers else {}
+        if stream:
+            kwargs['stream'] = True
+
+        if not url.startswith(urlbase + '/'):
+            return self.transport.get(url, timeout=timeout, **kwargs)
+
+        path = url[len(urlbase):]
+        deadline = time.time() + timeout
+        failure = None
+
+        order = self.endpoints.order()
+        for (i, endpoint) in enumerate(order):
+            started = time.time()
+            if started >= deadline:
+                break
+
+            try:
+                r = self.transport.get(endpoint + path, timeout=(deadline - started) / (len(order) - i), **kwargs)
+            except (ConnectionFailed, TimedOut) as e:
+                self.endpoints.record(endpoint, None)
+                failure = e
+                continue
+
+            if isinstance(failure, Response):
+                failure.close()
+
+            if r.status_code >= 500:
+                self.endpoints.record(endpoint, None)
+                failure = r
+                continue
+
+            self.endpoints.record(endpoint, time.time() - started)
+            return r
+
+        if isinstance(failure, Response):
+            return failure
+        raise failure or TimedOut(url)
+
+    def close(self):
+        self.transport.close()
+
+
+
+def make_transport(name=None, connections=1, policy=None, breaker=None):
+    ''' Create the transport called 'name', or the default one
+
+        When more than one base URL has been given (see 'endpoints'), its
+        requests are spread over them. They go through the CircuitBreaker
+        'breaker' and follow the RetryPolicy 'policy' if these are given, so
+        that each attempt made under the policy is seen by the circuit
+        breaker, which only sees a failure once every endpoint has failed.
+    '''
+
+    transport = transports[name or default_transport](connections)
+    if endpoints is not None:
+        transport = EndpointTransport(transport, endpoints)
+    if breaker is not None:
+        transport = CircuitTransport(transport, breaker)
+    if policy is not None:
+        transport = PolicyTransport(transport, policy)
+
+    return transport
+
+
+
+def check_status(response):
+    ''' Ensure that the 'status' element is present in the JSON response from the web service
+    
+        If present, it must be set to 'OK' or 'UNKNOWN'. If status is set to
+        something else or missing altogether, set our exit code to 'CRITICAL', If
+        the status is set to UNKNOWN, set exit code to WARNING to indicate to
+        Nagios that there may be a problem.
+    '''
+    
+    code = 'CRITICAL'
+    if 'status' in response:
+        if response['status'] == 'OK':
+            code = 'OK'
+
+        elif response['status'] == 'UNKNOWN':
+            code = 'WARNING'
+
+    # If the status in response was 'ERROR', there is something wrong with the
+    # service and we leave the return code at 'CRITICAL'
+
+    return code
+	
+	
+	
+def check_response (response, code, msg):
+    ''' Check the lastUpdate and pollingInterval JSON elements
+    
+        If they're both there, exit code is OK. If one or both are missing,
+        it's not a fatal error but something is mis-configured so set exit code
+        to WARNING. Of course, if the exit code was already set to CRITICAL as a
+        result of checking the status element of the JSON response, don't
+        change it. 
+        
+        While we're checking these fields, add information to the human-readable
+        message we're writing to stdout for Nagios to display.
+    '''
+
+    retcode = 'OK'
+
+    if 'lastUpdate' in response:
+        msg += ' - Last update: {0}'.format(response['lastUpdate'])
+    else:
+        retcode = 'WARNING';
+			
+    if 'meta' in response:
+        if 'pollingInterval' in response['meta']:
+            msg += ' - Polling: {0}'.format(response['meta']['pollingInterval'])
+        else:
+            retcode = 'WARNING';
+
+    else:
+        retcode = 'WARNING'
+
+    # There will be a message in the response if the service has not yet been
+    # polled
+    if 'message' in response:
+        msg += ' - Details: {0}'.format(response['message'])
+
+		
+    # If the exit code has previously been set to something other than OK, don't change it.
+    if code in ['CRITICAL', 'WARNING']:
+        retcode = code
+
+    return (retcode, msg)
+	
+
+
+def resource_url(resource_id):
+    ''' Build up the URL used to retrieve status information for a resource '''
+
+    return '{0}/resource/{1}/status'.format(urlbase, resource_id)
+
+
+
+def format_result(code, msg, perfdata=None):
+    ''' Format an exit code and message the way Nagios expects them on stdout,
+        followed by the performance data if there is any
+    '''
+
+    if perfdata:
+        return code + ' - {0} | {1}'.format(msg, perfdata)
+
+    return code + ' - {0} '.format(msg)
+
+
+
+def perf_number(value):
+    ''' Format a measurement or threshold to at most three decimal places '''
+
+    if value is None:
+        return ''
+
+    return ('{0:.3f}'.format(value)).rstrip('0').rstrip('.')
+
+
+
+def format_perfdata(perf, thresholds=None):
+    ''' Format the measurements in 'perf' as Nagios performance data
+
+        'perf' is filled in by check_resource(). Thresholds are given as a
+        dictionary of (warning, critical) tuples with the same keys; either
+        may be None.
+    '''
+
+    items = []
+    for (key, unit, _) in perf_items:
+        if perf.get(key) is not None:
+            warning, critical = (thresholds or {}).get(key, (None, None))
+            items.append('{0}={1}{2};{3};{4};0;'.format(key, perf_number(perf[key]), unit,
+                         perf_number(warning), perf_number(critical)))
+
+    return ' '.join(items)
+
+
+
+def check_thresholds(code, msg, perf, thresholds):
+    ''' Raise the exit code if any measurement in 'perf' is over its threshold
+
+        'thresholds' is as for format_perfdata(). The exit code is never
+        lowered, and a note is added to the message for each threshold that
+        was crossed.
+    '''
+
+    for (key, unit, description) in perf_items:
+        value = perf.get(key)
+        warning, critical = thresholds.get(key, (None, None))
+
+        if value is None:
+            continue
+
+        for (limit, limit_code) in ((critical, 'CRITICAL'), (warning, 'WARNING')):
+            if limit is not None and value > limit:
+                msg += ' - {0} {1}{2} over {3} threshold {4}{2}'.format(
+                    description, perf_number(value), unit, limit_code.lower(), perf_number(limit))
+                code = worst_code([code, limit_code])
+                break
+
+    return (code, msg)
+
+
+
+def worst_code(codes):
+    ''' Return the most severe of a list of exit codes (OK if the list is empty) '''
+
+    return max(codes or ['OK'], key=severity.index)
+
+
+
+def count_codes(codes):
+    ''' Summarise a list of exit codes as text, worst first, eg. '1 CRITICAL, 398 OK' '''
+
+    return ', '.join('{0} {1}'.format(codes.count(c), c) for c in reversed(severity) if c in codes)
+
+
+
+def percentile(values, pct):
+    ''' Return the pct'th percentile of a list of numbers (nearest rank), or
+        None if the list is empty
+    '''
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(0, min(len(values), rank) - 1)]
+
+
+
+def evaluate_response(r, msg, perf=None, freshness=None):
+    ''' Convert the HTTP response from the web service into an exit code
+
+        A non-200 response is CRITICAL. Otherwise the JSON payload is passed
+        on to evaluate_status(). The call to r.json() will raise a ValueError
+        exception if the response does not contain valid JSON; that is left
+        to the caller to deal with.
+    '''
+
+    # If the HTTP transaction was successful ...
+    if r.status_code == httplib.OK:
+        response = r.json()
+        mark('decode')
+        return evaluate_status(response, msg, perf, freshness)
+
+    # Bad HTTP response code. Update message on stdout appropriately
+    msg += ' - HTTP response status code {0}'.format(r.status_code)
+
+    return ('CRITICAL', msg)
+
+
+
+def evaluate_status(response, msg, perf=None, freshness=None):
+    ''' Convert the decoded JSON status of a resource into an exit code
+
+        The status is run through check_status() and check_response(). If a
+        'perf' dictionary is given, the age of the status (seconds since
+        lastUpdate) is recorded in it, along with when the web service is next
+        due to poll the resource (see next_update()). If 'freshness'
+        thresholds are given, the age is checked against them; see
+        check_freshness(). A ValueError is raised if the status isn't a JSON
+        object (null, a number or a list, say), as for any other invalid
+        response. A meta field that isn't an object is treated as missing, as
+        evaluate_statuses() does.
+    '''
+
+    if not isinstance(response, dict):
+        raise ValueError('status is not a JSON object')
+
+    if not isinstance(response.get('meta', {}), dict):
+        response = dict((k, v) for (k, v) in response.items() if k != 'meta')
+
+    # Set exit code based on status field returned in the JSON response.
+    code = check_status (response)
+
+    # Adjust the exit code as necessary based on the other fields in
+    # the JSON response and add to the human-readable message we'll
+    # be returning via stdout.
+    code, msg = check_response (response, code, msg)
+
+    if freshness is not None and isinstance(response, dict):
+        code, msg = check_freshness(response, code, msg, freshness)
+
+    if perf is not None and isinstance(response, dict):
+        last_update = parse_timestamp(response.get('lastUpdate'))
+        if last_update is not None:
+            perf['age'] = max(0, time.time() - last_update)
+        perf['next_update'] = next_update(response, time.time())
+
+    return (code, msg)
+
+
+
+# Stands in for a field that isn't in a status, so that fields present with a
+# value of None are told apart from missing ones
+missing = object()
+
+def evaluate_statuses(statuses, msgs, perfs=None, freshness=None, now=None):
+    ''' Evaluate many decoded JSON statuses (dictionaries) at once
+
+        Returns a list with an (exit code, message) tuple for each of
+        'statuses', starting from the message in 'msgs' at the same position,
+        exactly as evaluate_status() would. If 'perfs' is given, it's a list
+        of the same length whose dictionaries get the age and next update of
+        each status. 'now' defaults to the current time.
+
+        Rather than going through check_status() and check_response() one
+        status at a time, the fields they look at are pulled out into columns
+        first, the exit codes are worked out from the columns in one pass and
+        each message is built with a single join instead of a concatenation
+        per field. lastUpdate and pollingInterval are only parsed if freshness
+        or perfs need them.
+    '''
+
+    if now is None:
+        now = time.time()
+
+    # Columns of the fields check_status() and check_response() look at
+    status = [response.get('status', missing) for response in statuses]
+    last = [response.get('lastUpdate', missing) for response in statuses]
+    meta = [response.get('meta', missing) for response in statuses]
+    polling = [m.get('pollingInterval', missing) if isinstance(m, dict) else missing for m in meta]
+    message = [response.get('message', missing) for response in statuses]
+
+    codes = ['WARNING' if s == 'UNKNOWN' else 'CRITICAL' if s != 'OK' else
+             'WARNING' if l is missing or p is missing else 'OK' for (s, l, p) in zip(status, last, polling)]
+
+    parts = [[msg] for msg in msgs]
+    for (column, label) in ((last, ' - Last update: {0}'), (polling, ' - Polling: {0}'), (message, ' - Details: {0}')):
+        for (value, p) in zip(column, parts):
+            if value is not missing:
+                p.append(label.format(value))
+
+    if freshness is not None or perfs is not None:
+        # A fleet shares a handful of polling intervals, and often update times
+        # too, so each distinct value is only parsed once
+        intervals = parse_column(parse_polling_interval, polling)
+        last_updates = parse_column(parse_timestamp, last)
+
+        for (i, (interval, last_update)) in enumerate(zip(intervals, last_updates)):
+            if freshness is not None:
+                codes[i], stale = check_stale(codes[i], last_update, interval, freshness, now)
+                if stale:
+                    parts[i].append(stale)
+
+            if perfs is not None:
+                if last_update is not None:
+                    perfs[i]['age'] = max(0, now - last_update)
+                perfs[i]['next_update'] = next_poll(last_update, interval, now)
+
+    return [(code, ''.join(p)) for (code, p) in zip(codes, parts)]
+
+
+
+def parse_column(parse, column):
+    ''' Apply 'parse' to each value in 'column', parsing each distinct value once '''
+
+    parsed = {}
+    results = []
+
+    for value in column:
+        if value is missing:
+            value = None
+        try:
+            if value not in parsed:
+                parsed[value] = parse(value)
+            results.append(parsed[value])
+        except TypeError:
+            results.append(parse(value))    # not hashable
+
+    return results
+
+
+
+# Matches ISO 8601 timestamps such as '2014-01-13T21:26:04Z'. Fractions of a
+# second are allowed but ignored; a missing time zone means UTC.
+timestamp_regex = re.compile(r'^\s*(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:\.\d*)?)?'
+                             r'\s*(Z|[+-]\d\d:?\d\d)?\s*$', re.IGNORECASE)
+
+def parse_timestamp(text):
+    ''' Convert an ISO 8601 timestamp such as '2014-01-13T21:26:04Z', as found
+        in lastUpdate, to seconds since the epoch. Returns None if the
+        timestamp can't be parsed.
+    '''
+
+    import calendar
+
+    match = timestamp_regex.match(text) if isinstance(text, string_types) else None
+    if match is None:
+        return None
+
+    year, month, day, hour, minute, second = [int(g or 0) for g in match.groups()[:6]]
+    if not (1 <= month <= 12 and 1 <= day <= 31 and hour < 24 and minute < 60 and second <= 60):
+        return None
+
+    seconds = calendar.timegm((year, month, day, hour, minute, second, 0, 0, 0))
+
+    zone = match.group(7)
+    if zone and zone.upper() != 'Z':
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        seconds -= offset if zone[0] == '+' else -offset
+
+    return seconds
+
+
+
+# Units a pollingInterval can be given in. Only the first letter counts, so
+# 'm', 'min' and 'minutes' are all minutes.
+interval_unit = r'(?P<unit>s|secs?|seconds?|m|mins?|minutes?|h|hrs?|hours?|d|days?|w|wks?|weeks?)'
+
+interval_seconds = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+# The forms of pollingInterval that are understood, tried in turn. Between them
+# they match 'Every 15 minutes', 'Every hour', '30 min', 'Every 1.5 hours',
+# 'Twice a day', '4 times per hour' and 'Hourly'.
+interval_regexes = [
+    re.compile(r'^(?:every\s+)?(?:(?P<count>\d+(?:\.\d+)?|an?|one)\s*)?' + interval_unit + r'$', re.IGNORECASE),
+    re.compile(r'^(?P<times>\d+|once|twice)(?:\s+times)?\s+(?:a|an|per|every)\s+' + interval_unit + r'$', re.IGNORECASE),
+    re.compile(r'^(?P<adverb>hourly|daily|nightly|weekly)$', re.IGNORECASE),
+]
+
+interval_adverbs = {'hourly': 3600, 'daily': 86400, 'nightly': 86400, 'weekly': 604800}
+
+# Intervals parsed so far. There are only a handful of different ones, so this
+# saves parsing the same string for every resource in a sweep. It stops
+# growing at interval_cache_size entries in case something odd turns up.
+interval_cache = {}
+interval_cache_size = 1024
+
+def parse_polling_interval(text):
+    ''' Convert a human-readable pollingInterval such as 'Every 15 minutes' to
+        a number of seconds. Returns None if the interval can't be parsed.
+    '''
+
+    if not isinstance(text, string_types):
+        return None
+
+    try:
+        return interval_cache[text]
+    except KeyError:
+        pass
+
+    seconds = None
+    words = ' '.join(text.split())
+
+    for regex in interval_regexes:
+        match = regex.match(words)
+        if match is None:
+            continue
+
+        groups = match.groupdict()
+        if groups.get('adverb'):
+            seconds = interval_adverbs[groups['adverb'].lower()]
+        else:
+            unit = interval_seconds[groups['unit'][0].lower()]
+            if groups.get('times'):
+                times = {'once': 1, 'twice': 2}.get(groups['times'].lower()) or int(groups['times'])
+                seconds = int(round(float(unit) / times)) if times else None
+            else:
+                count = groups.get('count')
+                count = 1 if not count or not count[0].isdigit() else float(count)
+                seconds = int(round(count * unit))
+        break
+
+    if seconds is not None and seconds <= 0:
+        seconds = None
+
+    if len(interval_cache) < interval_cache_size:
+        interval_cache[text] = seconds
+
+    return seconds
+
+
+
+def next_update(response, now):
+    ''' Work out when the web service is next due to poll a resource
+
+        That's lastUpdate + pollingInterval from the resource's JSON payload,
+        or cache_min_ttl from now if it's overdue. If lastUpdate or
+        pollingInterval are missing, it's cache_min_ttl from now.
+    '''
+
+    interval = None
+    if isinstance(response.get('meta'), dict):
+        interval = parse_polling_interval(response['meta'].get('pollingInterval'))
+
+    return next_poll(parse_timestamp(response.get('lastUpdate')), interval, now)
+
+
+
+def next_poll(last_update, interval, now):
+    ''' next_update() from an already parsed lastUpdate and pollingInterval '''
+
+    if interval is None or last_update is None:
+        return now + cache_min_ttl
+
+    # Don't let a lastUpdate from the future put the next poll off forever
+    return min(max(last_update + interval, now + cache_min_ttl), now + max(interval, cache_min_ttl))
+
+
+
+def format_duration(seconds):
+    ''' Describe a number of seconds briefly, eg. '2d 3h', '15m' or '45s' '''
+
+    seconds = int(seconds)
+    parts = []
+    for (unit, length) in (('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+        if seconds >= length or (unit == 's' and not parts):
+            parts.append('{0}{1}'.format(seconds // length, unit))
+            seconds %= length
+
+    return ' '.join(parts[:2])
+
+
+
+def check_freshness(response, code, msg, freshness, now=None):
+    ''' Make sure the web service has polled the resource recently
+
+        'freshness' is a (warning, critical) tuple of multiples of the
+        pollingInterval; either may be None. If lastUpdate is older than the
+        critical multiple of the interval, the exit code is raised to
+        CRITICAL, or WARNING if it's older than the warning multiple. If
+        lastUpdate or pollingInterval are missing or can't be parsed, nothing
+        changes; check_response() has already dealt with that.
+    '''
+
+    warning, critical = freshness
+    if warning is None and critical is None:
+        return (code, msg)
+
+    interval = None
+    if isinstance(response.get('meta'), dict):
+        interval = parse_polling_interval(response['meta'].get('pollingInterval'))
+    last_update = parse_timestamp(response.get('lastUpdate'))
+
+    code, stale = check_stale(code, last_update, interval, freshness, now or time.time())
+    return (code, msg + stale)
+
+
+
+def check_stale(code, last_update, interval, freshness, now):
+    ''' check_freshness() from an already parsed lastUpdate and pollingInterval
+
+        Returns the exit code and the text to add to the message, which is
+        empty if the status is fresh enough or can't be checked.
+    '''
+
+    warning, critical = freshness
+    if interval is None or last_update is None:
+        return (code, '')
+
+    age = now - last_update
+
+    for (limit, limit_code) in ((critical, 'CRITICAL'), (warning, 'WARNING')):
+        if limit is not None and age > limit * interval:
+            return (worst_code([code, limit_code]),
+                    ' - Stale: not updated for {0}, expected every {1}'.format(format_duration(age), format_duration(interval)))
+
+    return (code, '')
+
+
+
+class StatusCache(object):
+    ''' Responses from the web service, kept on disk and shared between processes
+
+        The web service only refreshes the status of a resource once every
+        pollingInterval, so there's no point asking again until lastUpdate +
+        pollingInterval has passed. Each resource has a file of its own in the
+        cache directory holding the body of the last successful response and
+        the time it expires. Files are replaced atomically, so a process never
+        sees one that is half written.
+
+        When a response has expired, the first process to notice fetches a
+        new one while holding a lock on the resource; any others wait for it
+        and use what it fetched, rather than all asking the web service at
+        once.
+
+        For 'stale' seconds after it expires, a response is still used to
+        answer checks, but the resource is added to the 'stale' set so that a
+        fresh copy can be fetched in the background (see revalidate()).
+
+        The JSON payload is kept already decoded, along with the ETag and
+        Last-Modified headers the web service sent with it. A fresh copy is
+        asked for with If-None-Match and If-Modified-Since, and if the web
+        service answers "304 Not Modified" the payload in the cache is used
+        again without the body being downloaded or decoded.
+    '''
+
+    def __init__(self, directory, stale=cache_stale_sec):
+        self.directory = directory
+        self.stale_sec = stale
+        self.stale = set()
+        self.refreshing = threading.Lock()     # held while revalidate_in_thread() is at work
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    def filename(self, resource_id, suffix='.json'):
+        return os.path.join(self.directory, '{0}{1}'.format(resource_id, suffix))
+
+
+    def read(self, resource_id):
+        ''' Return the cache entry for a resource, or None if there isn't one '''
+
+        try:
+            with open(self.filename(resource_id)) as f:
+                return json.load(f)
+
+        except (IOError, OSError, ValueError):
+            return None
+
+
+    def read_current(self, resource_id):
+        ''' Return the cache entry for a resource if it's in the current format '''
+
+        entry = self.read(resource_id)
+        if entry is None or 'status' not in entry:
+            return None     # missing, or written by an older version
+
+        return entry
+
+
+    def response(self, entry, timings=None):
+        ''' Turn a cache entry back into a response (only successful ones are cached) '''
+
+        r = CachedResponse(entry['status'], entry.get('size'))
+        r.timings = timings or {}
+        return r
+
+
+    def validators(self, entry):
+        ''' The headers that ask the web service for the response in 'entry' only if it has changed '''
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+
+    def expiry(self, response, now):
+        ''' Work out when a response with the given JSON payload expires
+
+            That's when the web service is next due to poll the resource; see
+            next_update().
+        '''
+
+        return next_update(response, now)
+
+
+    def write(self, resource_id, entry):
+        ''' Replace the cache entry for a resource '''
+
+        import tempfile
+
+        handle, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as f:
+                json.dump(entry, f)
+            os.rename(temp, self.filename(resource_id))
+
+        except (IOError, OSError):
+            if os.path.exists(temp):
+                os.remove(temp)
+
+
+    def store(self, resource_id, r, entry=None):
+        ''' Save a response in the cache if it was successful, and return the response to use
+
+            'entry' is the cache entry the request was made to revalidate. If
+            the web service says it's still current, it's given a new expiry
+            time and returned as a response; anything else is returned as is.
+        '''
+
+        headers = getattr(r, 'headers', None) or {}
+        now = time.time()
+
+        if r.status_code == httplib.NOT_MODIFIED and entry is not None:
+            entry['fetched'] = now
+            entry['expires'] = self.expiry(entry['status'], now)
+            entry['etag'] = headers.get('etag') or entry.get('etag')
+            entry['last_modified'] = headers.get('last-modified') or entry.get('last_modified')
+            self.write(resource_id, entry)
+            return self.response(entry, getattr(r, 'timings', None))
+
+        if r.status_code != httplib.OK:
+            return r
+
+        try:
+            response = r.json()
+            entry = {'fetched': now, 'expires': self.expiry(response, now), 'status': response,
+                     'size': len(r.content) if getattr(r, 'content', None) is not None else None,
+                     'etag': headers.get('etag'), 'last_modified': headers.get('last-modified')}
+
+        except (ValueError, TypeError, AttributeError):
+            return r    # not JSON, or not a JSON object, so not worth keeping
+
+        self.write(resource_id, entry)
+        return r
+
+
+
+    def lock(self, resource_id, blocking=True):
+        ''' Lock a resource so that only one process fetches it at a time
+
+            Returns the open lock file, which must be closed to release the
+            lock, or None if 'blocking' is False and someone else has it.
+        '''
+
+        f = open(self.filename(resource_id, '.lock'), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return f
+
+        except IOError as e:
+            f.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+
+
+    def fetch(self, resource_id, get):
+        ''' Return the response for a resource, from the cache if possible
+
+            'get' is called to fetch the response from the web service when
+            the cache can't be used, with the headers that make the request
+            conditional (see validators()).
+        '''
+
+        entry = self.read_current(resource_id)
+        if entry is not None:
+            if time.time() < entry['expires']:
+                return self.response(entry)
+
+            if time.time() < entry['expires'] + self.stale_sec:
+                self.stale.add(resource_id)
+                return self.response(entry)
+
+        lock = self.lock(resource_id)
+        try:
+            # Someone else may have fetched it while we waited for the lock
+            entry = self.read_current(resource_id)
+            if entry is not None and time.time() < entry['expires']:
+                return self.response(entry)
+
+            return self.store(resource_id, get(self.validators(entry)), entry)
+
+        finally:
+            lock.close()
+
+
+    def revalidate(self, get=None, timeout=timeout_sec):
+        ''' Fetch fresh copies of the stale responses handed out so far
+
+            Resources that another process is already fetching are skipped.
+            Errors are ignored; the stale response stays in the cache until a
+            check fetches it again.
+        '''
+
+        while True:
+            try:
+                resource_id = self.stale.pop()
+            except KeyError:
+                break               # another thread may have emptied it since
+            self.refresh(resource_id, get, timeout)
+
+
+    def revalidate_in_thread(self, get=None, timeout=timeout_sec):
+        ''' Call revalidate() in a thread of its own, unless one already is
+
+            Returns the thread, or None if another was already refreshing the
+            stale responses (it picks up any added since).
+        '''
+
+        if not self.refreshing.acquire(False):
+            return None
+
+        def refresher():
+            try:
+                self.revalidate(get, timeout)
+            finally:
+                self.refreshing.release()
+
+        thread = threading.Thread(target=refresher)
+        thread.start()
+        return thread
+
+
+    def refresh(self, resource_id, get=None, timeout=timeout_sec):
+        ''' Fetch a fresh copy of a response, unless another process is already doing it
+
+            Returns when the entry in the cache expires, or None if there is
+            no entry. Errors are ignored.
+        '''
+
+        lock = self.lock(resource_id, blocking=False)
+        if lock is None:
+            return None
+
+        try:
+            entry = self.read_current(resource_id)
+            headers = self.validators(entry)
+            kwargs = {'headers': headers} if headers else {}
+            self.store(resource_id, (get or make_transport().get)(resource_url(resource_id), timeout=timeout,
+                                                                  **kwargs), entry)
+        except Exception:
+            pass
+        finally:
+            lock.close()
+
+        entry = self.read_current(resource_id)
+        return entry['expires'] if entry is not None else None
+
+
+    def revalidate_in_background(self, timeout=timeout_sec):
+        ''' Call revalidate() in a child process that outlives this one
+
+            The child detaches from stdin, stdout and stderr so that Nagios
+            gets our output and exit code straight away.
+        '''
+
+        if not self.stale:
+            return
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        try:
+            if os.fork() != 0:
+                return
+        except OSError:
+            return  # we'll refresh the next time round instead
+
+        try:
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+
+            self.revalidate(timeout=timeout)
+
+        finally:
+            os._exit(0)
+
+
+
+def check_resource(resource_id, get=None, timeout=timeout_sec, cache=None, perf=None, freshness=None, history=None):
+    ''' Retrieve the status of one resource and convert it to an exit code
+
+        'get' is the function used to issue the GET request, normally the get
+        method of a transport. If none is given, a new instance of the default
+        transport is used; batch mode passes in the get method of a shared
+        transport so that connections are re-used between resources. If a
+        StatusCache is given, the response is taken from it when possible.
+
+        If a 'perf' dictionary is given, measurements of the request are
+        recorded in it for use as performance data; see perf_items. If the
+        request fails, the name of the error is recorded under 'error'.
+        'freshness' is passed on to evaluate_response(). If a History is
+        given, the result is added to it.
+
+        Communications errors are caught here and reported as CRITICAL, so
+        this function always returns an (exit code, message) tuple.
+    '''
+
+    code = 'CRITICAL'   # assume badness until we learn otherwise
+    msg = 'Research Software resource {0}'.format(resource_id)
+
+    if perf is None and history is not None:
+        perf = {}
+
+    try:
+        # Make a request to the web service that tells us about the status of
+        # the specified software component (ie. service or platform).
+        url = resource_url(resource_id)
+
+        def fetch(headers=None):
+            kwargs = {'headers': headers} if headers else {}
+            return (get or make_transport().get)(url, timeout=timeout, **kwargs)
+
+        mark('setup')
+        started = time.time()
+        try:
+            r = cache.fetch(resource_id, fetch) if cache else fetch()
+        except CommunicationsError:
+            mark('request')
+            raise
+        finally:
+            if perf is not None:
+                perf['time'] = time.time() - started
+
+        if profile is not None:
+            timings = getattr(r, 'timings', {})
+            parts = [(key, timings[key]) for key in ('dns', 'tcp', 'tls', 'wait') if key in timings]
+            if 'ttfb' in timings and 'total' in timings:
+                parts.append(('download', timings['total'] - timings['ttfb']))
+            mark('request', parts)
+
+        if perf is not None:
+            timings = getattr(r, 'timings', {})
+            perf.update((key, timings[key]) for key in ('connect', 'ttfb') if key in timings)
+            if isinstance(r, CachedResponse):
+                if r.size is not None:
+                    perf['size'] = r.size
+            elif getattr(r, 'content', None) is not None:
+                perf['size'] = len(r.content)
+
+        code, msg = evaluate_response(r, msg, perf, freshness)
+
+    # Catch any exceptions raised during the above processing and adjust the
+    # outgoing human readable message accordingly.
+    except (ValueError, CommunicationsError) as e:
+        error, text = [(error, text) for (error, text) in error_messages if isinstance(e, error)][0]
+        msg += ' - ' + text
+        if perf is not None:
+            perf['error'] = error.__name__
+
+    if history is not None:
+        history.append(resource_id, time.time(), codelist[code], perf.get('time'), perf.get('age'))
+
+    return (code, msg)
+
+
+
+def read_ids(filename):
+    ''' Read a list of resource ids from a file ('-' means stdin)
+
+        Ids may be separated by whitespace or commas, and anything following
+        a '#' on a line is ignored. A ValueError is raised if the file contains
+        something that isn't a numeric id.
+    '''
+
+    f = sys.stdin if filename == '-' else open(filename)
+    try:
+        ids = []
+        for line in f:
+            for item in line.split('#', 1)[0].replace(',', ' ').split():
+                try:
+                    ids.append(int(item))
+                except ValueError:
+                    raise ValueError('invalid resource id in {0}: {1}'.format(filename, item))
+        return ids
+
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+
+def check_resources(ids, workers=default_workers, timeout=timeout_sec, cache=None, transport=None, freshness=None,
+                    policy=None, breaker=None, history=None):
+    ''' Check the status of many resources concurrently
+
+        Requests are issued from a pool of at most 'workers' threads sharing
+        a single transport, so that TCP and TLS connections to the web
+        service are set up once and re-used for the whole batch rather than
+        once per resource.
+
+        Requests follow the RetryPolicy 'policy' and go through the
+        CircuitBreaker 'breaker' if these are given. The results are added
+        to the History 'history' if there is one.
+
+        Returns a list of (id, exit code, message) tuples in the same order as
+        'ids'. Duplicate ids are only checked once.
+    '''
+
+    # Remove duplicates but keep the order the ids were given in
+    seen = set()
+    ids = [i for i in ids if not (i in seen or seen.add(i))]
+
+    from multiprocessing.pool import ThreadPool
+
+    shared = make_transport(transport, workers, policy, breaker)
+
+    def check(resource_id):
+        return (resource_id,) + check_resource(resource_id, shared.get, timeout, cache, freshness=freshness,
+                                               history=history)
+
+    pool = ThreadPool(max(1, min(workers, len(ids))))
+    try:
+        return pool.map(check, ids)
+
+    finally:
+        pool.close()
+        pool.join()
+        shared.close()
+
+
+
+def bulk_url(ids):
+    ''' Build up the URL used to retrieve the status of several resources at once '''
+
+    return '{0}{1}?ids={2}'.format(urlbase, bulk_path, ','.join(str(i) for i in ids))
+
+
+
+class JSONStream(object):
+    ''' Decode the values in a JSON document one at a time as its bytes arrive
+
+        'chunks' is an iterable of pieces of the UTF-8 encoded document, such
+        as the iter_content() of a streamed response. Only the part of the
+        document that hasn't been decoded yet is kept, so memory use depends on
+        the size of the largest value read with value(), not of the document.
+        A ValueError is raised if the document isn't valid JSON.
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = u''
+        self.pos = 0        # start of the part of the buffer not yet decoded
+        self.done = False   # all of the document is in the buffer
+
+
+    def more(self):
+        ''' Read the next piece of the document, returning False at its end '''
+
+        if self.done:
+            return False
+
+        try:
+            text = self.utf8.decode(next(self.chunks))
+        except StopIteration:
+            text = self.utf8.decode(b'', True)
+            self.done = True
+
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+
+    def peek(self):
+        ''' The next character that isn't white space, or '' at the end of the document '''
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in u' \t\r\n':
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self.more():
+                return ''
+
+
+    def expect(self, chars):
+        ''' Read past the next character, which must be one of 'chars', and return it '''
+
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('expected one of {0} at {1!r}'.format(chars, self.buffer[self.pos:self.pos + 20]))
+
+        self.pos += 1
+        return c
+
+
+    def value(self):
+        ''' Decode the next value in the document '''
+
+        self.peek()
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+
+                # A number at the end of the buffer may continue in the next piece
+                if end < len(self.buffer) or self.done:
+                    self.pos = end
+                    return value
+
+            except ValueError:
+                if self.done:
+                    raise   # not just incomplete
+
+            self.more()
+
+
+
+def bulk_items(stream, outermost=True):
+    ''' Yield the (key, status) pairs of the object or list next in a JSONStream '''
+
+    opening = stream.expect('{[')
+    closing = '}' if opening == '{' else ']'
+
+    if stream.peek() == closing:
+        stream.pos += 1
+        return
+
+    while True:
+        if opening == '[':
+            status = stream.value()
+            yield (status.get('id', status.get('resourceId')) if isinstance(status, dict) else None, status)
+
+        else:
+            key = stream.value()
+            stream.expect(':')
+
+            if outermost and key == 'resources' and stream.peek() in ('{', '['):
+                for item in bulk_items(stream, False):
+                    yield item
+            else:
+                yield (key, stream.value())
+
+        if stream.expect(',' + closing) == closing:
+            return
+
+
+
+def bulk_statuses(chunks):
+    ''' Yield the (id, status) pairs in a bulk response as they arrive
+
+        The statuses can be given as an object keyed by resource id, or as a
+        list of objects that each carry an 'id' (or 'resourceId') field, and
+        either can be wrapped in an object under 'resources'. Entries that
+        don't look like a resource status are left out. The response is
+        parsed with a JSONStream, so only one status is decoded at a time and
+        the first ones are available before the whole response has arrived.
+        A ValueError is raised at the point the response stops being valid.
+    '''
+
+    for (key, status) in bulk_items(JSONStream(chunks)):
+        try:
+            if isinstance(status, dict):
+                yield (int(key), status)
+        except (TypeError, ValueError):
+            pass    # not a resource id
+
+
+
+def bulk_results(ids, get, timeout=timeout_sec, freshness=None, history=None):
+    ''' Yield an (id, exit code, message) tuple for each of 'ids' in a bulk response
+
+        A single request is made with 'get', and the results are yielded as
+        the response arrives. Ids that aren't in the response are left out,
+        as are the rest of them if the request fails part way through. The
+        results are added to the History 'history' if there is one.
+    '''
+
+    wanted = set(ids)
+
+    try:
+        r = get(bulk_url(ids), timeout=timeout, stream=True)
+        try:
+            if r.status_code != httplib.OK:
+                for _ in r.iter_content(stream_chunk):
+                    pass    # read the rest so the connection can be re-used
+                return
+
+            pending = []
+            for (resource_id, status) in bulk_statuses(r.iter_content(stream_chunk)):
+                if resource_id in wanted:
+                    wanted.discard(resource_id)
+                    pending.append((resource_id, status))
+                    if len(pending) >= evaluate_chunk:
+                        for result in evaluate_bulk(pending, freshness, history):
+                            yield result
+                        pending = []
+
+            for result in evaluate_bulk(pending, freshness, history):
+                yield result
+
+        finally:
+            r.close()
+
+    except (ValueError, CommunicationsError):
+        pass    # the remaining resources are checked one at a time instead
+
+
+
+def evaluate_bulk(pending, freshness=None, history=None):
+    ''' Evaluate the (id, status) pairs from a bulk response with evaluate_statuses() '''
+
+    msgs = ['Research Software resource {0}'.format(resource_id) for (resource_id, status) in pending]
+    perfs = [{} for _ in pending]
+    results = evaluate_statuses([status for (resource_id, status) in pending], msgs, perfs, freshness)
+
+    now = time.time()
+    for ((resource_id, status), perf, (code, msg)) in zip(pending, perfs, results):
+        if history is not None:
+            history.append(resource_id, now, codelist[code], None, perf.get('age'))
+        yield (resource_id, code, msg)
+
+
+
+def check_resources_bulk(ids, workers=default_workers, timeout=timeout_sec, cache=None, transport=None,
+                         freshness=None, policy=None, breaker=None, history=None):
+    ''' Check the status of many resources with as few requests as possible
+
+        The ids are asked for from the bulk endpoint, at most bulk_chunk at a
+        time, and each status that comes back is judged exactly as if it had
+        been fetched on its own (see bulk_results()). Resources the bulk
+        endpoint doesn't return, and all of them if it can't be reached or
+        gives a bad answer, are checked one at a time as check_resources()
+        would. Only those go through the cache. Requests follow the
+        RetryPolicy 'policy' and go through the CircuitBreaker 'breaker' if
+        these are given. The results are added to the History 'history' if
+        there is one; the response time of a status from the bulk endpoint
+        isn't known.
+
+        Returns a list of (id, exit code, message) tuples in the same order as
+        'ids'. Duplicate ids are only checked once.
+    '''
+
+    # Remove duplicates but keep the order the ids were given in
+    seen = set()
+    ids = [i for i in ids if not (i in seen or seen.add(i))]
+
+    from multiprocessing.pool import ThreadPool
+
+    shared = make_transport(transport, workers, policy, breaker)
+
+    results = {}
+
+    def fetch(chunk):
+        for result in bulk_results(chunk, shared.get, timeout, freshness, history):
+            results[result[0]] = result
+
+    def check(resource_id):
+        if resource_id in results:
+            return results[resource_id]
+
+        return (resource_id,) + check_resource(resource_id, shared.get, timeout, cache, freshness=freshness,
+                                               history=history)
+
+    pool = ThreadPool(max(1, min(workers, len(ids))))
+    try:
+        pool.map(fetch, [ids[i:i + bulk_chunk] for i in range(0, len(ids), bulk_chunk)])
+
+        return pool.map(check, ids)
+
+    finally:
+        pool.close()
+        pool.join()
+        shared.close()
+
+
+
+def check_single(resource_id, get=None, timeout=timeout_sec, cache=None, freshness=None, thresholds=None,
+                 history=None, window=history_window):
+    ''' Check a resource the way a single check on the command line does
+
+        On top of check_resource(), the thresholds are applied and, with a
+        History, the availability and flap rate of the resource over the
+        last 'window' seconds are added to the performance data.
+
+        Returns the exit code, the message and the formatted performance
+        data, which format_result() puts together into the line of output.
+    '''
+
+    perf = {}
+    code, msg = check_resource(resource_id, get, timeout, cache, perf, freshness, history)
+    code, msg = check_thresholds(code, msg, perf, thresholds or {})
+    if history is not None:
+        perf.update(history.perf(resource_id, window))
+    mark('evaluate')
+
+    return (code, msg, format_perfdata(perf, thresholds))
+
+
+
+def report_batch(results, history=None):
+    ''' Write the results of a batch of checks to stdout
+
+        The first line is a summary for the whole batch, which is what Nagios
+        displays as the status information. Each resource then gets a line of
+        its own, in the same format as a single check, which Nagios shows as
+        the long output. The overall exit code is the worst of the individual
+        ones, and is returned. If the results couldn't all be added to the
+        History 'history', the summary says so and is at least WARNING.
+    '''
+
+    code = worst_code([c for (_, c, _) in results])
+    summary = 'Research Software batch of {0} resources - {1}'.format(len(results), count_codes([c for (_, c, _) in results]))
+
+    if history is not None and history.failures:
+        summary += ' - History not kept for {0} results ({1})'.format(history.failures, history.error)
+        code = worst_code([code, 'WARNING'])
+
+    print(format_result(code, summary))
+    for (_, c, m) in results:
+        print(format_result(c, m))
+
+    return code
+
+
+
+class PassiveWriter(object):
+    ''' Submit check results to Nagios as passive service checks
+
+        Results are buffered and written out in batches, once 'batch' of them
+        are waiting or the oldest has waited 'interval' seconds, and by
+        flush(). They go to the external command file at 'path' as
+        PROCESS_SERVICE_CHECK_RESULT commands or, with 'spool', as a check
+        result file in the directory 'path' (Nagios' check_result_path).
+        Each resource is submitted as the service 'service' (formatted with
+        the resource id) on the host 'host'.
+
+        Writes to the command file are at most PIPE_BUF bytes each, which
+        keeps them from being interleaved with those of anything else
+        submitting commands at the same time. A check result file is only
+        picked up by Nagios once the matching .ok file exists, so it's
+        never read half written.
+    '''
+
+    def __init__(self, path, host, service=passive_service, spool=False, batch=passive_batch,
+                 interval=passive_flush_sec):
+        self.path = path
+        self.host = host
+        self.service = service
+        self.spool = spool
+        self.batch = batch
+        self.interval = interval
+        self.pending = []   # (time, resource id, exit code, output) waiting to be written
+        self.queued = None  # when the oldest of them was submitted
+        self.written = 0
+
+
+    def submit(self, resource_id, code, output, when=None):
+        ''' Queue the result of a check: its exit code (as in codelist) and the line of output '''
+
+        now = time.time()
+        if not self.pending:
+            self.queued = now
+        self.pending.append((now if when is None else when, resource_id, code, output))
+
+        if len(self.pending) >= self.batch or now - self.queued >= self.interval:
+            self.flush()
+
+
+    def flush(self):
+        ''' Write out the results waiting to be written
+
+            Raises IOError or OSError if they can't be, in which case they're
+            kept for the next attempt.
+        '''
+
+        if not self.pending:
+            return
+
+        if self.spool:
+            self.write_spool(self.pending)
+        else:
+            self.write_commands(self.pending)
+
+        self.written += len(self.pending)
+        self.pending = []
+
+
+    def command(self, when, resource_id, code, output):
+        ''' The external command that submits one result
+
+            Line breaks in the output, which holds text from the web service,
+            are escaped as in a check result file, so that they can't end the
+            command and start another.
+        '''
+
+        output = output.replace('\\', '\\\\').replace('\r', '').replace('\n', '\\n')
+        return '[{0}] PROCESS_SERVICE_CHECK_RESULT;{1};{2};{3};{4}\n'.format(
+            int(when), self.host, self.service.format(id=resource_id), codelist[code], output)
+
+
+    def write_commands(self, results):
+        import select
+
+        # Group the commands into writes small enough to be atomic
+        chunks = ['']
+        for result in results:
+            line = self.command(*result)
+            if chunks[-1] and len((chunks[-1] + line).encode('utf-8')) > select.PIPE_BUF:
+                chunks.append('')
+            chunks[-1] += line
+
+        # Don't wait for a reader that isn't there: the command file is a
+        # named pipe that only exists while Nagios is running
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+        try:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+            for chunk in chunks:
+                os.write(fd, chunk.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+
+    def write_spool(self, results):
+        import random
+
+        # Nagios only reads files whose names are 'c' and six more characters
+        letters = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+        while True:
+            name = os.path.join(self.path, 'c' + ''.join(random.choice(letters) for _ in range(6)))
+            try:
+                fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        lines = ['### Active Check Result File ###', 'file_time={0}'.format(int(time.time())), '']
+        for (when, resource_id, code, output) in results:
+            output = output.replace('\\', '\\\\').replace('\n', '\\n')
+            lines.extend(['### Nagios Service Check Result ###',
+                          'host_name={0}'.format(self.host),
+                          'service_description={0}'.format(self.service.format(id=resource_id)),
+                          'check_type=1',       # passive
+                          'check_options=0',
+                          'scheduled_check=0',
+                          'reschedule_check=0',
+                          'latency=0.0',
+                          'start_time={0:.6f}'.format(when),
+                          'finish_time={0:.6f}'.format(when),
+                          'early_timeout=0',
+                          'exited_ok=1',
+                          'return_code={0}'.format(codelist[code]),
+                          'output={0}'.format(output),
+                          ''])
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        except Exception:
+            os.remove(name)
+            raise
+
+        open(name + '.ok', 'w').close()
+
+
+
+def fingerprint(code, msg):
+    ''' A short digest of an exit code and message that ignores the parts
+        of the message that change from one check to the next (see
+        volatile_text)
+    '''
+
+    import hashlib
+
+    text = u'{0} {1}'.format(code, volatile_text.sub('', msg))
+    return hashlib.md5(text.encode('utf-8')).hexdigest()[:16]
+
+
+
+class ChangeFilter(object):
+    ''' Pass on only the results that have changed since they were last passed on
+
+        The fingerprint of the last result passed on for each resource, and
+        when that was, are kept in the file at 'path'. A result is passed on
+        if its fingerprint is different, or if the last one was passed on
+        'heartbeat' seconds ago or more. save() writes the file, which should
+        only be done once the results have been passed on.
+    '''
+
+    def __init__(self, path, heartbeat=heartbeat_sec):
+        self.path = path
+        self.heartbeat = heartbeat
+        self.state = self.read()    # str(resource id) -> [fingerprint, time passed on]
+
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            return state if isinstance(state, dict) else {}
+
+        except (IOError, OSError, ValueError):
+            return {}   # nothing passed on yet
+
+
+    def changed(self, resource_id, code, msg, now=None):
+        ''' Whether to pass on this result, in which case it's recorded as passed on '''
+
+        now = time.time() if now is None else now
+        digest = fingerprint(code, msg)
+        last = self.state.get(str(resource_id))
+
+        if last and last[0] == digest and now - last[1] < self.heartbeat:
+            return False
+
+        self.state[str(resource_id)] = [digest, now]
+        return True
+
+
+    def save(self):
+        ''' Write the state to disk, atomically
+
+            Raises IOError or OSError if it can't be written.
+        '''
+
+        import tempfile
+
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as f:
+                json.dump(self.state, f, separators=(',', ':'))
+            os.rename(temp, self.path)
+
+        except (IOError, OSError):
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+
+
+def submit_resources(ids, writer, workers=default_workers, timeout=timeout_sec, cache=None, transport=None,
+                     freshness=None, thresholds=None, policy=None, breaker=None, history=None,
+                     window=history_window, changes=None):
+    ''' Check many resources and submit the results to Nagios through the PassiveWriter 'writer'
+
+        Each resource is checked as by check_single(), and submitted with
+        the line of output and exit code that a single check of it would
+        give, as soon as it's known. With a ChangeFilter 'changes', only the
+        results it passes on are submitted, and its state is saved once they
+        have been written. The other arguments are those of
+        check_resources().
+
+        Returns a list of (id, exit code, message) tuples in the same order as
+        'ids', once every result has been written out. Duplicate ids are only
+        checked once.
+    '''
+
+    seen = set()
+    ids = [i for i in ids if not (i in seen or seen.add(i))]
+
+    from multiprocessing.pool import ThreadPool
+
+    shared = make_transport(transport, workers, policy, breaker)
+
+    def check(resource_id):
+        return (resource_id,) + check_single(resource_id, shared.get, timeout, cache, freshness, thresholds, history,
+                                             window)
+
+    results = {}
+    pool = ThreadPool(max(1, min(workers, len(ids))))
+    try:
+        for (resource_id, code, msg, perfdata) in pool.imap_unordered(check, ids):
+            if changes is None or changes.changed(resource_id, code, msg):
+                writer.submit(resource_id, code, format_result(code, msg, perfdata))
+            results[resource_id] = (resource_id, code, msg)
+    finally:
+        pool.close()
+        pool.join()
+        shared.close()
+
+    writer.flush()
+    if changes is not None:
+        changes.save()
+    return [results[resource_id] for resource_id in ids]
+
+
+
+def parse_rule(text):
+    ''' Parse a roll-up rule given to '--rule': "worst", "quorum:N" or "percent:WARNING[:CRITICAL]"
+
+        Returns it as a tuple for rollup(). Raises ValueError if it isn't
+        one of those, or if the CRITICAL percentage of OK members is above
+        the WARNING one, which would make a group CRITICAL before WARNING.
+    '''
+
+    kind, _, limits = text.partition(':')
+    limits = [float(limit) for limit in limits.split(':')] if limits else []
+
+    if kind == 'worst' and not limits:
+        return ('worst',)
+    if kind == 'quorum' and len(limits) == 1 and limits[0] >= 1:
+        return ('quorum', int(limits[0]))
+    if kind == 'percent' and len(limits) in (1, 2) and all(0 <= limit <= 100 for limit in limits) and \
+            limits[-1] <= limits[0]:
+        return ('percent', limits[0], limits[-1] if len(limits) == 2 else 0.0)
+
+    raise ValueError('unknown roll-up rule: {0}'.format(text))
+
+
+
+def rollup(codes, rule=('worst',)):
+    ''' The exit code of a group whose members have the exit codes 'codes'
+
+        By 'rule' (see parse_rule()), it is:
+
+        ('worst',)                  the worst of them
+        ('quorum', n)               OK if all of them are OK, WARNING if at
+                                    least n are, CRITICAL otherwise
+        ('percent', warn, crit)     CRITICAL if fewer than crit percent of
+                                    them are OK, WARNING if fewer than warn
+                                    percent are, OK otherwise
+
+        An empty group is UNKNOWN unless the rule is 'worst'.
+    '''
+
+    if rule[0] == 'worst':
+        return worst_code(codes)
+
+    if not codes:
+        return 'UNKNOWN'
+
+    ok = codes.count('OK')
+    if rule[0] == 'quorum':
+        return 'OK' if ok == len(codes) else 'WARNING' if ok >= rule[1] else 'CRITICAL'
+
+    percent = 100.0 * ok / len(codes)
+    return 'CRITICAL' if percent < rule[2] else 'WARNING' if percent < rule[1] else 'OK'
+
+
+
+def read_groups(filename):
+    ''' Read the groups of resources used by '--group' from a file
+
+        Each line is a group name, a colon and the ids of its members,
+        separated by whitespace or commas, and anything following a '#' is
+        ignored. A group may be spread over several lines. Returns a
+        dictionary mapping names to lists of ids; raises ValueError if the
+        file can't be made sense of.
+    '''
+
+    groups = {}
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#', 1)[0]
+            if not line.strip():
+                continue
+
+            name, colon, members = line.partition(':')
+            if not colon or not name.strip():
+                raise ValueError('invalid group in {0}: {1}'.format(filename, line.strip()))
+            try:
+                groups.setdefault(name.strip(), []).extend(int(item) for item in members.replace(',', ' ').split())
+            except ValueError:
+                raise ValueError('invalid resource id in group {0} in {1}'.format(name.strip(), filename))
+
+    return groups
+
+
+
+def report_group(name, results, rule=('worst',)):
+    ''' Write the results of a roll-up check of the group 'name' to stdout
+
+        The first line gives the exit code of the group, by 'rule' (see
+        rollup()), and how many of its members are OK; it's what Nagios
+        displays as the status information. Each member then gets a line of
+        its own in the long output, worst first. Returns the exit code.
+    '''
+
+    codes = [c for (_, c, _) in results]
+    code = rollup(codes, rule)
+
+    msg = 'Research Software group {0} - {1} of {2} OK'.format(name, codes.count('OK'), len(codes))
+    if codes and codes.count('OK') < len(codes):
+        msg += ' ({0}%) - {1}'.format(perf_number(100.0 * codes.count('OK') / len(codes)),
+                                      count_codes([c for c in codes if c != 'OK']))
+
+    print(format_result(code, msg))
+    for (_, c, m) in sorted(results, key=lambda result: -severity.index(result[1])):
+        print(format_result(c, m))
+
+    return code
+
+
+
+def make_daemon(path, connections=default_workers, timeout=timeout_sec, cache=None, transport=None,
+                thresholds=None, freshness=None, policy=None, breaker=None, history=None):
+    ''' Create the server used in daemon mode
+
+        The server listens on the Unix domain socket 'path'. Each connection
+        carries one request: a resource id terminated by a newline. The
+        reply is the numeric exit code, a space and the line a single check
+        would have written to stdout, performance data included. Every
+        connection is handled in a thread of its own and all of them share
+        one transport, so checks don't pay for DNS lookups or TCP/TLS set
+        up. Stale responses handed out from the cache, if there is one, are
+        refreshed in a background thread. Requests follow the RetryPolicy
+        'policy' and go through the CircuitBreaker 'breaker' if these are
+        given. With a History, each result is added to it and the
+        availability and flap rate of the resource are added to the
+        performance data.
+    '''
+
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver
+
+    shared = make_transport(transport, connections, policy, breaker)
+
+    class CheckHandler(socketserver.StreamRequestHandler):
+        ''' Answer a single check request '''
+
+        def handle(self):
+            request = self.rfile.readline().decode('ascii', 'replace').strip()
+
+            try:
+                code, msg, perfdata = check_single(int(request), shared.get, timeout, cache, freshness, thresholds,
+                                                   history)
+            except ValueError:
+                code, msg, perfdata = 'WARNING', 'Research Software - Usage error', None
+
+            reply = '{0} {1}\n'.format(codelist[code], format_result(code, msg, perfdata))
+            self.wfile.write(reply.encode('utf-8'))
+
+            if cache is not None and cache.stale:
+                cache.revalidate_in_thread(shared.get, timeout)
+
+    class CheckServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    # A socket left behind by a previous instance would stop us binding
+    if os.path.exists(path):
+        os.remove(path)
+
+    return CheckServer(path, CheckHandler)
+
+
+
+def prefetcher(cache, workers=default_workers, timeout=timeout_sec, transport=None, policy=None, breaker=None):
+    ''' Return a function that refreshes the responses in 'cache' for a list of ids, for Scheduler.run() '''
+
+    from multiprocessing.pool import ThreadPool
+
+    shared = make_transport(transport, workers, policy, breaker)
+    pool = ThreadPool(workers)
+
+    def refresh(ids):
+        return dict(zip(ids, pool.map(lambda resource_id: cache.refresh(resource_id, shared.get, timeout), ids)))
+
+    return refresh
+
+
+
+def run_daemon(path, connections=default_workers, cache=None, transport=None, thresholds=None, freshness=None,
+               policy=None, breaker=None, scheduler=None, history=None):
+    ''' Answer check requests on the socket 'path' until we're told to stop
+
+        With a Scheduler, the responses in the cache are also refreshed in
+        the background as they fall due, so checks are answered from it.
+    '''
+
+    server = make_daemon(path, connections, cache=cache, transport=transport, thresholds=thresholds, freshness=freshness,
+                         policy=policy, breaker=breaker, history=history)
+
+    if scheduler is not None and cache is not None:
+        refresher = threading.Thread(target=scheduler.run,
+                                     args=(prefetcher(cache, connections, transport=transport, policy=policy,
+                                                      breaker=breaker),))
+        refresher.daemon = True
+        refresher.start()
+
+    # Treat SIGTERM like Ctrl-C so that the socket gets cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+
+class History(object):
+    ''' The results of recent checks of each resource, kept on disk
+
+        Each resource has a file of its own in 'directory', holding the last
+        'capacity' results in a ring (see history_header and history_record).
+        The files are memory mapped, so adding a result is a matter of
+        writing a few bytes, and a result is written before the header that
+        counts it so that a check that dies part way through can't leave a
+        half written record in the history. Writers hold a lock on the file,
+        so any number of processes can share the history. Only the
+        history_open most recently used files are kept open.
+
+        A history that can't be opened or created is counted in 'failures'
+        (with the reason in 'error'), reported once on stderr and left out of
+        the summary of a batch (see report_batch()), rather than stopping the
+        check.
+    '''
+
+    def __init__(self, directory, capacity=history_capacity):
+        self.directory = directory
+        self.capacity = capacity
+        self.maps = collections.OrderedDict()  # resource id -> (file, mmap), least recently used first
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.error = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    def filename(self, resource_id):
+        return os.path.join(self.directory, '{0}.history'.format(resource_id))
+
+
+    def ids(self):
+        ''' The ids of the resources with a history '''
+
+        names = [name.split('.')[0] for name in os.listdir(self.directory) if name.endswith('.history')]
+        return sorted(int(name) for name in names if name.isdigit())
+
+
+    def open(self, resource_id, create=True):
+        ''' Return the (file, memory map) of the history of a resource, or None if there isn't one
+
+            The caller must hold self.lock, and use the map before letting go
+            of it, as it may be closed to make way for another one after that.
+        '''
+
+        import mmap
+
+        if resource_id in self.maps:
+            self.maps[resource_id] = self.maps.pop(resource_id)    # now the most recently used
+            return self.maps[resource_id]
+
+        if not create and not os.path.exists(self.filename(resource_id)):
+            return None
+
+        while self.maps and len(self.maps) >= history_open:
+            f, ring = self.maps.popitem(last=False)[1]
+            ring.close()
+            f.close()
+
+        f = ring = None
+        try:
+            f = os.fdopen(os.open(self.filename(resource_id), os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                header = f.read(history_header.size)
+                if self.valid(header, os.fstat(f.fileno()).st_size):
+                    ring = mmap.mmap(f.fileno(), history_header.size + history_header.unpack(header)[3] * history_record.size)
+
+                elif create:
+                    # A new file, or one we can't make sense of: start again
+                    size = history_header.size + self.capacity * history_record.size
+                    f.seek(0)
+                    f.truncate(size)
+                    f.write(history_header.pack(history_marker, history_version, history_record.size, self.capacity, 0))
+                    f.flush()
+                    ring = mmap.mmap(f.fileno(), size)
+
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        except (IOError, OSError, EnvironmentError) as e:
+            self.failed(resource_id, e)
+
+        if ring is None:
+            if f is not None:
+                f.close()
+            return None
+
+        self.maps[resource_id] = (f, ring)
+        return (f, ring)
+
+
+    def failed(self, resource_id, error):
+        ''' Count a history that couldn't be opened, and say why the first time '''
+
+        self.failures += 1
+        self.error = 'resource {0}: {1}'.format(resource_id, error)
+        if self.failures == 1:
+            sys.stderr.write('check_research_sw: history not kept for {0}\n'.format(self.error))
+
+
+    def close(self):
+        ''' Close the history files that are open '''
+
+        with self.lock:
+            while self.maps:
+                f, ring = self.maps.popitem()[1]
+                ring.close()
+                f.close()
+
+
+    def valid(self, header, size):
+        ''' Whether a history file with this header and size is one we can use '''
+
+        if len(header) != history_header.size:
+            return False
+
+        marker, version, record_size, capacity, count = history_header.unpack(header)
+        return (marker == history_marker and version == history_version and record_size == history_record.size and
+                capacity > 0 and size == history_header.size + capacity * record_size)
+
+
+    def append(self, resource_id, when, code, latency=None, age=None):
+        ''' Add the result of a check: its time, exit code, response time and the age of the status '''
+
+        nan = float('nan')
+
+        with self.lock:
+            entry = self.open(resource_id)
+            if entry is None:
+                return  # nowhere to keep it
+
+            f, ring = entry
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                marker, version, record_size, capacity, count = history_header.unpack_from(ring, 0)
+                history_record.pack_into(ring, history_header.size + (count % capacity) * record_size, when, code,
+                                         nan if latency is None else latency, nan if age is None else age)
+                history_header.pack_into(ring, 0, marker, version, record_size, capacity, count + 1)
+
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def records(self, resource_id, since=None):
+        ''' The (time, exit code, response time, age) of the checks kept, oldest first
+
+            Only checks made at or after 'since' are returned, if it's given.
+            Unknown times are None.
+        '''
+
+        with self.lock:
+            entry = self.open(resource_id, create=False)
+            if entry is None:
+                return []
+
+            ring = entry[1]
+            marker, version, record_size, capacity, count = history_header.unpack_from(ring, 0)
+            raw = [history_record.unpack_from(ring, history_header.size + (n % capacity) * record_size)
+                   for n in range(max(0, count - capacity), count)]
+
+        return [(when, code, None if math.isnan(latency) else latency, None if math.isnan(age) else age)
+                for (when, code, latency, age) in raw if since is None or when >= since]
+
+
+    def summary(self, resource_id, window=history_window, now=None):
+        ''' Summarise the checks of a resource made in the last 'window' seconds
+
+            Returns a dictionary with the number of checks, the availability
+            (the percentage of them that were OK), the flap rate (the
+            percentage of them whose exit code was different from the one
+            before) and the 50th, 90th and 99th percentiles of the response
+            times, any of which is None if there's nothing to go on.
+        '''
+
+        now = time.time() if now is None else now
+        records = self.records(resource_id, now - window)
+        codes = [code for (when, code, latency, age) in records]
+        latencies = [latency for (when, code, latency, age) in records if latency is not None]
+
+        summary = {'checks': len(records), 'availability': None, 'flapping': None}
+        if codes:
+            summary['availability'] = 100.0 * codes.count(codelist['OK']) / len(codes)
+        if len(codes) > 1:
+            summary['flapping'] = 100.0 * sum(1 for (a, b) in zip(codes, codes[1:]) if a != b) / (len(codes) - 1)
+        for pct in (50, 90, 99):
+            summary['p{0}'.format(pct)] = percentile(latencies, pct) if latencies else None
+
+        return summary
+
+
+    def perf(self, resource_id, window=history_window):
+        ''' The availability and flap rate of a resource, as performance data '''
+
+        summary = self.summary(resource_id, window)
+        return dict((key, summary[key]) for key in ('availability', 'flapping') if summary[key] is not None)
+
+
+    def report(self, ids=None, window=history_window):
+        ''' One line summarising the history of each resource, for '--report' '''
+
+        def value(number, unit):
+            return 'n/a' if number is None else perf_number(number) + unit
+
+        lines = []
+        for resource_id in ids or self.ids():
+            summary = self.summary(resource_id, window)
+            lines.append('Research Software resource {0} - {1} checks, availability {2}, flap rate {3}, '
+                         'response time p50 {4} p90 {5} p99 {6}'.format(
+                             resource_id, summary['checks'], value(summary['availability'], '%'),
+                             value(summary['flapping'], '%'), value(summary['p50'], 's'),
+                             value(summary['p90'], 's'), value(summary['p99'], 's')))
+
+        return lines
+
+
+
+class HashRing(object):
+    ''' Share resource ids out between a group of pollers by consistent hashing
+
+        Each node is given 'replicas' points on a ring of 64 bit hashes, and
+        a resource belongs to the node whose point comes first at or after
+        the hash of its id, going round. Every node given the same list of
+        nodes, in any order, agrees on who owns what, and adding or removing
+        a node only moves the resources it gains or loses: about 1/N of them.
+    '''
+
+    def __init__(self, nodes, replicas=shard_replicas):
+        self.nodes = sorted(set(nodes))
+        points = sorted((self.hash('{0}#{1}'.format(node, n)), node) for node in self.nodes for n in range(replicas))
+        self.hashes = [h for (h, node) in points]
+        self.owners = [node for (h, node) in points]
+
+
+    @staticmethod
+    def hash(text):
+        import hashlib
+        return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:16], 16)
+
+
+    def owner(self, resource_id):
+        ''' The node that checks a resource '''
+
+        import bisect
+
+        n = bisect.bisect_left(self.hashes, self.hash(str(resource_id)))
+        return self.owners[n % len(self.owners)]
+
+
+    def owned(self, ids, node):
+        ''' The ids, in the order given, that belong to 'node' '''
+
+        return [resource_id for resource_id in ids if self.owner(resource_id) == node]
+
+
+    def coverage(self, ids):
+        ''' Work out which ids each node would check, as each of them does
+
+            Returns a dictionary mapping each node to its ids, and a list of
+            the ids that aren't owned by exactly one node (which should be
+            empty).
+        '''
+
+        ids = sorted(set(ids))
+        shares = dict((node, self.owned(ids, node)) for node in self.nodes)
+
+        claims = dict((resource_id, 0) for resource_id in ids)
+        for owned in shares.values():
+            for resource_id in owned:
+                claims[resource_id] += 1
+
+        return (shares, [resource_id for resource_id in ids if claims[resource_id] != 1])
+
+
+
+def report_coverage(ring, ids):
+    ''' Write out how the ids are shared out between the nodes of 'ring'
+
+        The first line says whether every id belongs to exactly one node;
+        each node then gets a line with the number of ids it checks. Returns
+        the exit code: CRITICAL if any id doesn't belong to exactly one node.
+    '''
+
+    shares, wrong = ring.coverage(ids)
+    total = sum(len(owned) for owned in shares.values())
+    msg = 'Research Software shard coverage - {0} resources over {1} nodes'.format(len(set(ids)), len(ring.nodes))
+
+    if wrong:
+        code = 'CRITICAL'
+        msg += ' - {0} not owned by exactly one node: {1}'.format(len(wrong), ', '.join(str(i) for i in wrong))
+    else:
+        code = 'OK'
+        msg += ', each owned by exactly one'
+
+    print(format_result(code, msg))
+    for node in ring.nodes:
+        share = 100.0 * len(shares[node]) / total if total else 0
+        print('{0} - {1} resources ({2}%)'.format(node, len(shares[node]), perf_number(share)))
+
+    return code
+
+
+
+class Scheduler(object):
+    ''' Work out when each of a set of resources is worth fetching again
+
+        There's no point fetching the status of a resource before the web
+        service has polled it again, which it does every pollingInterval.
+        The time each resource is next due is kept in a heap, so the next
+        one is always at the front, plus a random jitter of up to 'jitter'
+        seconds. At the start, resources are spread over the first 'jitter'
+        seconds.
+    '''
+
+    def __init__(self, ids, jitter=schedule_jitter):
+        import random
+
+        self.random = random.Random()
+        self.jitter = jitter
+        now = time.time()
+
+        self.heap = [(now + self.random.uniform(0, jitter), resource_id) for resource_id in sorted(set(ids))]
+        heapq.heapify(self.heap)
+
+
+    def schedule(self, resource_id, due):
+        ''' Fetch a resource after 'due', or cache_min_ttl from now if that's not known '''
+
+        if due is None:
+            due = time.time() + cache_min_ttl
+
+        heapq.heappush(self.heap, (due + self.random.uniform(0, self.jitter), resource_id))
+
+
+    def due(self):
+        ''' Remove and return the resources that are due to be fetched now '''
+
+        now = time.time()
+        ids = []
+        while self.heap and self.heap[0][0] <= now:
+            ids.append(heapq.heappop(self.heap)[1])
+
+        return ids
+
+
+    def wait(self):
+        ''' Seconds until the next resource is due, or None if there are none '''
+
+        if not self.heap:
+            return None
+
+        return max(0, self.heap[0][0] - time.time())
+
+
+    def run(self, fetch, stop=None):
+        ''' Fetch resources as they fall due until the threading.Event 'stop' is set
+
+            'fetch' is given a list of ids and returns a dictionary mapping
+            each of them to when the web service is next due to poll it (or
+            None if that isn't known).
+        '''
+
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            ids = self.due()
+            if ids:
+                for (resource_id, due) in fetch(ids).items():
+                    self.schedule(resource_id, due)
+            else:
+                stop.wait(self.wait())
+
+
+
+class Exporter(object):
+    ''' The state behind the Prometheus exporter
+
+        poll() checks every resource once and renders the metrics page from
+        the results; scrapes are answered with the page as it stands, so
+        they never cause a request to the web service and take the same time
+        however many resources there are. The metrics are:
+
+        research_software_status                 exit code of the latest check (see codelist)
+        research_software_last_update_age_seconds seconds since lastUpdate, where known
+        research_software_fetch_duration_seconds  histogram of response times
+        research_software_fetch_errors_total      failed requests by error (see error_messages)
+        research_software_checks_total            checks made
+        research_software_poll_timestamp_seconds  when the latest poll finished
+        research_software_poll_duration_seconds   how long it took
+
+        With a Scheduler, each poll only checks the resources that are due.
+
+        The other arguments are those of check_resources().
+    '''
+
+    def __init__(self, ids, workers=default_workers, timeout=timeout_sec, cache=None, transport=None, freshness=None,
+                 policy=None, breaker=None, history=None):
+        self.ids = sorted(set(ids))
+        self.workers = workers
+        self.timeout = timeout
+        self.cache = cache
+        self.freshness = freshness
+        self.history = history
+        self.transport = make_transport(transport, workers, policy, breaker)
+
+        self.results = {}   # id -> (exit code, perf)
+        self.buckets = [0] * (len(latency_buckets) + 1)     # the last is +Inf
+        self.latency_sum = 0.0
+        self.errors = dict((error.__name__, 0) for (error, text) in error_messages)
+        self.checks = 0
+        self.polled = None
+        self.poll_seconds = None
+        self.page = self.render()
+
+
+    def poll(self, ids=None):
+        ''' Check every resource, or just 'ids', and update the metrics page
+
+            Returns a dictionary mapping each id checked to when the web
+            service is next due to poll it, if known, for the Scheduler.
+        '''
+
+        from multiprocessing.pool import ThreadPool
+
+        def check(resource_id):
+            perf = {}
+            code, msg = check_resource(resource_id, self.transport.get, self.timeout, self.cache, perf, self.freshness,
+                                       self.history)
+            return (resource_id, code, perf)
+
+        started = time.time()
+        ids = self.ids if ids is None else ids
+        pool = ThreadPool(max(1, min(self.workers, len(ids))))
+        try:
+            results = pool.map(check, ids)
+        finally:
+            pool.close()
+            pool.join()
+
+        for (resource_id, code, perf) in results:
+            self.results[resource_id] = (code, perf)
+            self.checks += 1
+
+            if 'error' in perf:
+                self.errors[perf['error']] += 1
+            elif 'time' in perf:
+                self.buckets[len([b for b in latency_buckets if b < perf['time']])] += 1
+                self.latency_sum += perf['time']
+
+        self.polled = time.time()
+        self.poll_seconds = self.polled - started
+        self.page = self.render()
+
+        if self.cache is not None and self.cache.stale:
+            self.cache.revalidate(self.transport.get, self.timeout)
+
+        return dict((resource_id, perf.get('next_update')) for (resource_id, code, perf) in results)
+
+
+    def render(self):
+        ''' The metrics page, in the Prometheus text format '''
+
+        lines = []
+
+        def metric(name, kind, text, samples):
+            lines.append('# HELP {0} {1}'.format(name, text))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+            lines.extend('{0}{1} {2}'.format(name, labels, perf_number(value)) for (labels, value) in samples)
+
+        resources = sorted(self.results.items())
+        metric('research_software_status', 'gauge',
+               'Exit code of the latest check (0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN, 4 DEPENDENT)',
+               [('{{resource="{0}"}}'.format(i), codelist[code]) for (i, (code, perf)) in resources])
+        metric('research_software_last_update_age_seconds', 'gauge', 'Seconds since the resource was last polled',
+               [('{{resource="{0}"}}'.format(i), perf['age']) for (i, (code, perf)) in resources if 'age' in perf])
+
+        counts = [sum(self.buckets[:n + 1]) for n in range(len(self.buckets))]
+        bounds = [perf_number(b) for b in latency_buckets] + ['+Inf']
+        metric('research_software_fetch_duration_seconds', 'histogram', 'Time taken to get the status of a resource',
+               [('_bucket{{le="{0}"}}'.format(bound), count) for (bound, count) in zip(bounds, counts)] +
+               [('_sum', self.latency_sum), ('_count', counts[-1])])
+
+        metric('research_software_fetch_errors_total', 'counter', 'Requests for the status of a resource that failed',
+               [('{{error="{0}"}}'.format(name), count) for (name, count) in sorted(self.errors.items())])
+        metric('research_software_checks_total', 'counter', 'Checks made', [('', self.checks)])
+
+        if self.polled is not None:
+            metric('research_software_poll_timestamp_seconds', 'gauge', 'When all resources were last checked',
+                   [('', self.polled)])
+            metric('research_software_poll_duration_seconds', 'gauge', 'Time taken to check all resources',
+                   [('', self.poll_seconds)])
+
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+    def run(self, interval=exporter_interval, stop=None, scheduler=None):
+        ''' Poll every 'interval' seconds, or as 'scheduler' says, until the threading.Event 'stop' is set '''
+
+        stop = stop or threading.Event()
+        if scheduler is not None:
+            return scheduler.run(self.poll, stop)
+
+        while not stop.is_set():
+            started = time.time()
+            self.poll()
+            stop.wait(max(0, interval - (time.time() - started)))
+
+
+
+def make_exporter(address, exporter):
+    ''' Create the HTTP server that serves the metrics page of 'exporter' on /metrics '''
+
+    try:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+    except ImportError:
+        from http.server import BaseHTTPRequestHandler, HTTPServer     # Python 3
+        from socketserver import ThreadingMixIn
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        ''' Answer a scrape with the page as it stands '''
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            page = exporter.page
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+    class MetricsServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    return MetricsServer(address, MetricsHandler)
+
+
+
+def run_exporter(address, exporter, interval=exporter_interval, scheduler=None):
+    ''' Serve metrics on 'address' while polling in the background, until we're told to stop '''
+
+    server = make_exporter(address, exporter)
+
+    poller = threading.Thread(target=exporter.run, args=(interval, None, scheduler))
+    poller.daemon = True
+    poller.start()
+
+    # Treat SIGTERM like Ctrl-C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+
+
+
+def parse_address(text):
+    ''' Split "[HOST:]PORT" into a (host, port) tuple, as used by '--exporter' '''
+
+    host, _, port = text.rpartition(':')
+    return (host.strip('[]'), int(port))
+
+
+
+class Options(object):
+    ''' Command line options, set to their default values
+
+        parse_args() fills in whatever is given on the command line.
+    '''
+
+    id = []
+    file = None
+    workers = default_workers
+    daemon = False
+    socket = default_socket
+    cache_dir = None
+    cache_stale = cache_stale_sec
+    transport = None
+    urlbase = None
+    latency_warning = None
+    latency_critical = None
+    age_warning = None
+    age_critical = None
+    stale_warning = None
+    stale_critical = None
+    bulk = False
+    timeout = None
+    retries = default_retries
+    hedge = None
+    circuit = None
+    circuit_failures = circuit_failures
+    circuit_reset = circuit_reset_sec
+    exporter = None
+    interval = exporter_interval
+    schedule = False
+    schedule_jitter = schedule_jitter
+    history_dir = None
+    history_window = history_window
+    report = False
+    passive = None
+    passive_spool = None
+    passive_host = None
+    passive_service = passive_service
+    passive_batch = passive_batch
+    passive_flush = passive_flush_sec
+    changes_only = None
+    heartbeat = heartbeat_sec
+    endpoint_state = None
+    group = None
+    group_file = None
+    rule = ('worst',)
+    shard_nodes = None
+    shard_node = None
+    coverage = False
+    profile = False
+    profile_file = None
+    profile_sample = 1.0
+
+    def ring(self):
+        ''' The HashRing asked for on the command line, or None '''
+
+        if not self.shard_nodes:
+            return None
+
+        return HashRing(node.strip() for node in self.shard_nodes.split(',') if node.strip())
+
+    def urls(self):
+        ''' The base URLs given on the command line '''
+
+        return [url.strip().rstrip('/') for urls in self.urlbase or [] for url in urls.split(',') if url.strip()]
+
+    def endpoints(self):
+        ''' The Endpoints asked for on the command line, or None for a single base URL '''
+
+        if len(self.urls()) < 2:
+            return None
+
+        return Endpoints(self.urls(), self.endpoint_state)
+
+    def thresholds(self):
+        ''' The thresholds given on the command line, as used by check_thresholds() '''
+
+        return {'time': (self.latency_warning, self.latency_critical),
+                'age': (self.age_warning, self.age_critical)}
+
+    def freshness(self):
+        ''' The multiples of pollingInterval given on the command line, as used by check_freshness() '''
+
+        return (self.stale_warning, self.stale_critical)
+
+    def policy(self):
+        ''' The RetryPolicy asked for on the command line, or None for a single attempt per request '''
+
+        if self.timeout is None and self.hedge is None:
+            return None
+
+        return RetryPolicy(self.timeout or timeout_sec, self.retries, self.hedge)
+
+    def breaker(self):
+        ''' The CircuitBreaker asked for on the command line, or None '''
+
+        if self.circuit is None:
+            return None
+
+        return CircuitBreaker(self.circuit, self.circuit_failures, self.circuit_reset)
+
+    def history(self):
+        ''' The History asked for on the command line, or None '''
+
+        if self.history_dir is None:
+            return None
+
+        return History(self.history_dir)
+
+    def writer(self):
+        ''' The PassiveWriter asked for on the command line, or None '''
+
+        if self.passive is None and self.passive_spool is None:
+            return None
+
+        return PassiveWriter(self.passive or self.passive_spool, self.passive_host, self.passive_service,
+                             spool=self.passive is None, batch=self.passive_batch, interval=self.passive_flush)
+
+    def changes(self):
+        ''' The ChangeFilter asked for on the command line, or None '''
+
+        if self.changes_only is None:
+            return None
+
+        return ChangeFilter(self.changes_only, self.heartbeat)
+
+    def scheduler(self):
+        ''' The Scheduler asked for on the command line, or None '''
+
+        if not self.schedule:
+            return None
+
+        return Scheduler(self.id, self.schedule_jitter)
+
+
+
+def parse_args(argv):
+    ''' Parse the command line and return the options
+
+        The usual Nagios check, with a single id as its only argument, is
+        handled without loading argparse. Raises SystemExit if the command
+        line is wrong.
+    '''
+
+    options = Options()
+
+    if len(argv) == 1 and argv[0].isdigit():
+        options.id = [int(argv[0])]
+        return options
+
+    import argparse
+
+    # Build up command line parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument('id', type=int, nargs='*', help='numeric identifier of the resource(s) of interest')
+    parser.add_argument('-f', '--file', help='read more resource ids from FILE ("-" for stdin) and check them as a batch')
+    parser.add_argument('-w', '--workers', type=int, default=default_workers,
+                        help='number of resources checked concurrently in batch mode (default: %(default)s)')
+    parser.add_argument('--bulk', action='store_true',
+                        help='in batch mode, fetch the status of many resources per request from the bulk endpoint')
+    parser.add_argument('-t', '--timeout', type=float, metavar='SECONDS',
+                        help='time allowed for each check, as given to check_nrpe -t; failed requests are '
+                             'retried for as long as it allows')
+    parser.add_argument('--retries', type=int, default=default_retries,
+                        help='number of times a failed request may be retried with --timeout (default: %(default)s)')
+    parser.add_argument('--hedge', type=float, metavar='PERCENTILE',
+                        help='send a second request when the first is slower than this percentile of '
+                             'response times seen so far (batch and daemon modes)')
+    parser.add_argument('--circuit', metavar='FILE',
+                        help='share a circuit breaker through FILE, so that checks fail at once while the web '
+                             'service is unreachable')
+    parser.add_argument('--circuit-failures', type=int, metavar='N', default=circuit_failures,
+                        help='connection errors or timeouts in a row that open the circuit (default: %(default)s)')
+    parser.add_argument('--circuit-reset', type=float, metavar='SECONDS', default=circuit_reset_sec,
+                        help='time the circuit stays open before a request is let through to test the web '
+                             'service (default: %(default)s)')
+    parser.add_argument('--daemon', action='store_true',
+                        help='answer check requests from check_research_sw_client.py instead of checking resources')
+    parser.add_argument('--exporter', metavar='[HOST:]PORT', type=parse_address,
+                        help='serve the status of the resources as Prometheus metrics on /metrics, '
+                             'checking them in the background')
+    parser.add_argument('--interval', type=float, metavar='SECONDS', default=exporter_interval,
+                        help='how often the exporter checks the resources (default: %(default)s)')
+    parser.add_argument('--schedule', action='store_true',
+                        help='with --exporter or --daemon (and --cache-dir), fetch each resource when the web '
+                             'service is due to have polled it again, instead of every --interval')
+    parser.add_argument('--schedule-jitter', type=float, metavar='SECONDS', default=schedule_jitter,
+                        help='spread scheduled fetches over this many seconds (default: %(default)s)')
+    parser.add_argument('--socket', default=default_socket,
+                        help='Unix domain socket used in daemon mode (default: %(default)s)')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='share responses from the web service between checks through files in DIR')
+    parser.add_argument('--cache-stale', type=int, metavar='SECONDS', default=cache_stale_sec,
+                        help='keep answering from the cache for this long after a response expires, '
+                             'while it is refreshed in the background (default: %(default)s)')
+    parser.add_argument('--history-dir', metavar='DIR',
+                        help='keep the results of recent checks of each resource in DIR, and report the '
+                             'availability and flap rate of a single resource as performance data')
+    parser.add_argument('--history-window', type=float, metavar='SECONDS', default=history_window,
+                        help='period the availability, flap rate and --report cover (default: %(default)s)')
+    parser.add_argument('--report', action='store_true',
+                        help='summarise the history of the resources given, or of all of them, instead of '
+                             'checking them')
+    parser.add_argument('--passive', metavar='FILE',
+                        help='submit the results to Nagios as passive checks through its external command file FILE')
+    parser.add_argument('--passive-spool', metavar='DIR',
+                        help='submit the results to Nagios as passive checks through check result files in DIR '
+                             '(its check_result_path)')
+    parser.add_argument('--passive-host', metavar='HOST',
+                        help='host the passive checks are submitted for')
+    parser.add_argument('--passive-service', metavar='TEMPLATE', default=passive_service,
+                        help='service the passive check of each resource is submitted as, with {id} replaced by '
+                             'the resource id (default: %(default)s)')
+    parser.add_argument('--passive-batch', type=int, metavar='N', default=passive_batch,
+                        help='write passive check results once this many are waiting (default: %(default)s)')
+    parser.add_argument('--passive-flush', type=float, metavar='SECONDS', default=passive_flush_sec,
+                        help='write passive check results once the oldest has waited this long (default: %(default)s)')
+    parser.add_argument('--changes-only', metavar='FILE',
+                        help='only submit passive check results that have changed since they were last '
+                             'submitted, keeping track of them in FILE')
+    parser.add_argument('--heartbeat', type=float, metavar='SECONDS', default=heartbeat_sec,
+                        help='with --changes-only, submit a result that hasn\'t changed once it was last '
+                             'submitted this long ago (default: %(default)s)')
+    parser.add_argument('--group', metavar='NAME',
+                        help='check the resources together as the group NAME and give it a single exit code')
+    parser.add_argument('--group-file', metavar='FILE',
+                        help='read the members of the --group from FILE, which has lines of the form "NAME: ID ..."')
+    parser.add_argument('--rule', type=parse_rule, default=('worst',),
+                        help='how the exit code of a --group is worked out: worst (the default), quorum:N '
+                             '(OK members needed to avoid CRITICAL) or percent:WARNING[:CRITICAL] (percentage '
+                             'of OK members needed)')
+    parser.add_argument('--shard-nodes', metavar='NODES',
+                        help='share the resources out between the pollers named in this comma separated list, '
+                             'and only check those that belong to this one')
+    parser.add_argument('--shard-node', metavar='NAME',
+                        help='name of this poller in --shard-nodes (default: the host name)')
+    parser.add_argument('--coverage', action='store_true',
+                        help='show how the resources are shared out between --shard-nodes instead of checking them')
+    parser.add_argument('--profile', action='store_true',
+                        help='write how long each phase of the check took to stderr')
+    parser.add_argument('--profile-file', metavar='FILE',
+                        help='profile the check like --profile, but append the phases to FILE as a JSON line')
+    parser.add_argument('--profile-sample', type=float, metavar='FRACTION', default=1.0,
+                        help='only profile this fraction of checks, chosen at random (default: %(default)s)')
+    parser.add_argument('--transport', choices=sorted(transports),
+                        help='how to talk to the web service (default: {0})'.format(default_transport))
+    parser.add_argument('-u', '--urlbase', metavar='URL', action='append',
+                        help='URL of the web service (default: {0}); give more than one, separated by commas or '
+                             'with more than one --urlbase, to use whichever is answering best'.format(urlbase))
+    parser.add_argument('--endpoint-state', metavar='FILE',
+                        help='with more than one --urlbase, share how well each is answering with other checks '
+                             'through FILE')
+    parser.add_argument('--latency-warning', type=float, metavar='SECONDS',
+                        help='WARNING if the web service takes longer than this to answer')
+    parser.add_argument('--latency-critical', type=float, metavar='SECONDS',
+                        help='CRITICAL if the web service takes longer than this to answer')
+    parser.add_argument('--age-warning', type=float, metavar='SECONDS',
+                        help='WARNING if lastUpdate is older than this')
+    parser.add_argument('--age-critical', type=float, metavar='SECONDS',
+                        help='CRITICAL if lastUpdate is older than this')
+    parser.add_argument('--stale-warning', type=float, metavar='MULTIPLE',
+                        help='WARNING if lastUpdate is older than this many pollingIntervals')
+    parser.add_argument('--stale-critical', type=float, metavar='MULTIPLE',
+                        help='CRITICAL if lastUpdate is older than this many pollingIntervals')
+
+    parser.parse_args(argv, namespace=options)
+
+    if options.file:
+        try:
+            options.id = options.id + read_ids(options.file)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+
+    if options.group_file:
+        if not options.group:
+            parser.error('--group-file needs --group')
+        try:
+            groups = read_groups(options.group_file)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+        if options.group not in groups:
+            parser.error('no group {0} in {1}'.format(options.group, options.group_file))
+        options.id = options.id + groups[options.group]
+
+    if options.group and (options.daemon or options.exporter or options.report or options.passive or
+                          options.passive_spool or options.shard_nodes):
+        parser.error('--group can\'t be used with --daemon, --exporter, --report, --shard-nodes or passive checks')
+
+    if options.daemon and options.id and not options.schedule:
+        parser.error('resource ids can only be given in daemon mode with --schedule')
+
+    if options.schedule and not (options.exporter or (options.daemon and options.cache_dir)):
+        parser.error('--schedule needs --exporter, or --daemon and --cache-dir')
+
+    if options.schedule_jitter < 0:
+        parser.error('the schedule jitter can\'t be negative')
+
+    if options.daemon and options.exporter:
+        parser.error('--daemon and --exporter can\'t be used together')
+
+    if options.report and not options.history_dir:
+        parser.error('--report needs --history-dir')
+
+    if options.passive or options.passive_spool:
+        if options.passive and options.passive_spool:
+            parser.error('--passive and --passive-spool can\'t be used together')
+        if options.daemon or options.exporter or options.report:
+            parser.error('passive checks can\'t be submitted with --daemon, --exporter or --report')
+        if not options.passive_host:
+            parser.error('passive checks need --passive-host')
+        if options.passive_batch < 1:
+            parser.error('the passive batch size must be at least 1')
+
+    elif options.changes_only:
+        parser.error('--changes-only needs --passive or --passive-spool')
+
+    if not options.id and not options.daemon and not options.report:
+        parser.error('at least one resource id is required')
+
+    if options.interval <= 0:
+        parser.error('the interval must be more than 0 seconds')
+
+    if options.shard_nodes:
+        nodes = options.ring().nodes
+        if not nodes:
+            parser.error('--shard-nodes needs at least one node')
+        options.shard_node = options.shard_node or socket.gethostname().split('.')[0]
+        if options.shard_node not in nodes and not options.coverage:
+            parser.error('this poller ({0}) isn\'t one of the --shard-nodes'.format(options.shard_node))
+
+    elif options.coverage or options.shard_node:
+        parser.error('--coverage and --shard-node need --shard-nodes')
+
+    if options.endpoint_state and len(options.urls()) < 2:
+        parser.error('--endpoint-state needs more than one --urlbase')
+
+    if not 0 <= options.profile_sample <= 1:
+        parser.error('the profile sample must be between 0 and 1')
+
+    if options.workers < 1:
+        parser.error('the number of workers must be at least 1')
+
+    if options.timeout is not None and options.timeout <= deadline_margin:
+        parser.error('the timeout must be more than {0} seconds'.format(deadline_margin))
+
+    if options.retries < 0:
+        parser.error('the number of retries can\'t be negative')
+
+    if options.circuit_failures < 1:
+        parser.error('the number of failures that open the circuit must be at least 1')
+
+    if options.hedge is not None and not 0 < options.hedge < 100:
+        parser.error('the hedging percentile must be between 0 and 100')
+
+    return options
+
+
+
+def sampled(fraction):
+    ''' Whether this run is one of the 'fraction' chosen at random '''
+
+    if fraction >= 1:
+        return True
+
+    import random
+    return random.random() < fraction
+
+
+
+def main():
+
+    global urlbase, endpoints, profile
+
+    message = 'Research Software'
+
+    # Profiling is only set up once the command line says it's wanted, so a
+    # check that isn't profiled doesn't pay for it, but the time taken to
+    # parse the command line is still counted from here
+    started = (clock(), time.time())
+
+    try:
+        args = parse_args(sys.argv[1:])
+
+    except SystemExit:
+        message += ' - Usage error'      # raised by argparse
+        print(format_result('WARNING', message))
+        exit(codelist['WARNING'])
+
+    profile = Profile(*started) if (args.profile or args.profile_file) and sampled(args.profile_sample) else None
+
+    mark('argparse')
+
+    if args.urlbase:
+        urlbase = args.urls()[0]
+        endpoints = args.endpoints()
+
+    ids = args.id
+    ring = args.ring()
+
+    if args.coverage:
+        exit(codelist[report_coverage(ring, ids)])
+
+    # Only check our share of the resources when polling is shared out
+    if ring is not None:
+        args.id = ids = ring.owned(ids, args.shard_node)
+
+    cache = StatusCache(args.cache_dir, args.cache_stale) if args.cache_dir else None
+
+    history = args.history()
+
+    if args.report:
+        for line in history.report(ids, args.history_window):
+            print(line)
+        exit(0)
+
+    if args.daemon:
+        run_daemon(args.socket, args.workers, cache, args.transport, args.thresholds(), args.freshness(), args.policy(),
+                   args.breaker(), args.scheduler(), history)
+        exit(0)
+
+    if args.exporter:
+        exporter = Exporter(ids, args.workers, cache=cache, transport=args.transport, freshness=args.freshness(),
+                            policy=args.policy(), breaker=args.breaker(), history=history)
+        run_exporter(args.exporter, exporter, args.interval, args.scheduler())
+        exit(0)
+
+    # Passive checks are submitted to Nagios, one per resource. Otherwise a
+    # single id on the command line is the classic Nagios check, and anything
+    # more is checked as a batch, with one line of output per resource.
+    writer = args.writer()
+
+    if writer is not None:
+        try:
+            code = report_batch(submit_resources(ids, writer, args.workers, cache=cache, transport=args.transport,
+                                                 freshness=args.freshness(), thresholds=args.thresholds(),
+                                                 policy=args.policy(), breaker=args.breaker(), history=history,
+                                                 window=args.history_window, changes=args.changes()), history)
+        except (IOError, OSError) as e:
+            print(format_result('UNKNOWN', 'Research Software - Cannot submit passive check results: {0}'.format(e)))
+            exit(codelist['UNKNOWN'])
+        mark('batch')
+
+    elif args.group:
+        # Every member at once, so the group takes as long as the slowest
+        batch = check_resources_bulk if args.bulk else check_resources
+        code = report_group(args.group, batch(ids, max(args.workers, len(ids)), cache=cache, transport=args.transport,
+                                              freshness=args.freshness(), policy=args.policy(),
+                                              breaker=args.breaker(), history=history), args.rule)
+        mark('batch')
+
+    elif len(ids) == 1 and not args.file and ring is None:
+        transport = make_transport(args.transport, policy=args.policy(), breaker=args.breaker())
+        code, message, perfdata = check_single(ids[0], transport.get, cache=cache, freshness=args.freshness(),
+                                               thresholds=args.thresholds(), history=history,
+                                               window=args.history_window)
+        print(format_result(code, message, perfdata))
+
+    else:
+        batch = check_resources_bulk if args.bulk else check_resources
+        code = report_batch(batch(ids, args.workers, cache=cache, transport=args.transport,
+                                  freshness=args.freshness(), policy=args.policy(), breaker=args.breaker(),
+                                  history=history), history)
+        mark('batch')
+
+    mark('output')
+    if profile is not None:
+        profile.write(args.profile_file or '-', ids=ids, code=code)
 
-    except requests.exceptions.HTTPError:
-        message += ' - HTTP error'
+    if cache is not None:
+        cache.revalidate_in_background()
 
-    except requests.exceptions.RequestException: 
-        message += ' - Unknown communications error'    # catch all
-  
-  
-    print(code + ' - {0} '.format(message))
     exit(codelist[code])
 
 # -----------------------------------------------------------------------------
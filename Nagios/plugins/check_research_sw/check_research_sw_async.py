@@ -0,0 +1,435 @@
+#!/usr/bin/python3
+
+'''
+Copyright 2016 - CANARIE Inc. All rights reserved
+
+Synopsis: asyncio engine for check_research_sw.py that sweeps thousands of
+          resources from a single process, writing out each result as soon as
+          it is known. Requires Python 3.
+
+Blob Hash: $Id$
+
+-------------------------------------------------------------------------------
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, 
+   this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, 
+   this list of conditions and the following disclaimer in the documentation 
+   and/or other materials provided with the distribution.
+
+3. The name of the author may not be used to endorse or promote products 
+   derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY CANARIE Inc. "AS IS" AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+
+Theory of Operations:
+
+The batch mode of check_research_sw.py uses a thread per concurrent request,
+which is fine for a few hundred resources but not for tens of thousands. This
+module checks resources from a single thread using asyncio instead.
+
+A fixed number of worker tasks ('--concurrency') take ids from the list of
+resources to check, so only that many requests are ever in progress and memory
+use does not grow with the size of the list. Connections to the web service
+are kept open and re-used, with at most '--per-host' of them to any one host,
+and a rate limiter spaces requests out so that no more than '--rate' are
+started per second.
+
+Each response is converted to an exit code and message by the same code as a
+single check (check_research_sw.evaluate_response), and communications errors
+are reported with the same messages. The timeout of each request starts once it
+has a connection, not while it waits for one of the '--per-host' slots. A line
+summarising the whole sweep is written to stdout first, as in batch mode,
+followed by the results in the order they completed, in the same format as a
+single check. With '--stream', each result is written as soon as it completes
+and the summary comes last instead. The exit code is the worst of the
+individual ones.
+
+'''
+
+import argparse
+import asyncio
+import http.client
+import shutil
+import ssl
+import sys
+import tempfile
+
+from urllib.parse import urljoin, urlsplit
+
+import check_research_sw
+
+# Number of requests in progress at any one time
+default_concurrency = 100
+
+# Maximum number of connections open to any one host
+default_per_host = 10
+
+# Maximum number of requests started per second (0 means no limit)
+default_rate = 20.0
+
+# Bytes of result lines held in memory before they are moved to a temporary
+# file, while the summary line that goes before them is worked out
+spool_size = 1048576
+
+
+class ProtocolError(Exception):
+    ''' Raised when the server's response isn't valid HTTP '''
+
+
+
+class RateLimiter(object):
+    ''' Space out the start of requests so there are at most 'rate' per second '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = 0
+
+    async def wait(self):
+        if not self.interval:
+            return
+
+        # There's no await between reading and updating next_slot, so no
+        # other task can take the same slot
+        now = asyncio.get_event_loop().time()
+        delay = self.next_slot - now
+        self.next_slot = max(now, self.next_slot) + self.interval
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+
+class AsyncChecker(object):
+    ''' Check the status of resources concurrently from a single thread
+
+        Use sweep() to check a list of resources and close() when done to
+        close the connections that are still open.
+    '''
+
+    def __init__(self, concurrency=default_concurrency, per_host=default_per_host,
+                 rate=default_rate, timeout=check_research_sw.timeout_sec, freshness=None):
+        self.concurrency = concurrency
+        self.freshness = freshness
+        self.per_host = per_host
+        self.limiter = RateLimiter(rate)
+        self.timeout = timeout
+        self.ssl_context = ssl.create_default_context()
+
+        self.host_slots = {}   # host -> semaphore limiting connections in use
+        self.idle = {}         # host -> connections open but not in use
+
+
+    # -------------------------------------------------
+    async def read_response(self, reader):
+        ''' Read an HTTP response. Returns the status code, headers and body
+            and whether the connection can be used again.
+        '''
+
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError('connection closed by server')
+
+        try:
+            version, status = line.split(None, 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise ProtocolError('bad status line')
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass    # trailers
+                    break
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+
+        elif status in (http.client.NO_CONTENT, http.client.NOT_MODIFIED) or status < 200:
+            body = b''
+
+        else:
+            body = await reader.read()
+            keep_alive = False
+
+        return (status, headers, body, keep_alive)
+
+
+    # -------------------------------------------------
+    async def request(self, url):
+        ''' Issue a single GET request, on a connection from the pool if
+            there is one
+        '''
+
+        parts = urlsplit(url)
+        secure = parts.scheme == 'https'
+        key = (parts.scheme, parts.hostname, parts.port or (443 if secure else 80))
+
+        if key not in self.host_slots:
+            self.host_slots[key] = asyncio.Semaphore(self.per_host)
+            self.idle[key] = []
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        message = ('GET {0} HTTP/1.1\r\nHost: {1}\r\nAccept: application/json\r\n'
+                   'User-Agent: check_research_sw\r\n\r\n').format(path, parts.netloc).encode('latin-1')
+
+        # The timeout starts once a connection slot is free, so time spent
+        # waiting for one of the per_host slots doesn't count against it
+        async with self.host_slots[key]:
+            return await asyncio.wait_for(self.exchange(key, secure, message), self.timeout)
+
+
+    # -------------------------------------------------
+    async def exchange(self, key, secure, message):
+        ''' Send a request on an idle or new connection to 'key' and read the response '''
+
+        while True:
+            reused = bool(self.idle[key])
+            if reused:
+                reader, writer = self.idle[key].pop()
+            else:
+                reader, writer = await asyncio.open_connection(
+                    key[1], key[2], ssl=self.ssl_context if secure else None)
+
+            try:
+                writer.write(message)
+                await writer.drain()
+                status, headers, body, keep_alive = await self.read_response(reader)
+
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue    # the server closed an idle connection; try a new one
+                raise
+
+            except BaseException:
+                writer.close()  # includes being cancelled by a timeout
+                raise
+
+            if keep_alive:
+                self.idle[key].append((reader, writer))
+            else:
+                writer.close()
+
+            return check_research_sw.Response(status, headers, body)
+
+
+    # -------------------------------------------------
+    async def get(self, url):
+        ''' GET a URL, following redirects like requests.get() does '''
+
+        for _ in range(check_research_sw.max_redirects + 1):
+            r = await self.request(url)
+            if not (300 <= r.status_code < 400 and 'location' in r.headers):
+                return r
+            url = urljoin(url, r.headers['location'])
+
+        raise check_research_sw.TooManyRedirects(url)
+
+
+    # -------------------------------------------------
+    async def check(self, resource_id):
+        ''' Check one resource. Returns an (id, exit code, message) tuple. '''
+
+        code = 'CRITICAL'   # assume badness until we learn otherwise
+        msg = 'Research Software resource {0}'.format(resource_id)
+
+        try:
+            await self.limiter.wait()
+            r = await self.get(check_research_sw.resource_url(resource_id))
+            code, msg = check_research_sw.evaluate_response(r, msg, freshness=self.freshness)
+
+        # Report errors the same way check_research_sw.check_resource() does.
+        # A timeout is an OSError in recent versions of Python, so it has to
+        # come first.
+        except ValueError:
+            msg += ' - Invalid response'
+
+        except asyncio.TimeoutError:
+            msg += ' - Timeout'
+
+        except (OSError, asyncio.IncompleteReadError):
+            msg += ' - Connection error'
+
+        except check_research_sw.TooManyRedirects:
+            msg += ' - Too many redirects'
+
+        except ProtocolError:
+            msg += ' - Unknown communications error'
+
+        # Anything else is a bug, but one resource mustn't stop the sweep
+        except Exception:
+            msg += ' - Unknown error'
+
+        return (resource_id, code, msg)
+
+
+    # -------------------------------------------------
+    async def sweep(self, ids):
+        ''' Check every resource in 'ids', yielding (id, exit code, message)
+            tuples as soon as each one is known
+        '''
+
+        ids = iter(ids)
+        results = asyncio.Queue(self.concurrency)
+        done = object()
+
+        async def worker():
+            try:
+                for resource_id in ids:     # shared by all the workers
+                    await results.put(await self.check(resource_id))
+            finally:
+                await results.put(done)     # or sweep() would wait for this worker forever
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.concurrency)]
+        try:
+            running = len(workers)
+            while running:
+                result = await results.get()
+                if result is done:
+                    running -= 1
+                else:
+                    yield result
+
+        finally:
+            for w in workers:
+                w.cancel()
+
+
+    # -------------------------------------------------
+    def close(self):
+        ''' Close the connections that are still open '''
+
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+            del connections[:]
+
+
+
+async def run(ids, checker, out=sys.stdout, stream=False):
+    ''' Check the resources in 'ids' and write a summary line to 'out',
+        followed by each result in the order they arrived. Returns the overall
+        exit code.
+
+        Nagios takes the first line as the status of the check, as in batch
+        mode, so the results are held in a temporary file (in memory until
+        there are a lot of them) until the summary is known. With 'stream',
+        each result is written and flushed as soon as it arrives and the
+        summary is written last.
+    '''
+
+    codes = []
+    with tempfile.SpooledTemporaryFile(spool_size, mode='w+') as lines:
+        try:
+            async for resource_id, code, msg in checker.sweep(ids):
+                codes.append(code)
+                if stream:
+                    out.write(check_research_sw.format_result(code, msg) + '\n')
+                    out.flush()
+                else:
+                    lines.write(check_research_sw.format_result(code, msg) + '\n')
+
+        finally:
+            checker.close()
+
+        code = check_research_sw.worst_code(codes)
+        summary = 'Research Software sweep of {0} resources - {1}'.format(len(codes), check_research_sw.count_codes(codes))
+        out.write(check_research_sw.format_result(code, summary) + '\n')
+
+        lines.seek(0)
+        shutil.copyfileobj(lines, out)
+        out.flush()
+
+    return code
+
+
+
+def main():
+
+    message = 'Research Software'
+
+    try:
+        # Build up command line parser
+        parser = argparse.ArgumentParser()
+        parser.add_argument('id', type=int, nargs='*', help='numeric identifier of the resource(s) of interest')
+        parser.add_argument('-f', '--file', help='read more resource ids from FILE ("-" for stdin)')
+        parser.add_argument('-c', '--concurrency', type=int, default=default_concurrency,
+                            help='number of requests in progress at any one time (default: %(default)s)')
+        parser.add_argument('--per-host', type=int, default=default_per_host,
+                            help='maximum number of connections to any one host (default: %(default)s)')
+        parser.add_argument('--rate', type=float, default=default_rate,
+                            help='maximum number of requests started per second, 0 for no limit (default: %(default)s)')
+        parser.add_argument('--stream', action='store_true',
+                            help='write each result as soon as it completes, with the summary last')
+        parser.add_argument('-u', '--urlbase', metavar='URL',
+                            help='URL of the web service (default: {0})'.format(check_research_sw.urlbase))
+        parser.add_argument('--stale-warning', type=float, metavar='MULTIPLE',
+                            help='WARNING if lastUpdate is older than this many pollingIntervals')
+        parser.add_argument('--stale-critical', type=float, metavar='MULTIPLE',
+                            help='CRITICAL if lastUpdate is older than this many pollingIntervals')
+
+        args = parser.parse_args()
+
+        ids = args.id
+        if args.file:
+            try:
+                ids += check_research_sw.read_ids(args.file)
+            except (IOError, ValueError) as e:
+                parser.error(str(e))
+
+        if not ids:
+            parser.error('at least one resource id is required')
+
+        if args.concurrency < 1 or args.per_host < 1 or args.rate < 0:
+            parser.error('concurrency and connections per host must be at least 1 and the rate can\'t be negative')
+
+    except SystemExit:
+        message += ' - Usage error'      # raised by argparse
+        print(check_research_sw.format_result('WARNING', message))
+        exit(check_research_sw.codelist['WARNING'])
+
+    if args.urlbase:
+        check_research_sw.urlbase = args.urlbase.rstrip('/')
+
+    checker = AsyncChecker(args.concurrency, args.per_host, args.rate,
+                           freshness=(args.stale_warning, args.stale_critical))
+    code = asyncio.run(run(ids, checker, stream=args.stream))
+
+    exit(check_research_sw.codelist[code])
+
+# -----------------------------------------------------------------------------
+if  __name__ =='__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+'''
+Copyright 2016 - CANARIE Inc. All rights reserved
+
+Synopsis: thin client for check_research_sw.py running in daemon mode. Takes
+          the same command line and produces the same output and exit code,
+          but leaves the work to the daemon.
+
+Blob Hash: $Id$
+
+-------------------------------------------------------------------------------
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, 
+   this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, 
+   this list of conditions and the following disclaimer in the documentation 
+   and/or other materials provided with the distribution.
+
+3. The name of the author may not be used to endorse or promote products 
+   derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY CANARIE Inc. "AS IS" AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+
+Theory of Operations:
+
+Most of the time taken by check_research_sw.py goes into starting up: loading
+the 'requests' module, looking up the web service and setting up a TLS
+connection to it. Run with '--daemon', check_research_sw.py does all of that
+once and then answers requests on a Unix domain socket.
+
+This client is what NRPE runs instead. It only loads modules that are part of
+the Python interpreter itself, sends the resource id to the daemon and writes
+the reply to stdout, exiting with the exit code the daemon sent back.
+
+If the daemon isn't running (there is no socket, or nothing listening on it),
+or the command line is anything other than a single numeric id (which includes
+usage errors), the work is handed over to check_research_sw.py itself so that
+Nagios always sees the same result it would have seen without the daemon. A
+daemon that is running but doesn't answer in time, or answers with something
+that doesn't make sense, is reported as CRITICAL instead: checking the resource
+again here would take the check past the time NRPE allows it (10 seconds by
+default), and Nagios would report that rather than our result. How long the
+client waits can be changed through the environment, and must be longer than
+the daemon may take over a check (its '--timeout', retries included).
+
+'''
+
+import errno
+import os
+import socket
+import sys
+
+# Socket the daemon listens on. Must match the '--socket' option given to
+# check_research_sw.py --daemon. Can be overridden by setting the environment
+# variable below.
+default_socket = '/tmp/check_research_sw.sock'
+socket_env = 'CHECK_RESEARCH_SW_SOCKET'
+
+# Number of seconds to wait for the daemon to answer. This is a little longer
+# than the daemon waits for the web service by default so that its own timeout
+# is reported. Can be overridden by setting the environment variable below,
+# which must be done if the daemon is given a longer '--timeout'.
+timeout_sec = 6
+timeout_env = 'CHECK_RESEARCH_SW_TIMEOUT'
+
+# Errors connecting to the daemon that mean it isn't running, so the check is
+# made here instead
+not_running = (errno.ENOENT, errno.ECONNREFUSED)
+
+
+def query(path, resource_id, timeout=timeout_sec):
+    ''' Ask the daemon listening on 'path' to check a resource
+
+        Returns the exit code and the line to write to stdout. Raises
+        socket.error (or IOError/OSError) if the daemon can't be reached and
+        ValueError if the reply doesn't make sense.
+    '''
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall('{0}\n'.format(resource_id).encode('ascii'))
+
+        reply = b''
+        while not reply.endswith(b'\n'):
+            data = s.recv(4096)
+            if not data:
+                break
+            reply += data
+
+    finally:
+        s.close()
+
+    code, line = reply.decode('utf-8').rstrip('\n').split(' ', 1)
+    return (int(code), line)
+
+
+
+def wait_seconds():
+    ''' How long to wait for the daemon: the number of seconds in the
+        environment variable, if it's set to one, or timeout_sec
+    '''
+
+    try:
+        seconds = float(os.environ.get(timeout_env, timeout_sec))
+    except ValueError:
+        return timeout_sec
+
+    return seconds if seconds > 0 else timeout_sec
+
+
+
+def main():
+
+    args = sys.argv[1:]
+
+    if len(args) == 1 and args[0].isdigit():
+        message = 'Research Software resource {0}'.format(int(args[0]))
+        try:
+            code, line = query(os.environ.get(socket_env, default_socket), int(args[0]), wait_seconds())
+            print(line)
+            exit(code)
+
+        except socket.timeout:
+            print('CRITICAL - {0} - Timeout '.format(message))
+            exit(2)
+
+        except (socket.error, IOError, OSError) as e:
+            if e.errno not in not_running:
+                print('CRITICAL - {0} - Unknown communications error '.format(message))
+                exit(2)
+            # no daemon, so do the check ourselves
+
+        except ValueError:
+            print('CRITICAL - {0} - Invalid response '.format(message))
+            exit(2)
+
+    import check_research_sw
+    check_research_sw.main()
+
+# -----------------------------------------------------------------------------
+if  __name__ =='__main__':
+    main()
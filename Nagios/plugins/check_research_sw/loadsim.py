@@ -0,0 +1,564 @@
+#!/usr/bin/python
+
+'''
+Copyright 2016 - CANARIE Inc. All rights reserved
+
+Synopsis: find the load at which check_research_sw.py stops keeping up, by
+          polling a simulated fleet at increasing rates
+
+Blob Hash: $Id$
+
+-------------------------------------------------------------------------------
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, 
+   this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, 
+   this list of conditions and the following disclaimer in the documentation 
+   and/or other materials provided with the distribution.
+
+3. The name of the author may not be used to endorse or promote products 
+   derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY CANARIE Inc. "AS IS" AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+
+Theory of Operations:
+
+A mock web service (see mock_server.py) is started as a separate process for a
+fleet of '--fleet-size' resources. Its latency is drawn from a log-normal
+distribution ('--latency' is the median, '--sigma' the shape), and a share of
+requests can be made to fail, to be slow or to hang, so that the plugin's
+timeouts are exercised the way a struggling web service would exercise them.
+
+Checks are then started open loop at each rate in '--rates' (resources checked
+per second) for '--duration' seconds: rate x duration resources are offered in
+each step, spread evenly over it, and a check is started when it is due
+whether or not earlier ones have finished, as Nagios schedules them. Resource
+ids are taken from the fleet in turn. Each mode in '--modes' is driven
+separately:
+
+a) process: one check_research_sw.py process per check, as NRPE runs it.
+
+b) daemon: one check_research_sw_client.py process per check, answered by a
+   check_research_sw.py --daemon process started for the mode.
+
+c) batch: check_research_sw.py --file processes, as many as it takes for none
+   to check more than '--batch-size' resources, with the resources of the step
+   shared evenly between them and the batches spread evenly over it. At rates
+   where a step offers fewer than '--batch-size' resources, it's a single
+   smaller batch.
+
+For each rate the following are reported: resources checked per second (over
+the step, or until the last check finished if that was later), latency of
+each check (wall time of its process, or of the whole batch) as p50/p99, the
+fraction of resources that timed out (reported ' - Timeout' by the plugin, or
+whose process had to be killed), host CPU use from /proc/stat less that of the
+mock web service, which is reported on its own, CPU seconds used per resource
+by the plugin processes (and the daemon in mode b), the largest resident size
+of a plugin process so far and the least memory available on the host.
+
+The timeout onset of a mode is the lowest rate at which more than
+'--threshold' of resources timed out. Once over half time out, higher rates are
+skipped for that mode. The results are written as JSON to the file given with
+'--output'. CPU and memory figures need Linux and are left out elsewhere.
+
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import benchmark
+import check_research_sw
+import check_research_sw_client
+import mock_server
+
+
+# Scripts run for each check
+plugin = benchmark.plugin
+client = os.path.join(os.path.dirname(plugin), 'check_research_sw_client.py')
+mock_script = os.path.join(os.path.dirname(plugin), 'mock_server.py')
+
+# Modes that can be driven, in the order they are run
+modes = ['process', 'daemon', 'batch']
+
+# How often the memory available on the host is sampled, in seconds
+sample_sec = 0.25
+
+# Fraction of resources timing out past which higher rates aren't tried
+give_up = 0.5
+
+
+
+def host_cpu():
+    ''' Return (busy, total) jiffies of the host from /proc/stat, or None '''
+
+    try:
+        with open('/proc/stat') as f:
+            fields = [int(x) for x in f.readline().split()[1:]]
+    except (IOError, OSError, ValueError):
+        return None
+
+    idle = sum(fields[3:5])     # idle and iowait
+    return (sum(fields) - idle, sum(fields))
+
+
+
+def host_available():
+    ''' Return the memory available on the host in bytes, or None '''
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    return None
+
+
+
+def process_usage(pid):
+    ''' Return (CPU seconds, largest resident size in bytes) of a running process, or None '''
+
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+        with open('/proc/{0}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return (cpu, int(line.split()[1]) * 1024)
+
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+
+
+def cpus():
+    ''' Number of CPUs on the host '''
+
+    try:
+        return os.sysconf('SC_NPROCESSORS_ONLN')
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+
+
+def children_usage():
+    ''' Return (CPU seconds, largest resident size in bytes) of all finished child processes, or None '''
+
+    try:
+        import resource
+    except ImportError:
+        return None     # not Unix
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024)
+
+
+
+class Sampler(threading.Thread):
+    ''' Samples host CPU and memory until stopped '''
+
+
+    def __init__(self):
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.stopping = threading.Event()
+        self.first = host_cpu()
+        self.least = host_available()
+
+
+    def run(self):
+
+        while not self.stopping.wait(sample_sec):
+            available = host_available()
+            if available is not None:
+                self.least = available if self.least is None else min(self.least, available)
+
+
+    def stop(self):
+        ''' Stop sampling and return (host CPU percent, least memory available) '''
+
+        self.stopping.set()
+        self.join()
+
+        last = host_cpu()
+        if self.first is None or last is None or last[1] == self.first[1]:
+            return (None, self.least)
+
+        return (100.0 * (last[0] - self.first[0]) / (last[1] - self.first[1]), self.least)
+
+
+
+class Check(object):
+    ''' One plugin process: its output and wall time '''
+
+
+    def __init__(self, command, deadline, stdin=None):
+
+        self.command = command
+        self.deadline = deadline
+        self.stdin = stdin
+        self.output = ''
+        self.elapsed = None
+        self.killed = False
+
+
+    def run(self):
+        ''' Run the process to completion, killing it if it runs for longer than 'deadline' seconds '''
+
+        start = check_research_sw.clock()
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull)
+            timer = threading.Timer(self.deadline, self.kill, [process])
+            timer.start()
+
+            try:
+                output = process.communicate(self.stdin)[0]
+            finally:
+                timer.cancel()
+
+        self.elapsed = check_research_sw.clock() - start
+        self.output = output.decode('utf-8', 'replace')
+
+
+    def kill(self, process):
+
+        self.killed = True
+        try:
+            process.kill()
+        except OSError:
+            pass    # already finished
+
+
+
+def schedule(rate, duration, batch_size=1):
+    ''' Split the rate x duration resources of a step into checks
+
+        Returns a (first, size) tuple for each check: the position of its first
+        resource in the step and the number of resources it checks. There are
+        as few checks as there can be without any checking more than
+        'batch_size' resources, and their sizes differ by one at most.
+    '''
+
+    total = max(1, int(round(rate * duration)))
+    checks = -(-total // batch_size)
+    sizes = [total // checks + (1 if n < total % checks else 0) for n in range(checks)]
+
+    return [(sum(sizes[:n]), size) for (n, size) in enumerate(sizes)]
+
+
+
+def drive(start, checks, duration):
+    ''' Call start(first, size) for each of 'checks', spread evenly over 'duration' seconds
+
+        Each call is made in a thread of its own so that slow checks don't hold
+        back later ones. Returns the threads, which end when their check has.
+    '''
+
+    threads = []
+    begin = check_research_sw.clock()
+    interval = float(duration) / len(checks)
+
+    for (n, (first, size)) in enumerate(checks):
+        delay = begin + n * interval - check_research_sw.clock()
+        if delay > 0:
+            time.sleep(delay)
+
+        thread = threading.Thread(target=start, args=(first, size))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    return threads
+
+
+
+def run_step(commands, rate, duration, batch_size=1, pid=None, mock=None):
+    ''' Run the checks made by commands(first, size), 'rate' resources a second
+
+        Each command checks 'size' resources, starting with the 'first' of the
+        step, and no more than 'batch_size'. 'pid' is a process outside the
+        checks whose CPU and memory count too (the daemon), and 'mock' that
+        of the mock web service, whose CPU is taken out of the host's.
+    '''
+
+    checks = []
+    lock = threading.Lock()
+
+    def start(first, size):
+        check = commands(first, size)
+        check.size = size
+        with lock:
+            checks.append(check)
+        check.run()
+
+    before = children_usage()
+    extra_before = process_usage(pid) if pid else None
+    mock_before = process_usage(mock) if mock else None
+    sampler = Sampler()
+    sampler.start()
+    began = check_research_sw.clock()
+
+    for thread in drive(start, schedule(rate, duration, batch_size), duration):
+        thread.join()
+
+    wall = check_research_sw.clock() - began
+    host, available = sampler.stop()
+    after = children_usage()
+    extra_after = process_usage(pid) if pid else None
+    mock_after = process_usage(mock) if mock else None
+
+    resources = sum(check.size for check in checks)
+    timeouts = sum(check.size if check.killed else check.output.count(' - Timeout') for check in checks)
+
+    mock_cpu = None
+    if mock_before is not None and mock_after is not None:
+        mock_cpu = 100.0 * (mock_after[0] - mock_before[0]) / (wall * cpus())
+        if host is not None:
+            host = max(0.0, host - mock_cpu)
+
+    cpu = rss = None
+    if before is not None and after is not None:
+        cpu, rss = after[0] - before[0], after[1]
+        if extra_before is not None and extra_after is not None:
+            cpu += extra_after[0] - extra_before[0]
+            rss = max(rss, extra_after[1])
+
+    return {'rate': rate,
+            'achieved': resources / max(wall, duration),
+            'resources': resources,
+            'checks': len(checks),
+            'latency': benchmark.summarise([check.elapsed for check in checks]),
+            'timeouts': float(timeouts) / resources,
+            'killed': sum(1 for check in checks if check.killed),
+            'host_cpu_percent': host,
+            'mock_cpu_percent': mock_cpu,
+            'cpu_per_check': cpu / resources if cpu is not None else None,
+            'max_rss': rss,
+            'least_available': available}
+
+
+
+def start_mock(args):
+    ''' Start mock_server.py as a process of its own, so that its CPU can be told apart
+
+        Returns the process, with the URL to use in its 'urlbase' attribute.
+        Its stderr, where it reports requests whose client gave up on them,
+        is thrown away.
+    '''
+
+    command = [sys.executable, mock_script, '--port', '0', '--shape', args.shape, '--latency', str(args.latency),
+               '--sigma', str(args.sigma), '--error-rate', str(args.error_rate), '--slow-rate', str(args.slow_rate),
+               '--slow-seconds', str(args.slow_seconds), '--hang-rate', str(args.hang_rate),
+               '--hang-seconds', str(args.timeout * 2), '--fleet-size', str(args.fleet_size)]
+
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=devnull)
+
+    line = process.stdout.readline().decode('utf-8')
+    if not line.startswith('Serving on '):
+        process.kill()
+        raise RuntimeError('mock_server.py did not start')
+
+    process.urlbase = line.split(' ', 2)[2].strip()
+    return process
+
+
+
+def wait_for(path, process, seconds=10):
+    ''' Wait for a daemon process to create its socket '''
+
+    until = check_research_sw.clock() + seconds
+    while not os.path.exists(path):
+        if process.poll() is not None or check_research_sw.clock() > until:
+            raise RuntimeError('check_research_sw.py --daemon did not start')
+        time.sleep(0.05)
+
+
+
+def run_mode(mode, args, mock, ids):
+    ''' Run each rate in turn in one mode, stopping early once most checks time out '''
+
+    common = ['--urlbase', mock.urlbase, '--timeout', str(args.timeout), '--transport', args.transport]
+    deadline = args.timeout * 2 + 5    # NRPE would have given up long before
+    directory = tempfile.mkdtemp()
+    daemon = None
+    batch_size = 1
+    step = {'first': 0}     # resources already used, so each step carries on through the fleet
+
+    def resource(n):
+        return str(ids[(step['first'] + n) % len(ids)])
+
+    if mode == 'process':
+        commands = lambda first, size: Check([args.python, plugin] + common + [resource(first)], deadline)
+
+    elif mode == 'daemon':
+        path = os.path.join(directory, 'check.sock')
+        with open(os.devnull, 'w') as devnull:
+            daemon = subprocess.Popen([args.python, plugin, '--daemon', '--socket', path, '--workers', str(args.workers)]
+                                      + common, stdout=devnull, stderr=devnull)
+        wait_for(path, daemon)
+        os.environ[check_research_sw_client.socket_env] = path
+        commands = lambda first, size: Check([args.python, client, resource(first)], deadline)
+
+    else:
+        batch_size = args.batch_size
+        deadline += args.timeout * batch_size / args.workers
+
+        def commands(first, size):
+            batch = '\n'.join(resource(first + i) for i in range(size))
+            return Check([args.python, plugin, '--file', '-', '--workers', str(args.workers)] + common,
+                         deadline, batch.encode('utf-8'))
+
+    steps = []
+    try:
+        for rate in args.rates:
+            result = run_step(commands, rate, args.duration, batch_size, daemon and daemon.pid, mock.pid)
+            step['first'] += result['resources']
+            steps.append(result)
+            print_step(mode, result)
+
+            if result['timeouts'] > give_up:
+                break
+
+    finally:
+        if daemon is not None:
+            daemon.send_signal(signal.SIGTERM)
+            daemon.wait()
+            del os.environ[check_research_sw_client.socket_env]
+        shutil.rmtree(directory)
+
+    return {'steps': steps, 'timeout_onset': onset(steps, args.threshold)}
+
+
+
+def onset(steps, threshold):
+    ''' Return the lowest rate at which more than 'threshold' of resources timed out, or None '''
+
+    for step in sorted(steps, key=lambda step: step['rate']):
+        if step['timeouts'] > threshold:
+            return step['rate']
+
+    return None
+
+
+
+# Columns printed for each step
+columns = '{0:8} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8} {6:>6} {7:>6} {8:>10} {9:>8} {10:>10}'
+
+
+
+def print_step(mode, step):
+
+    def show(value, format, scale=1):
+        return '-' if value is None else format.format(value / scale)
+
+    print(columns.format(mode, show(step['rate'], '{0:g}'), show(step['achieved'], '{0:.1f}'),
+                         show(step['latency'].get('p50'), '{0:.3f}'), show(step['latency'].get('p99'), '{0:.3f}'),
+                         show(step['timeouts'], '{0:.1%}'), show(step['host_cpu_percent'], '{0:.0f}%'),
+                         show(step['mock_cpu_percent'], '{0:.0f}%'), show(step['cpu_per_check'], '{0:.4f}'), show(step['max_rss'], '{0:.1f}M', 1048576.0),
+                         show(step['least_available'], '{0:.0f}M', 1048576.0)))
+    sys.stdout.flush()
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Find the load at which check_research_sw.py stops keeping up')
+    parser.add_argument('-o', '--output', help='write the results to this file as JSON')
+    parser.add_argument('--python', default=sys.executable, help='interpreter used to run the plugin (default: %(default)s)')
+    parser.add_argument('--transport', default=check_research_sw.default_transport, choices=sorted(check_research_sw.transports),
+                        help='transport used by the plugin (default: %(default)s)')
+    parser.add_argument('--modes', type=lambda text: text.split(','), default=modes,
+                        help='comma separated modes to drive, from {0} (default: all)'.format(', '.join(modes)))
+    parser.add_argument('--rates', type=lambda text: [float(rate) for rate in text.split(',')], default=[1, 2, 5, 10, 20, 50],
+                        help='comma separated resources per second to try (default: 1,2,5,10,20,50)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds each rate is run for (default: %(default)s)')
+    parser.add_argument('-t', '--timeout', type=float, default=10, help='timeout given to the plugin (default: %(default)s)')
+    parser.add_argument('--threshold', type=float, default=0.01,
+                        help='fraction of resources timing out that marks the timeout onset (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=check_research_sw.default_workers,
+                        help='concurrency of daemon and batch modes (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=50, help='resources checked by each batch process (default: %(default)s)')
+    parser.add_argument('--fleet-size', type=int, default=1000, help='number of resources in the fleet (default: %(default)s)')
+    parser.add_argument('--shape', default='mixed', choices=['mixed'] + mock_server.mixed_shapes,
+                        help='payload returned by the mock web service (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.1, help='median mock web service latency in seconds (default: %(default)s)')
+    parser.add_argument('--sigma', type=float, default=0.5, help='shape of the log-normal latency (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='fraction of requests answered with HTTP 500 (default: %(default)s)')
+    parser.add_argument('--slow-rate', type=float, default=0.01, help='fraction of requests that are slow (default: %(default)s)')
+    parser.add_argument('--slow-seconds', type=float, default=2.0, help='extra time taken by slow requests (default: %(default)s)')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='fraction of requests that never finish (default: %(default)s)')
+    args = parser.parse_args()
+
+    unknown = [mode for mode in args.modes if mode not in modes]
+    if unknown:
+        parser.error('unknown mode: {0}'.format(', '.join(unknown)))
+    if min(args.rates) <= 0:
+        parser.error('--rates must be positive')
+    if args.workers < 1 or args.batch_size < 1 or args.fleet_size < 1:
+        parser.error('--workers, --batch-size and --fleet-size must be at least 1')
+    args.rates.sort()
+
+    mock = start_mock(args)
+    ids = list(range(1, args.fleet_size + 1))
+
+    print(columns.format('mode', 'rate', 'achieved', 'p50', 'p99', 'timeouts', 'cpu', 'mock', 'cpu/check', 'rss',
+                         'available'))
+
+    results = {}
+    try:
+        for mode in modes:
+            if mode in args.modes:
+                results[mode] = run_mode(mode, args, mock, ids)
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    for mode in modes:
+        if mode in results:
+            rate = results[mode]['timeout_onset']
+            print('{0}: {1}'.format(mode, 'no timeouts at the rates tried' if rate is None
+                                          else 'timeouts begin at {0:g} resources/s'.format(rate)))
+
+    if args.output:
+        report = {'settings': vars(args),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                  'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+# -----------------------------------------------------------------------------
+if  __name__ =='__main__':
+    main()
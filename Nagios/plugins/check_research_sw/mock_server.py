@@ -0,0 +1,371 @@
+#!/usr/bin/python
+
+'''
+Copyright 2016 - CANARIE Inc. All rights reserved
+
+Synopsis: local stand-in for the science.canarie.ca research software status
+          web service, used to test and benchmark check_research_sw.py without
+          touching production
+
+Blob Hash: $Id$
+
+-------------------------------------------------------------------------------
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, 
+   this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, 
+   this list of conditions and the following disclaimer in the documentation 
+   and/or other materials provided with the distribution.
+
+3. The name of the author may not be used to endorse or promote products 
+   derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY CANARIE Inc. "AS IS" AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+
+Theory of Operations:
+
+The server answers GET requests for any path ending in /resource/{id}/status,
+so check_research_sw.py can be pointed at it with
+'--urlbase http://127.0.0.1:{port}/researchsoftware/rs'. Connections are kept
+open between requests like the real web service does.
+
+How it behaves is controlled by a MockConfig:
+
+a) 'shape' picks which of the payloads in 'shapes' below is returned. These
+   are the cases from TestJSONErrors.json_response_data in test.py. With
+   'mixed', each resource id gets one of them in turn, so a fleet of ids
+   covers every case.
+
+b) 'latency' seconds, plus or minus up to 'jitter' seconds, pass before each
+   request is answered. With 'sigma', the latency is instead drawn from a
+   log-normal distribution with 'latency' as its median and 'sigma' as its
+   shape, which gives the long tail real web services have (a sigma of 0.5
+   makes 1 request in 100 take over 3 times the median).
+
+c) A fraction 'error_rate' of requests get an HTTP 500 response and a fraction
+   'not_json_rate' get a 200 response that isn't JSON.
+
+d) A fraction 'slow_rate' of requests take an extra 'slow_seconds' to answer
+   and a fraction 'hang_rate' don't get an answer for 'hang_seconds', which is
+   long enough for any client to time out.
+
+e) The bulk endpoint, .../resources/status?ids=1,2,3, returns an object
+   keyed by id holding the same payloads as the individual requests. It only
+   knows about resources 1 to 'fleet_size', so that ids beyond that have to
+   be fetched one at a time. Without 'ids' it returns the whole fleet.
+
+Each resource is polled once every polling_seconds, at a time of its own, so
+lastUpdate is always recent and only changes when the resource is polled
+again. Responses carry ETag and Last-Modified headers; a request with a
+matching If-None-Match or If-Modified-Since header gets "304 Not Modified"
+instead. The server counts the requests it has answered in 'requests' and the
+304 responses among them in 'not_modified'.
+
+It can be run from the command line or started from another script (see
+start() and stop()), which is what benchmark.py and the unit tests do.
+
+'''
+
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+    from email.utils import formatdate, mktime_tz, parsedate_tz
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer     # Python 3
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+    from email.utils import formatdate, mktime_tz, parsedate_tz
+
+# Path prefix of the real web service, so that URLs look the same
+urlpath = '/researchsoftware/rs'
+
+# Interval at which the mock resources claim to be polled
+polling_interval = 'Every 15 minutes'
+polling_seconds = 900
+
+# The payloads the server can return. Each is a function of the time of the
+# last update so that lastUpdate can be filled in when the request is made.
+shapes = {
+    'ok':                  lambda t: {'status': 'OK', 'lastUpdate': t, 'meta': {'pollingInterval': polling_interval}},
+    'not_ok':              lambda t: {'status': 'NOTOK', 'lastUpdate': t, 'meta': {'pollingInterval': polling_interval}},
+    'no_status':           lambda t: {'lastUpdate': t, 'meta': {'pollingInterval': polling_interval}},
+    'unknown':             lambda t: {'status': 'UNKNOWN', 'lastUpdate': t, 'meta': {'pollingInterval': polling_interval}},
+    'error':               lambda t: {'status': 'ERROR', 'lastUpdate': t, 'meta': {'pollingInterval': polling_interval}},
+    'error_no_update':     lambda t: {'status': 'ERROR', 'meta': {'pollingInterval': polling_interval}},
+    'error_no_interval':   lambda t: {'status': 'ERROR', 'lastUpdate': t, 'meta': {}},
+    'no_update':           lambda t: {'status': 'OK', 'meta': {'pollingInterval': polling_interval}},
+    'no_update_interval':  lambda t: {'status': 'OK'},
+    'no_interval':         lambda t: {'status': 'OK', 'lastUpdate': t, 'meta': {}},
+    'no_meta':             lambda t: {'status': 'OK', 'lastUpdate': t},
+    'interval_not_in_meta': lambda t: {'status': 'OK', 'lastUpdate': t, 'pollingInterval': polling_interval},
+    'not_polled':          lambda t: {'status': 'UNKNOWN', 'message': 'There are no polls for this service'},
+}
+
+# Order in which 'mixed' hands out the shapes above
+mixed_shapes = sorted(shapes)
+
+# Matches the path of a status request and picks out the resource id
+status_regex = re.compile(r'/resource/(\d+)/status$')
+
+# Matches the path of a bulk status request
+bulk_regex = re.compile(r'/resources/status$')
+
+
+class MockConfig(object):
+    ''' How the mock web service behaves. See the Theory of Operations above. '''
+
+    def __init__(self, shape='ok', latency=0.0, jitter=0.0, error_rate=0.0, not_json_rate=0.0,
+                 slow_rate=0.0, slow_seconds=1.0, hang_rate=0.0, hang_seconds=60.0, fleet_size=1000, sigma=0.0):
+        if shape != 'mixed' and shape not in shapes:
+            raise ValueError('unknown payload shape: {0}'.format(shape))
+
+        self.shape = shape
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.not_json_rate = not_json_rate
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.fleet_size = fleet_size
+        self.sigma = sigma
+
+
+    def last_update(self, resource_id, now):
+        ''' When a resource was last polled, at some point in the last interval '''
+
+        offset = (resource_id * 37) % polling_seconds
+        return int(now) - (int(now) - offset) % polling_seconds
+
+
+    def payload(self, resource_id, now):
+        ''' The JSON payload returned for a resource '''
+
+        shape = self.shape
+        if shape == 'mixed':
+            shape = mixed_shapes[resource_id % len(mixed_shapes)]
+
+        last_update = self.last_update(resource_id, now)
+        return shapes[shape](time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(last_update)))
+
+
+    def delay(self):
+        ''' Number of seconds to wait before answering a request '''
+
+        latency = self.latency * random.lognormvariate(0, self.sigma) if self.sigma else self.latency
+        delay = max(0.0, latency + random.uniform(-self.jitter, self.jitter))
+
+        chance = random.random()
+        if chance < self.hang_rate:
+            delay += self.hang_seconds
+        elif chance < self.hang_rate + self.slow_rate:
+            delay += self.slow_seconds
+
+        return delay
+
+
+    def bulk_payload(self, ids, now):
+        ''' The JSON payload returned by the bulk endpoint for 'ids', or the whole fleet if None '''
+
+        if ids is None:
+            ids = range(1, self.fleet_size + 1)
+
+        return dict((str(i), self.payload(i, now)) for i in ids if 1 <= i <= self.fleet_size)
+
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    ''' Answer requests as described by the server's MockConfig '''
+
+    protocol_version = 'HTTP/1.1'   # keep connections open
+    disable_nagle_algorithm = True  # don't hold back small responses
+
+    def log_message(self, *args):
+        pass
+
+
+    def send(self, status, body, content_type='application/json', headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def not_modified(self, etag, last_modified):
+        ''' Whether the client's copy, described by its validators, is still current '''
+
+        if self.headers.get('If-None-Match') is not None:
+            return etag in [tag.strip() for tag in self.headers.get('If-None-Match').split(',')]
+
+        since = parsedate_tz(self.headers.get('If-Modified-Since') or '')
+        return since is not None and last_modified <= mktime_tz(since)
+
+
+    def send_status(self, resource_id, now):
+        ''' Answer a request for the status of one resource, or say it hasn't changed '''
+
+        config = self.server.config
+        body = json.dumps(config.payload(resource_id, now), sort_keys=True).encode('utf-8')
+        last_modified = config.last_update(resource_id, now)
+
+        etag = '"{0}"'.format(hashlib.md5(body).hexdigest())
+        headers = [('ETag', etag), ('Last-Modified', formatdate(last_modified, usegmt=True))]
+
+        if self.not_modified(etag, last_modified):
+            self.server.count('not_modified')
+            self.send_response(304)
+            for (name, value) in headers:
+                self.send_header(name, value)
+            self.end_headers()
+        else:
+            self.send(200, body, headers=headers)
+
+
+    def do_GET(self):
+        config = self.server.config
+        self.server.count()
+
+        time.sleep(config.delay())
+
+        path, _, query = self.path.partition('?')
+        match = status_regex.search(path)
+        bulk = bulk_regex.search(path)
+        if match is None and bulk is None:
+            self.send(404, b'{"error": "not found"}')
+            return
+
+        chance = random.random()
+        if chance < config.error_rate:
+            self.send(500, b'{"error": "internal server error"}')
+        elif chance < config.error_rate + config.not_json_rate:
+            self.send(200, b'<html><body>Service temporarily unavailable</body></html>', 'text/html')
+        elif bulk is not None:
+            ids = parse_qs(query).get('ids')
+            try:
+                ids = [int(i) for i in ','.join(ids).split(',') if i] if ids else None
+            except ValueError:
+                self.send(400, b'{"error": "bad ids"}')
+                return
+
+            self.send(200, json.dumps(config.bulk_payload(ids, time.time())).encode('utf-8'))
+        else:
+            self.send_status(int(match.group(1)), time.time())
+
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    ''' The mock web service. 'urlbase' is what check_research_sw.py should use. '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128    # the default of 5 drops connections from busy clients
+
+    def __init__(self, address, config):
+        HTTPServer.__init__(self, address, MockHandler)
+        self.config = config
+        self.requests = 0
+        self.not_modified = 0
+        self.lock = threading.Lock()
+        self.urlbase = 'http://{0}:{1}{2}'.format(self.server_address[0], self.server_address[1], urlpath)
+
+    def count(self, counter='requests'):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+
+def start(config=None, host='127.0.0.1', port=0):
+    ''' Start a mock web service in a background thread and return it
+
+        Port 0 picks a free port; the URL to use is in the returned server's
+        'urlbase' attribute.
+    '''
+
+    server = MockServer((host, port), config or MockConfig())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.thread = thread
+
+    return server
+
+
+
+def stop(server):
+    ''' Stop a server started with start() '''
+
+    server.shutdown()
+    server.server_close()
+    server.thread.join()
+
+
+
+def main():
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local stand-in for the research software status web service')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on, 0 for any (default: %(default)s)')
+    parser.add_argument('--shape', default='ok', choices=['mixed'] + mixed_shapes,
+                        help='payload returned, or "mixed" to cycle through them by id (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each answer (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random variation in latency, in seconds')
+    parser.add_argument('--sigma', type=float, default=0.0,
+                        help='draw the latency from a log-normal distribution with this shape, and the latency as '
+                             'its median')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with HTTP 500')
+    parser.add_argument('--not-json-rate', type=float, default=0.0, help='fraction of requests answered with HTML')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='fraction of requests that are slow')
+    parser.add_argument('--slow-seconds', type=float, default=1.0, help='extra delay of a slow request (default: %(default)s)')
+    parser.add_argument('--hang-rate', type=float, default=0.0, help='fraction of requests that hang')
+    parser.add_argument('--hang-seconds', type=float, default=60.0, help='how long a request hangs (default: %(default)s)')
+    parser.add_argument('--fleet-size', type=int, default=1000,
+                        help='resources known to the bulk endpoint (default: %(default)s)')
+    args = parser.parse_args()
+
+    config = MockConfig(args.shape, args.latency, args.jitter, args.error_rate, args.not_json_rate,
+                        args.slow_rate, args.slow_seconds, args.hang_rate, args.hang_seconds, args.fleet_size,
+                        args.sigma)
+
+    server = MockServer((args.host, args.port), config)
+    print('Serving on {0}'.format(server.urlbase))
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# -----------------------------------------------------------------------------
+if  __name__ =='__main__':
+    main()
@@ -33,12 +33,28 @@ POSSIBILITY OF SUCH DAMAGE.
 
 '''
 import check_research_sw
+import check_research_sw_client
+import loadsim
+import mock_server
 import unittest
 import argparse
 from StringIO import StringIO
 import sys
 import requests
 import httplib
+import BaseHTTPServer
+import SocketServer
+import heapq
+import json
+import os
+import re
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
 
 # ------------------------------------------------------------------------------
 class TestCommandLineArguments(unittest.TestCase):
@@ -142,6 +158,18 @@ class TestHTTPErrors(unittest.TestCase):
         	            requests.exceptions.HTTPError,
         		        requests.exceptions.RequestException ]
 
+
+    # ---------------------------------------
+    def setUp(self):
+        ''' These tests replace functions in the "requests" module, so make
+            sure check_research_sw uses it
+        '''
+        self.saved_transport = check_research_sw.default_transport
+        check_research_sw.default_transport = 'requests'
+
+    def tearDown(self):
+        check_research_sw.default_transport = self.saved_transport
+
 	
     # -------------------------------------------------
     def simulate_http_failure(self, url, timeout): 
@@ -287,6 +315,18 @@ class TestJSONErrors(unittest.TestCase):
         ]
 		   		   
     json_response_index = 0
+
+    # ---------------------------------------
+    def setUp(self):
+        ''' These tests replace functions in the "requests" module, so make
+            sure check_research_sw uses it
+        '''
+        self.saved_transport = check_research_sw.default_transport
+        check_research_sw.default_transport = 'requests'
+
+    def tearDown(self):
+        check_research_sw.default_transport = self.saved_transport
+
     
     # ---------------------------------------
     class TestJSONResponse ():
@@ -373,6 +413,2033 @@ class TestJSONErrors(unittest.TestCase):
             sys.stdout = saved_stdout
 	    
 	    
+# ------------------------------------------------------------------------------
+class TestBatchMode(unittest.TestCase):
+    ''' Test checking several resources in a single run '''
+
+    # JSON returned for each of the resources we check in these tests
+    json_by_id = { 49: TestJSONErrors.json_response_data[0]['json_response'],    # OK
+                   50: TestJSONErrors.json_response_data[3]['json_response'],    # WARNING
+                   51: TestJSONErrors.json_response_data[1]['json_response'],    # CRITICAL
+                   52: None,                                                     # not an object
+                   53: [1, 2],
+                   54: { u'status': u'OK', u'lastUpdate': u'2014-01-13T21:26:04Z', u'meta': None },
+                   55: { u'status': u'OK', u'lastUpdate': u'2014-01-13T21:26:04Z', u'meta': [u'pollingInterval'] } }
+
+    # -------------------------------------------------
+    @staticmethod
+    def simulate_session_get(session, url, timeout):
+        ''' Replacement for requests.Session.get() that returns the JSON for
+            the resource id found in the URL
+        '''
+        resource_id = int(url.split('/')[-2])
+        return TestJSONErrors.TestJSONResponse(TestBatchMode.json_by_id[resource_id])
+
+    # -------------------------------------------------
+    def run_main(self, argv):
+        ''' Run check_research_sw with the given command line and return its
+            exit code and the lines it wrote to stdout
+        '''
+        saved_stdout = sys.stdout
+        saved_get = requests.Session.get
+        out = StringIO()
+        sys.stdout = out
+
+        try:
+            requests.Session.get = TestBatchMode.simulate_session_get
+            sys.argv = argv + ['--transport', 'requests']
+
+            with self.assertRaises(SystemExit) as cm:
+                check_research_sw.main()
+
+        finally:
+            sys.stdout = saved_stdout
+            requests.Session.get = saved_get
+
+        return cm.exception.code, out.getvalue().strip().split('\n')
+
+    # -------------------------------------------------------------------------
+    def test_batch_command_line(self):
+        ''' Ids given on the command line produce a summary line and one line per resource '''
+
+        code, lines = self.run_main(['check_research_sw', '49', '50', '51', '49'])
+
+        # The worst result wins
+        self.assertEqual(code, check_research_sw.codelist['CRITICAL'])
+        self.assertEqual(len(lines), 4)  # summary, then the three distinct ids
+        assert lines[0].startswith('CRITICAL - Research Software batch of 3 resources')
+        assert '1 OK' in lines[0] and '1 WARNING' in lines[0] and '1 CRITICAL' in lines[0]
+
+        # Results are reported in the order the ids were given
+        assert lines[1].startswith('OK - Research Software resource 49 ')
+        assert lines[2].startswith('WARNING - Research Software resource 50 ')
+        assert lines[3].startswith('CRITICAL - Research Software resource 51 ')
+
+    # -------------------------------------------------------------------------
+    def test_batch_not_object(self):
+        ''' A resource whose JSON isn't an object is CRITICAL without spoiling the rest of the batch '''
+
+        code, lines = self.run_main(['check_research_sw', '49', '52', '53'])
+
+        self.assertEqual(code, check_research_sw.codelist['CRITICAL'])
+        self.assertEqual(len(lines), 4)
+        assert lines[1].startswith('OK - Research Software resource 49 ')
+        self.assertEqual(lines[2].strip(), 'CRITICAL - Research Software resource 52 - Invalid response')
+        self.assertEqual(lines[3].strip(), 'CRITICAL - Research Software resource 53 - Invalid response')
+
+    # -------------------------------------------------------------------------
+    def test_batch_meta_not_object(self):
+        ''' A meta field that isn't an object is treated as missing '''
+
+        code, lines = self.run_main(['check_research_sw', '49', '54', '55'])
+
+        self.assertEqual(code, check_research_sw.codelist['WARNING'])
+        self.assertEqual(len(lines), 4)
+        assert lines[1].startswith('OK - Research Software resource 49 ')
+        for line in lines[2:]:
+            assert line.startswith('WARNING - Research Software resource 5'), line
+            assert 'Last update: 2014-01-13T21:26:04Z' in line and 'Polling' not in line, line
+
+    # -------------------------------------------------------------------------
+    def test_batch_file(self):
+        ''' Ids can be read from a file '''
+
+        handle, filename = tempfile.mkstemp()
+        os.write(handle, b'# resources to check\n49, 50 # two of them\n\n')
+        os.close(handle)
+
+        try:
+            code, lines = self.run_main(['check_research_sw', '--file', filename])
+            self.assertEqual(code, check_research_sw.codelist['WARNING'])
+            self.assertEqual(len(lines), 3)
+
+            # A file with something other than ids in it is a usage error
+            with open(filename, 'w') as f:
+                f.write('49 fifty\n')
+
+            code, lines = self.run_main(['check_research_sw', '--file', filename])
+            self.assertEqual(code, check_research_sw.codelist['WARNING'])
+            assert 'Usage error' in lines[0]
+
+        finally:
+            os.remove(filename)
+
+
+# ------------------------------------------------------------------------------
+class TestDaemon(unittest.TestCase):
+    ''' Test daemon mode and the client that talks to it '''
+
+    def setUp(self):
+        ''' Start a daemon on a temporary socket, using the simulated
+            session from TestBatchMode in place of the web service
+        '''
+        self.saved_get = requests.Session.get
+        requests.Session.get = TestBatchMode.simulate_session_get
+
+        self.path = os.path.join(tempfile.mkdtemp(), 'check.sock')
+        self.server = check_research_sw.make_daemon(self.path, transport='requests')
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        requests.Session.get = self.saved_get
+        os.remove(self.path)
+        os.rmdir(os.path.dirname(self.path))
+
+    # -------------------------------------------------------------------------
+    def test_query(self):
+        ''' The daemon returns the same exit code and output as a single check '''
+
+        for resource_id, expected in [(49, 'OK'), (50, 'WARNING'), (51, 'CRITICAL')]:
+            code, line = check_research_sw_client.query(self.path, resource_id)
+            self.assertEqual(code, check_research_sw.codelist[expected])
+            # The daemon adds performance data after the message
+            self.assertEqual(line.split(' | ')[0] + ' ', check_research_sw.format_result(
+                *check_research_sw.check_resource(resource_id, requests.Session().get)))
+            assert ' | time=' in line
+
+    # -------------------------------------------------------------------------
+    def test_client_falls_back(self):
+        ''' Without a daemon, the client does the check itself '''
+
+        saved_stdout = sys.stdout
+        saved_environ = dict(os.environ)
+        out = StringIO()
+        sys.stdout = out
+
+        try:
+            os.environ[check_research_sw_client.socket_env] = self.path + '.missing'
+            sys.argv = ['check_research_sw_client', '3a']
+
+            with self.assertRaises(SystemExit) as cm:
+                check_research_sw_client.main()
+
+            self.assertEqual(cm.exception.code, check_research_sw.codelist['WARNING'])
+            assert 'Usage error' in out.getvalue()
+
+        finally:
+            sys.stdout = saved_stdout
+            os.environ.clear()
+            os.environ.update(saved_environ)
+
+    # -------------------------------------------------------------------------
+    def test_client_slow_daemon(self):
+        ''' A daemon that's running but doesn't answer is a timeout, not a reason to check again '''
+
+        saved = (sys.stdout, sys.argv, dict(os.environ), check_research_sw_client.timeout_sec, check_research_sw.main)
+        checked = []
+        check_research_sw.main = lambda: checked.append(True)
+        check_research_sw_client.timeout_sec = 0.2
+
+        # Connecting works, as the connection waits to be accepted, but nothing answers
+        path = self.path + '.slow'
+        slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        slow.bind(path)
+        slow.listen(1)
+
+        def run(socket_path):
+            os.environ[check_research_sw_client.socket_env] = socket_path
+            sys.argv = ['check_research_sw_client', '49']
+            sys.stdout = StringIO()
+            try:
+                check_research_sw_client.main()
+                code = None
+            except SystemExit as e:
+                code = e.code
+            output = sys.stdout.getvalue()
+            sys.stdout = saved[0]
+            return (code, output)
+
+        try:
+            self.assertEqual(run(path), (check_research_sw.codelist['CRITICAL'],
+                                         check_research_sw.format_result('CRITICAL', 'Research Software resource 49 - Timeout')
+                                         + '\n'))
+            self.assertEqual(checked, [])
+
+            # How long to wait can be set through the environment
+            os.environ[check_research_sw_client.timeout_env] = '0.5'
+            started = time.time()
+            self.assertEqual(run(path)[0], check_research_sw.codelist['CRITICAL'])
+            assert 0.45 < time.time() - started < 2
+            for value in ('soon', '0', '-1'):
+                os.environ[check_research_sw_client.timeout_env] = value
+                self.assertEqual(check_research_sw_client.wait_seconds(), 0.2)
+            del os.environ[check_research_sw_client.timeout_env]
+
+            # Without a daemon, the check is made by check_research_sw.main()
+            self.assertEqual(run(self.path + '.missing'), (None, ''))
+            self.assertEqual(checked, [True])
+
+        finally:
+            slow.close()
+            os.remove(path)
+            sys.stdout, sys.argv = saved[:2]
+            os.environ.clear()
+            os.environ.update(saved[2])
+            check_research_sw_client.timeout_sec, check_research_sw.main = saved[3:]
+
+
+# ------------------------------------------------------------------------------
+class TestStatusCache(unittest.TestCase):
+    ''' Test the on-disk cache of responses from the web service '''
+
+    class TestCachedResponse ():
+        ''' Simulate the "response" class, with the body available as text '''
+        def __init__(self, status, the_json, headers=None):
+            self.status_code = status
+            self.text = json.dumps(the_json)
+            self.headers = headers or {}
+
+        def json(self):
+            return json.loads(self.text)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = check_research_sw.StatusCache(self.directory)
+        self.fetches = 0
+
+        # A resource that was polled a minute ago and is polled every 15 minutes
+        self.the_json = { u'status': u'OK',
+                          u'lastUpdate': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - 60)),
+                          u'meta': {u'pollingInterval': u'Every 15 minutes'} }
+        self.status = httplib.OK
+        self.etag = None
+        self.sent_headers = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def simulate_get(self, url, timeout, headers=None):
+        ''' Replacement for requests.get() that counts how often it is called '''
+        self.fetches += 1
+        self.sent_headers.append(headers or {})
+
+        if self.etag is None:
+            return TestStatusCache.TestCachedResponse(self.status, self.the_json)
+        if (headers or {}).get('If-None-Match') == self.etag:
+            return TestStatusCache.TestCachedResponse(httplib.NOT_MODIFIED, None, {'etag': self.etag})
+        return TestStatusCache.TestCachedResponse(self.status, self.the_json, {'etag': self.etag})
+
+    def expire(self, seconds_ago):
+        ''' Make the cached response for resource 49 expire some time ago '''
+        entry = self.cache.read(49)
+        entry['expires'] = time.time() - seconds_ago
+        with open(self.cache.filename(49), 'w') as f:
+            json.dump(entry, f)
+
+    def check(self):
+        return check_research_sw.check_resource(49, self.simulate_get, cache=self.cache)
+
+    # -------------------------------------------------------------------------
+    def test_parse_polling_interval(self):
+        ''' Polling intervals are converted to seconds '''
+
+        self.assertEqual(check_research_sw.parse_polling_interval('Every 15 minutes'), 900)
+        self.assertEqual(check_research_sw.parse_polling_interval('every hour'), 3600)
+        self.assertEqual(check_research_sw.parse_polling_interval('Every 2 days'), 172800)
+        self.assertEqual(check_research_sw.parse_polling_interval('whenever'), None)
+        self.assertEqual(check_research_sw.parse_timestamp('2014-01-13T21:26:04Z'), 1389648364)
+
+    # -------------------------------------------------------------------------
+    def test_fresh_response_is_reused(self):
+        ''' A response is re-used until the next poll is due '''
+
+        first = self.check()
+        self.assertEqual(self.check(), first)
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(first[0], 'OK')
+
+        # About 14 minutes to go before the web service polls again
+        expires = self.cache.read(49)['expires'] - time.time()
+        assert 800 < expires < 900
+
+    # -------------------------------------------------------------------------
+    def test_stale_response(self):
+        ''' A stale response is used while it's refreshed, an older one is not '''
+
+        self.check()
+
+        entry = self.cache.read(49)
+        entry['expires'] = time.time() - 10
+        with open(self.cache.filename(49), 'w') as f:
+            json.dump(entry, f)
+
+        self.check()
+        self.assertEqual(self.fetches, 1)
+        self.assertEqual(self.cache.stale, set([49]))
+
+        self.cache.revalidate(self.simulate_get)
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(self.cache.stale, set())
+        assert self.cache.read(49)['expires'] > time.time()
+
+        # Beyond the stale window the response is fetched again
+        entry['expires'] = time.time() - self.cache.stale_sec - 10
+        with open(self.cache.filename(49), 'w') as f:
+            json.dump(entry, f)
+
+        self.check()
+        self.assertEqual(self.fetches, 3)
+
+    # -------------------------------------------------------------------------
+    def test_revalidate_in_thread(self):
+        ''' Only one thread at a time refreshes the stale responses '''
+
+        release = threading.Event()
+        def slow_get(url, timeout, headers=None):
+            release.wait(5)
+            return self.simulate_get(url, timeout, headers)
+
+        self.cache.stale.update([49, 50])
+        thread = self.cache.revalidate_in_thread(slow_get)
+        self.assertEqual(self.cache.revalidate_in_thread(slow_get), None)
+
+        release.set()
+        thread.join(5)
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(self.cache.stale, set())
+
+        # Once it has finished, another can start
+        self.cache.stale.add(49)
+        self.cache.revalidate_in_thread(slow_get).join(5)
+        self.assertEqual(self.fetches, 3)
+
+    # -------------------------------------------------------------------------
+    def test_errors_not_cached(self):
+        ''' Unsuccessful responses are always fetched again '''
+
+        self.status = httplib.INTERNAL_SERVER_ERROR
+        self.assertEqual(self.check()[0], 'CRITICAL')
+        self.assertEqual(self.check()[0], 'CRITICAL')
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(self.cache.read(49), None)
+
+    # -------------------------------------------------------------------------
+    def test_conditional_get(self):
+        ''' An expired response is only downloaded again if it has changed '''
+
+        self.etag = '"v1"'
+        first = self.check()
+        self.assertEqual(self.sent_headers, [{}])
+
+        # Not modified: answered from the cache, which is good for another while
+        self.expire(self.cache.stale_sec + 10)
+        self.the_json = None    # would be CRITICAL if it were used
+        self.assertEqual(self.check(), first)
+        self.assertEqual(self.sent_headers[-1], {'If-None-Match': '"v1"'})
+        assert self.cache.read(49)['expires'] > time.time()
+
+        # The same goes for a refresh in the background
+        self.expire(10)
+        self.check()
+        self.cache.revalidate(self.simulate_get)
+        self.assertEqual(self.sent_headers[-1], {'If-None-Match': '"v1"'})
+        self.assertEqual(self.check(), first)
+
+        # Modified: the new response is used
+        self.etag = '"v2"'
+        self.the_json = {u'status': u'ERROR'}
+        self.expire(self.cache.stale_sec + 10)
+        self.assertEqual(self.check()[0], 'CRITICAL')
+        self.assertEqual(self.cache.read(49)['etag'], '"v2"')
+        self.assertEqual(self.fetches, 4)
+
+
+# ------------------------------------------------------------------------------
+class TestStatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Stand-in for the web service
+
+        Resource 404 doesn't exist, 998 is too slow to answer, 999 returns
+        something that isn't JSON and 301 is redirected to itself. Any other
+        resource is OK. The client port of each request is recorded so that
+        tests can tell how many connections were used.
+    '''
+
+    protocol_version = 'HTTP/1.1'  # keep connections open
+    client_ports = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        TestStatusHandler.client_ports.add(self.client_address[1])
+        resource_id = int(self.path.split('/')[-2])
+
+        if resource_id == 998:
+            time.sleep(1)
+
+        if resource_id == 301:
+            self.send_response(301)
+            self.send_header('Location', self.path)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if resource_id == 404:
+            body, status = b'Not found', 404
+        elif resource_id == 999:
+            body, status = b'<html>Not JSON</html>', 200
+        else:
+            body, status = json.dumps(TestJSONErrors.json_response_data[0]['json_response']).encode(), 200
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestStatusServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+# ------------------------------------------------------------------------------
+class TestHTTPTransport(unittest.TestCase):
+    ''' Test the http.client transport against a local stand-in for the web service '''
+
+    def setUp(self):
+        self.server = TestStatusServer(('127.0.0.1', 0), TestStatusHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.saved_urlbase = check_research_sw.urlbase
+        check_research_sw.urlbase = 'http://127.0.0.1:{0}/rs'.format(self.server.server_address[1])
+        TestStatusHandler.client_ports.clear()
+
+    def tearDown(self):
+        check_research_sw.urlbase = self.saved_urlbase
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    # -------------------------------------------------------------------------
+    def test_responses(self):
+        ''' Responses and errors are reported as with the "requests" transport '''
+
+        transport = check_research_sw.make_transport('http')
+        check = lambda resource_id, timeout=5: check_research_sw.check_resource(resource_id, transport.get, timeout)
+
+        self.assertEqual(check(49), ('OK', 'Research Software resource 49 - Last update: 2014-01-13T21:26:04Z'
+                                           ' - Polling: Every 15 minutes'))
+        self.assertEqual(check(404), ('CRITICAL', 'Research Software resource 404 - HTTP response status code 404'))
+        self.assertEqual(check(999), ('CRITICAL', 'Research Software resource 999 - Invalid response'))
+        self.assertEqual(check(301), ('CRITICAL', 'Research Software resource 301 - Too many redirects'))
+        self.assertEqual(check(998, 0.3), ('CRITICAL', 'Research Software resource 998 - Timeout'))
+
+        # Nothing listens on the port of a server that has been closed
+        closed = TestStatusServer(('127.0.0.1', 0), TestStatusHandler)
+        closed.server_close()
+        check_research_sw.urlbase = 'http://127.0.0.1:{0}/rs'.format(closed.server_address[1])
+        self.assertEqual(check(49), ('CRITICAL', 'Research Software resource 49 - Connection error'))
+
+    # -------------------------------------------------------------------------
+    def test_tls_errors(self):
+        ''' Certificate and other TLS errors are connection errors, not invalid responses '''
+
+        import ssl
+
+        for error in (ssl.CertificateError("hostname '127.0.0.1' doesn't match 'example.org'"),
+                      ssl.SSLError('certificate verify failed')):
+            def fail(key, conn):
+                raise error
+
+            transport = check_research_sw.HTTPTransport()
+            transport.open = fail
+            self.assertEqual(check_research_sw.check_resource(49, transport.get),
+                             ('CRITICAL', 'Research Software resource 49 - Connection error'))
+
+    # -------------------------------------------------------------------------
+    def test_connections_reused(self):
+        ''' A batch re-uses the connections it opens '''
+
+        results = check_research_sw.check_resources(range(1, 21), workers=2, transport='http')
+
+        self.assertEqual([r[1] for r in results], ['OK'] * 20)
+        assert len(TestStatusHandler.client_ports) <= 2
+
+    # -------------------------------------------------------------------------
+    def test_lazy_imports(self):
+        ''' A single check doesn't load "requests" or argparse '''
+
+        script = ('import sys, check_research_sw; check_research_sw.parse_args(["49"]); '
+                  'check_research_sw.make_transport("http"); '
+                  'print(" ".join(m for m in ("requests", "argparse") if m in sys.modules))')
+
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=os.path.dirname(os.path.abspath(check_research_sw.__file__)))
+        self.assertEqual(output.strip(), b'')
+
+
+# ------------------------------------------------------------------------------
+class TestMockServer(unittest.TestCase):
+    ''' Test the stand-in web service used by benchmark.py and loadsim.py '''
+
+    def structure(self, response):
+        ''' The keys and values of a JSON response, ignoring the value of lastUpdate '''
+        return sorted((k, self.structure(v) if isinstance(v, dict) else (v if k != 'lastUpdate' else None))
+                      for (k, v) in response.items())
+
+    # -------------------------------------------------------------------------
+    def test_shapes(self):
+        ''' The mock can return every response used by TestJSONErrors '''
+
+        expected = [self.structure(case['json_response']) for case in TestJSONErrors.json_response_data]
+        shapes = [self.structure(shape('2014-01-13T21:26:04Z')) for shape in mock_server.shapes.values()]
+
+        self.assertEqual(sorted(expected), sorted(shapes))
+
+    # -------------------------------------------------------------------------
+    def test_fleet(self):
+        ''' A batch of checks against a mixed fleet sees every shape '''
+
+        server = mock_server.start(mock_server.MockConfig('mixed'))
+        saved_urlbase = check_research_sw.urlbase
+        check_research_sw.urlbase = server.urlbase
+
+        try:
+            ids = range(1, len(mock_server.shapes) + 1)
+            results = check_research_sw.check_resources(ids, transport='http')
+
+            self.assertEqual(server.requests, len(ids))
+            for (resource_id, code, msg) in results:
+                payload = server.config.payload(resource_id, time.time())
+                self.assertEqual(code, check_research_sw.check_response(payload, check_research_sw.check_status(payload), '')[0])
+
+        finally:
+            check_research_sw.urlbase = saved_urlbase
+            mock_server.stop(server)
+
+    # -------------------------------------------------------------------------
+    def test_latency_distribution(self):
+        ''' A log-normal latency has the configured median and a long tail '''
+
+        random.seed(1)
+        config = mock_server.MockConfig('ok', latency=0.1, jitter=0.0, sigma=0.5)
+        delays = [config.delay() for _ in range(2000)]
+
+        self.assertAlmostEqual(check_research_sw.percentile(delays, 50), 0.1, delta=0.01)
+        self.assertGreater(check_research_sw.percentile(delays, 99), 0.25)
+        self.assertEqual(mock_server.MockConfig('ok', latency=0.1, jitter=0.0).delay(), 0.1)
+
+    # -------------------------------------------------------------------------
+    def test_load_schedule(self):
+        ''' loadsim.py offers rate x duration resources, in checks no bigger than the batch size '''
+
+        self.assertEqual(loadsim.schedule(2, 3), [(n, 1) for n in range(6)])
+        self.assertEqual(loadsim.schedule(2, 3, 50), [(0, 6)])
+        self.assertEqual(loadsim.schedule(20, 10, 50), [(0, 50), (50, 50), (100, 50), (150, 50)])
+        self.assertEqual(loadsim.schedule(11, 10, 50), [(0, 37), (37, 37), (74, 36)])
+        self.assertEqual(loadsim.schedule(0.01, 1), [(0, 1)])
+
+    # -------------------------------------------------------------------------
+    def test_validators(self):
+        ''' Responses that haven't changed since the cached copy aren't sent again '''
+
+        server = mock_server.start(mock_server.MockConfig('ok'))
+        saved_urlbase = check_research_sw.urlbase
+        check_research_sw.urlbase = server.urlbase
+        directory = tempfile.mkdtemp()
+
+        try:
+            cache = check_research_sw.StatusCache(directory, stale=0)
+            get = check_research_sw.HTTPTransport().get
+            first = check_research_sw.check_resource(49, get, cache=cache)
+
+            entry = cache.read(49)
+            assert entry['etag'] and entry['last_modified']
+            entry['expires'] = time.time() - 1
+            with open(cache.filename(49), 'w') as f:
+                json.dump(entry, f)
+
+            perf = {}
+            self.assertEqual(check_research_sw.check_resource(49, get, cache=cache, perf=perf), first)
+            self.assertEqual((server.requests, server.not_modified), (2, 1))
+            self.assertEqual(perf['size'], len(json.dumps(server.config.payload(49, time.time()), sort_keys=True)))
+
+            # Last-Modified is enough on its own
+            del entry['etag']
+            with open(cache.filename(49), 'w') as f:
+                json.dump(entry, f)
+
+            self.assertEqual(check_research_sw.check_resource(49, get, cache=cache), first)
+            self.assertEqual((server.requests, server.not_modified), (3, 2))
+
+        finally:
+            check_research_sw.urlbase = saved_urlbase
+            mock_server.stop(server)
+            shutil.rmtree(directory)
+
+
+# ------------------------------------------------------------------------------
+class TestPerfdata(unittest.TestCase):
+    ''' Test performance data and the thresholds on it '''
+
+    def test_format(self):
+        ''' Measurements are written in the format Nagios expects '''
+
+        perf = {'time': 0.25, 'size': 103, 'age': 600.5}
+        thresholds = {'time': (1, 2.5), 'age': (None, 3600)}
+
+        self.assertEqual(check_research_sw.format_perfdata(perf, thresholds),
+                         'time=0.25s;1;2.5;0; size=103B;;;0; age=600.5s;;3600;0;')
+        self.assertEqual(check_research_sw.format_result('OK', 'Research Software resource 49', 'time=0.25s;;;0;'),
+                         'OK - Research Software resource 49 | time=0.25s;;;0;')
+
+    # -------------------------------------------------------------------------
+    def test_thresholds(self):
+        ''' Crossing a threshold raises the exit code, but never lowers it '''
+
+        thresholds = {'time': (1, 2), 'age': (600, 3600)}
+        check = lambda code, perf: check_research_sw.check_thresholds(code, 'msg', perf, thresholds)
+
+        self.assertEqual(check('OK', {'time': 0.5, 'age': 10}), ('OK', 'msg'))
+        self.assertEqual(check('OK', {'time': 1.5}), ('WARNING', 'msg - Response time 1.5s over warning threshold 1s'))
+        self.assertEqual(check('OK', {'age': 7200})[0], 'CRITICAL')
+        self.assertEqual(check('CRITICAL', {'time': 1.5})[0], 'CRITICAL')
+
+    # -------------------------------------------------------------------------
+    def test_check(self):
+        ''' A check against the mock web service records every measurement '''
+
+        server = mock_server.start()
+        saved_stdout = sys.stdout
+        saved_urlbase = check_research_sw.urlbase
+        out = StringIO()
+        sys.stdout = out
+
+        try:
+            sys.argv = ['check_research_sw', '--urlbase', server.urlbase, '--age-warning', '0', '49']
+            with self.assertRaises(SystemExit) as cm:
+                check_research_sw.main()
+
+        finally:
+            sys.stdout = saved_stdout
+            check_research_sw.urlbase = saved_urlbase
+            mock_server.stop(server)
+
+        # The mock's lastUpdate is always in the past, so it's over the threshold
+        output = out.getvalue().strip()
+        self.assertEqual(cm.exception.code, check_research_sw.codelist['WARNING'])
+        assert 'Status age' in output
+
+        perfdata = output.split(' | ')[1]
+        self.assertEqual([item.split('=')[0] for item in perfdata.split()], ['connect', 'ttfb', 'time', 'size', 'age'])
+
+
+# ------------------------------------------------------------------------------
+class TestFreshness(unittest.TestCase):
+    ''' Test checking lastUpdate against pollingInterval '''
+
+    # Seconds since the epoch of the lastUpdate used in TestJSONErrors
+    last_update = 1389648364
+
+    def test_polling_intervals(self):
+        ''' The usual ways of writing an interval are understood, and remembered '''
+
+        intervals = [(u'Every 15 minutes', 900), (u'every  hour', 3600), (u'Every 1.5 hours', 5400),
+                     (u'30 min', 1800), (u'Twice a day', 43200), (u'Hourly', 3600), (u'Every 0 minutes', None),
+                     (u'When it feels like it', None), (None, None), (15, None)]
+
+        for (text, seconds) in intervals:
+            self.assertEqual(check_research_sw.parse_polling_interval(text), seconds)
+
+        assert u'Every 15 minutes' in check_research_sw.interval_cache
+
+    # -------------------------------------------------------------------------
+    def test_timestamps(self):
+        ''' Time zones and fractions of a second are allowed in lastUpdate '''
+
+        for text in ['2014-01-13T21:26:04Z', '2014-01-13T21:26:04.250Z', '2014-01-13T16:26:04-05:00']:
+            self.assertEqual(check_research_sw.parse_timestamp(text), self.last_update)
+
+        self.assertEqual(check_research_sw.parse_timestamp('2014-01-32T21:26:04Z'), None)
+
+    # -------------------------------------------------------------------------
+    def test_check_freshness(self):
+        ''' The exit code is raised once lastUpdate is several intervals old '''
+
+        response = TestJSONErrors.json_response_data[0]['json_response']
+        check = lambda minutes: check_research_sw.check_freshness(response, 'OK', 'msg', (2, 4),
+                                                                   self.last_update + minutes * 60)
+
+        self.assertEqual(check(20), ('OK', 'msg'))
+        self.assertEqual(check(40), ('WARNING', 'msg - Stale: not updated for 40m, expected every 15m'))
+        self.assertEqual(check(24 * 60)[0], 'CRITICAL')
+
+        # Without both lastUpdate and pollingInterval, there's nothing to check
+        response = TestJSONErrors.json_response_data[9]['json_response']
+        self.assertEqual(check(24 * 60), ('OK', 'msg'))
+
+    # -------------------------------------------------------------------------
+    def test_main(self):
+        ''' The TestJSONErrors responses are all long out of date '''
+
+        saved_stdout = sys.stdout
+        saved_transport = check_research_sw.default_transport
+        saved_get = requests.get
+        out = StringIO()
+        sys.stdout = out
+
+        try:
+            check_research_sw.default_transport = 'requests'
+            requests.get = lambda url, timeout: TestJSONErrors.TestJSONResponse(TestJSONErrors.json_response_data[0]['json_response'])
+            sys.argv = ['check_research_sw', '--stale-critical', '3', '49']
+
+            with self.assertRaises(SystemExit) as cm:
+                check_research_sw.main()
+
+        finally:
+            sys.stdout = saved_stdout
+            check_research_sw.default_transport = saved_transport
+            requests.get = saved_get
+
+        self.assertEqual(cm.exception.code, check_research_sw.codelist['CRITICAL'])
+        assert 'Stale: not updated for' in out.getvalue()
+
+# ------------------------------------------------------------------------------
+class TestBulk(unittest.TestCase):
+    ''' Test batches fetched from the bulk endpoint '''
+
+    def setUp(self):
+        self.server = mock_server.start(mock_server.MockConfig('mixed', fleet_size=20))
+        self.saved_urlbase = check_research_sw.urlbase
+        check_research_sw.urlbase = self.server.urlbase
+
+
+    def tearDown(self):
+        check_research_sw.urlbase = self.saved_urlbase
+        mock_server.stop(self.server)
+
+
+    def untimed(self, results):
+        ''' The results with timestamps removed, as the mock's lastUpdate moves with the clock '''
+        return [(i, code, re.sub(r'\d{4}-\d\d-\d\dT[\d:]+Z', '', msg)) for (i, code, msg) in results]
+
+    def statuses(self, payload, size=None):
+        ''' Parse a bulk response sent in pieces of 'size' bytes '''
+        body = json.dumps(payload).encode('utf-8')
+        size = size or len(body)
+        return dict(check_research_sw.bulk_statuses(body[i:i + size] for i in range(0, len(body), size)))
+
+    # -------------------------------------------------------------------------
+    def test_bulk_statuses(self):
+        ''' Every layout of bulk response is understood '''
+
+        status = {'status': 'OK'}
+        expected = {1: status, 2: status}
+
+        self.assertEqual(self.statuses({'1': status, '2': status}), expected)
+        self.assertEqual(self.statuses({'resources': {'1': status, '2': status}}), expected)
+        self.assertEqual(self.statuses([dict(status, id=1), dict(status, resourceId='2')]),
+                         {1: dict(status, id=1), 2: dict(status, resourceId='2')})
+        self.assertEqual(self.statuses({'resources': [dict(status, id=1)]}), {1: dict(status, id=1)})
+        self.assertEqual(self.statuses({}), {})
+        self.assertEqual(self.statuses([]), {})
+
+        # Anything that isn't a resource status is ignored
+        self.assertEqual(self.statuses({'1': status, 'next': '/page/2', '3': 'OK'}), {1: status})
+        self.assertEqual(self.statuses([status, 'OK', None]), {})
+        self.assertRaises(ValueError, self.statuses, 'OK')
+
+    # -------------------------------------------------------------------------
+    def test_streaming(self):
+        ''' Statuses are parsed as they arrive, whatever the size of the pieces '''
+
+        payload = dict((str(i), {'status': 'OK', 'lastUpdate': '2014-01-13T21:26:04Z', 'id': i * 1.5,
+                                 'meta': {'pollingInterval': u'Every 15 minutes \u00e9t\u00e9', 'n': [i, None, True]}})
+                       for i in range(1, 6))
+        expected = dict((int(k), v) for (k, v) in payload.items())
+
+        for size in (1, 2, 3, 7, 64):
+            self.assertEqual(self.statuses(payload, size), expected)
+
+        # The first status is available long before the end of the response
+        body = json.dumps(dict((str(i), {'status': 'OK'}) for i in range(1000))).encode('utf-8')
+        pieces = [body[i:i + 100] for i in range(0, len(body), 100)]
+        read = []
+
+        def chunks():
+            for piece in pieces:
+                read.append(piece)
+                yield piece
+
+        statuses = check_research_sw.bulk_statuses(chunks())
+        next(statuses)
+        self.assertTrue(len(read) < 3)
+
+        # ... and only a little of it is held at a time
+        stream = check_research_sw.JSONStream(chunks())
+        biggest = 0
+        for _ in check_research_sw.bulk_items(stream):
+            biggest = max(biggest, len(stream.buffer))
+        self.assertTrue(biggest < 300)
+
+    # -------------------------------------------------------------------------
+    def test_truncated(self):
+        ''' The statuses before the point a response goes wrong are still returned '''
+
+        body = json.dumps([{'id': 1, 'status': 'OK'}, {'id': 2, 'status': 'OK'}]).encode('utf-8')
+        statuses = check_research_sw.bulk_statuses([body[:-10]])
+
+        self.assertEqual(next(statuses), (1, {'id': 1, 'status': 'OK'}))
+        self.assertRaises(ValueError, next, statuses)
+
+    # -------------------------------------------------------------------------
+    def test_evaluate_statuses(self):
+        ''' Evaluating statuses together gives the same results as one at a time '''
+
+        statuses = [case['json_response'] for case in TestJSONErrors.json_response_data]
+        statuses += [{'status': None, 'lastUpdate': None, 'meta': {'pollingInterval': None}, 'message': ''},
+                     {'status': 'OK', 'lastUpdate': '2014-01-13T21:26:04Z', 'meta': 'Every 15 minutes'},
+                     {'status': 'OK', 'lastUpdate': '2014-01-13T21:26:04Z', 'meta': None},
+                     {'status': 'OK', 'lastUpdate': '2014-01-13T21:26:04Z', 'meta': 'pollingInterval'},
+                     {'status': 'OK', 'lastUpdate': '2014-01-13T21:26:04Z', 'meta': ['pollingInterval']}]
+        msgs = ['Research Software resource {0}'.format(i) for i in range(len(statuses))]
+        now = time.time()
+
+        for freshness in (None, (2, 4), (None, 1e9)):
+            perfs = [{} for _ in statuses]
+            results = check_research_sw.evaluate_statuses(statuses, msgs, perfs, freshness, now)
+
+            for (status, msg, perf, result) in zip(statuses, msgs, perfs, results):
+                expected_perf = {}
+                expected = check_research_sw.evaluate_status(status, msg, expected_perf, freshness)
+                self.assertEqual(result, expected)
+                self.assertEqual(sorted(perf), sorted(expected_perf))
+                for key in perf:
+                    self.assertAlmostEqual(perf[key], expected_perf[key], delta=5)
+
+        # The exit codes are the ones TestJSONErrors expects
+        codes = [check_research_sw.codelist[code] for (code, msg) in check_research_sw.evaluate_statuses(statuses, msgs)]
+        self.assertEqual(codes[:len(TestJSONErrors.json_response_data)],
+                         [case['exit_code'] for case in TestJSONErrors.json_response_data])
+        self.assertEqual(check_research_sw.evaluate_statuses([], []), [])
+
+    # -------------------------------------------------------------------------
+    def test_same_results(self):
+        ''' A bulk batch gives the same results as one request per resource '''
+
+        ids = list(range(1, 26))
+        expected = check_research_sw.check_resources(ids, transport='http')
+
+        for transport in ('http', 'requests'):
+            self.server.requests = 0
+
+            results = check_research_sw.check_resources_bulk(ids, transport=transport)
+            self.assertEqual(self.untimed(results), self.untimed(expected))
+
+            # One bulk request, then one request for each id beyond the fleet
+            self.assertEqual(self.server.requests, 1 + 5)
+
+    # -------------------------------------------------------------------------
+    def test_fallback(self):
+        ''' Resources are fetched one at a time when the bulk endpoint fails '''
+
+        ids = [3, 4, 5]
+        expected = check_research_sw.check_resources(ids, transport='http')
+
+        saved_bulk_path = check_research_sw.bulk_path
+        check_research_sw.bulk_path = '/no/such/endpoint'
+        try:
+            self.server.requests = 0
+            results = check_research_sw.check_resources_bulk(ids, transport='http')
+        finally:
+            check_research_sw.bulk_path = saved_bulk_path
+
+        self.assertEqual(self.untimed(results), self.untimed(expected))
+        self.assertEqual(self.server.requests, 1 + len(ids))
+
+    # -------------------------------------------------------------------------
+    def test_chunks(self):
+        ''' Long lists of ids are split over several bulk requests '''
+
+        saved_bulk_chunk = check_research_sw.bulk_chunk
+        check_research_sw.bulk_chunk = 4
+        try:
+            results = check_research_sw.check_resources_bulk(list(range(1, 11)), workers=3, transport='http')
+        finally:
+            check_research_sw.bulk_chunk = saved_bulk_chunk
+
+        self.assertEqual([r[0] for r in results], list(range(1, 11)))
+        self.assertEqual(self.server.requests, 3)
+
+    # -------------------------------------------------------------------------
+    def test_evaluate_chunk(self):
+        ''' Statuses evaluated a few at a time give the same results '''
+
+        ids = list(range(1, 21))
+        expected = check_research_sw.check_resources_bulk(ids, transport='http')
+
+        saved_evaluate_chunk = check_research_sw.evaluate_chunk
+        check_research_sw.evaluate_chunk = 3
+        try:
+            results = check_research_sw.check_resources_bulk(ids, transport='http')
+        finally:
+            check_research_sw.evaluate_chunk = saved_evaluate_chunk
+
+        self.assertEqual(self.untimed(results), self.untimed(expected))
+
+# ------------------------------------------------------------------------------
+class TestRetryPolicy(unittest.TestCase):
+    ''' Test retries and hedged requests within a time budget '''
+
+    def setUp(self):
+        self.answers = []
+        self.timeouts = []
+
+    def simulate_get(self, url, timeout, headers=None):
+        ''' Replacement for a transport's get(), giving out self.answers in turn '''
+        self.timeouts.append(timeout)
+        answer = self.answers.pop(0) if len(self.answers) > 1 else self.answers[0]
+        if isinstance(answer, float):
+            time.sleep(min(answer, timeout))
+            if answer > timeout:
+                raise check_research_sw.TimedOut(url)
+            return check_research_sw.Response(httplib.OK, {}, b'{}')
+        if isinstance(answer, Exception):
+            raise answer
+        return check_research_sw.Response(answer, {}, b'{}')
+
+    # -------------------------------------------------------------------------
+    def test_retries(self):
+        ''' Connection errors, timeouts and 5xx responses are retried '''
+
+        policy = check_research_sw.RetryPolicy(5)
+
+        self.answers = [check_research_sw.ConnectionFailed('refused'), httplib.SERVICE_UNAVAILABLE, httplib.OK]
+        self.assertEqual(policy.get(self.simulate_get, 'url').status_code, httplib.OK)
+        self.assertEqual(len(self.timeouts), 3)
+
+        # The last failure is what's reported when the retries run out
+        self.answers = [httplib.INTERNAL_SERVER_ERROR]
+        self.assertEqual(policy.get(self.simulate_get, 'url').status_code, httplib.INTERNAL_SERVER_ERROR)
+        self.answers = [check_research_sw.TimedOut('url')]
+        self.assertRaises(check_research_sw.TimedOut, policy.get, self.simulate_get, 'url')
+
+        # Other errors, and 4xx responses, aren't worth trying again
+        self.timeouts = []
+        self.answers = [check_research_sw.TooManyRedirects('url'), httplib.OK]
+        self.assertRaises(check_research_sw.TooManyRedirects, policy.get, self.simulate_get, 'url')
+        self.answers = [httplib.NOT_FOUND, httplib.OK]
+        self.assertEqual(policy.get(self.simulate_get, 'url').status_code, httplib.NOT_FOUND)
+        self.assertEqual(len(self.timeouts), 2)
+
+    # -------------------------------------------------------------------------
+    def test_budget(self):
+        ''' Attempts never run past the time budget '''
+
+        policy = check_research_sw.RetryPolicy(1.5, retries=5)
+        self.answers = [10.0]
+
+        started = time.time()
+        self.assertRaises(check_research_sw.TimedOut, policy.get, self.simulate_get, 'url', timeout=5)
+        assert time.time() - started < 1.5 - check_research_sw.deadline_margin + 0.3
+        assert self.timeouts[0] <= 1.0
+
+        # The error is reported as usual
+        transport = check_research_sw.PolicyTransport(check_research_sw.HTTPTransport(), policy)
+        transport.transport.get = self.simulate_get
+        self.assertEqual(check_research_sw.check_resource(49, transport.get),
+                         ('CRITICAL', 'Research Software resource 49 - Timeout'))
+
+    # -------------------------------------------------------------------------
+    def test_hedge(self):
+        ''' A slow request gets a second copy sent, and the first answer is used '''
+
+        policy = check_research_sw.RetryPolicy(5, hedge=90)
+        self.answers = [0.01]
+        for _ in range(check_research_sw.hedge_min_samples):
+            policy.get(self.simulate_get, 'url')
+        assert policy.hedge_after() < 0.1
+
+        self.timeouts = []
+        self.answers = [2.0, 0.01]
+        started = time.time()
+        self.assertEqual(policy.get(self.simulate_get, 'url').status_code, httplib.OK)
+        assert time.time() - started < 1.0
+        self.assertEqual(len(self.timeouts), 2)
+
+        # Any other error is raised in the caller, unless the other copy answers
+        self.answers = [0.3, ValueError('bad response')]
+        self.assertEqual(policy.get(self.simulate_get, 'url').status_code, httplib.OK)
+        self.answers = [KeyError('bug')]
+        self.assertRaises(KeyError, policy.get, self.simulate_get, 'url')
+
+    # -------------------------------------------------------------------------
+    def test_command_line(self):
+        ''' A policy is only used when asked for '''
+
+        self.assertEqual(check_research_sw.parse_args(['49']).policy(), None)
+
+        policy = check_research_sw.parse_args(['-t', '10', '--retries', '3', '49']).policy()
+        self.assertEqual((policy.budget, policy.retries, policy.hedge), (10, 3, None))
+
+        policy = check_research_sw.parse_args(['--hedge', '95', '49', '50']).policy()
+        self.assertEqual((policy.budget, policy.hedge), (check_research_sw.timeout_sec, 95))
+
+        saved_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(SystemExit, check_research_sw.parse_args, ['-t', '0.2', '49'])
+            self.assertRaises(SystemExit, check_research_sw.parse_args, ['--hedge', '100', '49'])
+        finally:
+            sys.stderr = saved_stderr
+
+# ------------------------------------------------------------------------------
+class TestCircuitBreaker(unittest.TestCase):
+    ''' Test the circuit breaker shared by all checks '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'circuit')
+        self.requests = 0
+        self.error = check_research_sw.ConnectionFailed('refused')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def simulate_get(self, url, timeout):
+        ''' Replacement for a transport's get() that fails with self.error, if set '''
+        self.requests += 1
+        if self.error is not None:
+            raise self.error
+        return check_research_sw.Response(httplib.OK, {}, json.dumps(TestJSONErrors.json_response_data[0]['json_response']).encode())
+
+    def check(self, breaker):
+        transport = check_research_sw.CircuitTransport(check_research_sw.HTTPTransport(), breaker)
+        transport.transport.get = self.simulate_get
+        return check_research_sw.check_resource(49, transport.get)
+
+    # -------------------------------------------------------------------------
+    def test_circuit(self):
+        ''' The circuit opens after repeated failures and a probe closes it again '''
+
+        breaker = check_research_sw.CircuitBreaker(self.path, failures=3, reset=0.2)
+        other = check_research_sw.CircuitBreaker(self.path, failures=3, reset=0.2)   # another process
+
+        self.assertEqual(self.check(breaker), ('CRITICAL', 'Research Software resource 49 - Connection error'))
+        self.error = check_research_sw.TimedOut('slow')
+        self.check(breaker)
+        self.check(other)
+        self.assertEqual(self.requests, 3)
+
+        # Open: no more requests for a while, in any process
+        self.assertEqual(self.check(breaker), ('CRITICAL', 'Research Software resource 49 - Portal unreachable - circuit open'))
+        self.assertEqual(self.check(other)[0], 'CRITICAL')
+        self.assertEqual(self.requests, 3)
+
+        # A probe that fails keeps it open
+        time.sleep(0.25)
+        self.check(other)
+        self.assertEqual(self.requests, 4)
+        self.check(breaker)
+        self.assertEqual(self.requests, 4)
+
+        # Only one probe is let through at a time, and one that succeeds closes it
+        time.sleep(0.25)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(other.allow())
+        breaker.succeeded()
+
+        self.error = None
+        self.assertEqual(self.check(other)[0], 'OK')
+        self.assertEqual(breaker.read(), {})
+
+    # -------------------------------------------------------------------------
+    def test_answers_close_circuit(self):
+        ''' Any answer from the web service counts as success, other errors as neither '''
+
+        breaker = check_research_sw.CircuitBreaker(self.path, failures=2)
+
+        self.check(breaker)
+        self.error = check_research_sw.TooManyRedirects('loop')
+        self.check(breaker)
+        self.assertEqual(breaker.read()['failures'], 1)
+
+        self.error = None
+        self.check(breaker)
+        self.assertEqual(breaker.read(), {})
+
+        # A state file that can't be written leaves the circuit closed
+        breaker = check_research_sw.CircuitBreaker(os.path.join(self.directory, 'missing', 'circuit'), failures=1)
+        self.error = check_research_sw.ConnectionFailed('refused')
+        self.check(breaker)
+        self.assertEqual(self.check(breaker)[1], 'Research Software resource 49 - Connection error')
+
+    # -------------------------------------------------------------------------
+    def test_command_line(self):
+        ''' The circuit breaker is only used when asked for '''
+
+        self.assertEqual(check_research_sw.parse_args(['49', '50']).breaker(), None)
+
+        breaker = check_research_sw.parse_args(['--circuit', self.path, '--circuit-failures', '2', '49', '50']).breaker()
+        self.assertEqual((breaker.path, breaker.failures, breaker.reset), (self.path, 2, check_research_sw.circuit_reset_sec))
+
+# ------------------------------------------------------------------------------
+class TestExporter(unittest.TestCase):
+    ''' Test the Prometheus exporter '''
+
+    def setUp(self):
+        self.server = mock_server.start(mock_server.MockConfig('mixed'))
+        self.saved_urlbase = check_research_sw.urlbase
+        check_research_sw.urlbase = self.server.urlbase
+
+    def tearDown(self):
+        check_research_sw.urlbase = self.saved_urlbase
+        mock_server.stop(self.server)
+
+    def samples(self, page):
+        ''' The samples on a metrics page, as a dictionary '''
+        return dict(line.rsplit(' ', 1) for line in page.decode('utf-8').splitlines() if not line.startswith('#'))
+
+    # -------------------------------------------------------------------------
+    def test_poll(self):
+        ''' A poll checks every resource and the page reports the results '''
+
+        ids = list(range(1, len(mock_server.shapes) + 1))
+        exporter = check_research_sw.Exporter(ids + [1], transport='http')
+        self.assertEqual(self.samples(exporter.page)['research_software_checks_total'], '0')
+
+        exporter.poll()
+        samples = self.samples(exporter.page)
+        self.assertEqual(self.server.requests, len(ids))
+
+        for (resource_id, code, msg) in check_research_sw.check_resources(ids, transport='http'):
+            self.assertEqual(samples['research_software_status{{resource="{0}"}}'.format(resource_id)],
+                             str(check_research_sw.codelist[code]))
+
+        self.assertEqual(samples['research_software_checks_total'], str(len(ids)))
+        self.assertEqual(samples['research_software_fetch_duration_seconds_count'], str(len(ids)))
+        self.assertEqual(samples['research_software_fetch_duration_seconds_bucket{le="+Inf"}'], str(len(ids)))
+        self.assertEqual(samples['research_software_fetch_errors_total{error="TimedOut"}'], '0')
+        assert 0 <= float(samples['research_software_last_update_age_seconds{resource="1"}']) < 900
+
+        # Errors are counted by type
+        check_research_sw.urlbase = 'http://127.0.0.1:1/rs'
+        exporter.poll()
+        samples = self.samples(exporter.page)
+        self.assertEqual(samples['research_software_fetch_errors_total{error="ConnectionFailed"}'], str(len(ids)))
+        self.assertEqual(samples['research_software_status{resource="1"}'], '2')
+        self.assertEqual(samples['research_software_checks_total'], str(2 * len(ids)))
+        self.assertEqual(samples['research_software_fetch_duration_seconds_count'], str(len(ids)))
+
+    # -------------------------------------------------------------------------
+    def test_scrape(self):
+        ''' Scrapes are answered from the latest poll without asking the web service '''
+
+        exporter = check_research_sw.Exporter([1, 2, 3], transport='http')
+        exporter.poll()
+
+        metrics = check_research_sw.make_exporter(('127.0.0.1', 0), exporter)
+        thread = threading.Thread(target=metrics.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            for path, status in (('/metrics', 200), ('/metrics', 200), ('/', 404)):
+                conn = httplib.HTTPConnection('127.0.0.1', metrics.server_address[1], timeout=5)
+                conn.request('GET', path)
+                r = conn.getresponse()
+                self.assertEqual(r.status, status)
+                if status == 200:
+                    self.assertEqual(r.read(), exporter.page)
+                conn.close()
+
+            self.assertEqual(self.server.requests, 3)
+
+        finally:
+            metrics.shutdown()
+            metrics.server_close()
+
+    # -------------------------------------------------------------------------
+    def test_command_line(self):
+        ''' The exporter needs resource ids and an address '''
+
+        args = check_research_sw.parse_args(['--exporter', '9468', '49', '50'])
+        self.assertEqual((args.exporter, args.interval), (('', 9468), check_research_sw.exporter_interval))
+        self.assertEqual(check_research_sw.parse_args(['--exporter', '127.0.0.1:9468', '49']).exporter,
+                         ('127.0.0.1', 9468))
+
+        saved_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(SystemExit, check_research_sw.parse_args, ['--exporter', '9468'])
+            self.assertRaises(SystemExit, check_research_sw.parse_args, ['--exporter', 'port', '49'])
+        finally:
+            sys.stderr = saved_stderr
+
+# ------------------------------------------------------------------------------
+class TestScheduler(unittest.TestCase):
+    ''' Test fetching resources only when they can have changed '''
+
+    # -------------------------------------------------------------------------
+    def test_schedule(self):
+        ''' Resources come due in order, spread out by the jitter '''
+
+        now = time.time()
+        scheduler = check_research_sw.Scheduler([3, 1, 2, 1], jitter=0.2)
+        self.assertEqual(sorted(resource_id for (due, resource_id) in scheduler.heap), [1, 2, 3])
+        assert all(now <= due <= now + 0.3 for (due, resource_id) in scheduler.heap)
+
+        time.sleep(0.25)
+        self.assertEqual(sorted(scheduler.due()), [1, 2, 3])
+        self.assertEqual(scheduler.due(), [])
+        self.assertEqual(scheduler.wait(), None)
+
+        scheduler.schedule(1, now + 100)
+        scheduler.schedule(2, now + 50)
+        scheduler.schedule(3, None)     # not known: try again after cache_min_ttl
+        self.assertEqual([heapq.heappop(scheduler.heap)[1] for _ in range(3)], [2, 3, 1])
+
+    # -------------------------------------------------------------------------
+    def test_next_update(self):
+        ''' The next poll is lastUpdate + pollingInterval, within limits '''
+
+        now = 1389648364
+        status = {'status': 'OK', 'lastUpdate': '2014-01-13T21:26:04Z', 'meta': {'pollingInterval': 'Every hour'}}
+        self.assertEqual(check_research_sw.next_update(status, now + 600), now + 3600)
+
+        # Overdue, from the future, or not known
+        min_ttl = check_research_sw.cache_min_ttl
+        self.assertEqual(check_research_sw.next_update(status, now + 7200), now + 7200 + min_ttl)
+        self.assertEqual(check_research_sw.next_update(status, now - 86400), now - 86400 + 3600)
+        self.assertEqual(check_research_sw.next_update({'status': 'OK'}, now), now + min_ttl)
+
+    # -------------------------------------------------------------------------
+    def test_exporter(self):
+        ''' A scheduled exporter checks each resource once until it's due again '''
+
+        server = mock_server.start(mock_server.MockConfig('ok'))
+        saved_urlbase = check_research_sw.urlbase
+        check_research_sw.urlbase = server.urlbase
+
+        try:
+            exporter = check_research_sw.Exporter([1, 2, 3], transport='http')
+            scheduler = check_research_sw.Scheduler(exporter.ids, jitter=0.1)
+            stop = threading.Event()
+            thread = threading.Thread(target=exporter.run, args=(0.01, stop, scheduler))
+            thread.start()
+
+            time.sleep(0.5)
+            stop.set()
+            thread.join()
+
+            self.assertEqual(server.requests, 3)
+            assert all(due > time.time() + check_research_sw.cache_min_ttl - 1 for (due, i) in scheduler.heap)
+
+        finally:
+            check_research_sw.urlbase = saved_urlbase
+            mock_server.stop(server)
+
+    # -------------------------------------------------------------------------
+    def test_prefetch(self):
+        ''' The daemon's cache is filled in as resources fall due '''
+
+        server = mock_server.start(mock_server.MockConfig('ok'))
+        saved_urlbase = check_research_sw.urlbase
+        check_research_sw.urlbase = server.urlbase
+        directory = tempfile.mkdtemp()
+
+        try:
+            cache = check_research_sw.StatusCache(directory)
+            refresh = check_research_sw.prefetcher(cache, 2, transport='http')
+            due = refresh([1, 2])
+
+            self.assertEqual(sorted(due), [1, 2])
+            self.assertEqual(due[1], cache.read(1)['expires'])
+            self.assertEqual(server.requests, 2)
+
+            # Checks are then answered from the cache
+            check_research_sw.check_resource(1, cache=cache)
+            self.assertEqual(server.requests, 2)
+
+        finally:
+            check_research_sw.urlbase = saved_urlbase
+            mock_server.stop(server)
+            shutil.rmtree(directory)
+
+# ------------------------------------------------------------------------------
+class TestHistory(unittest.TestCase):
+    ''' Test the history of results kept for flap detection and reports '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # -------------------------------------------------------------------------
+    def test_ring(self):
+        ''' Only the most recent results are kept, oldest first '''
+
+        history = check_research_sw.History(self.directory, capacity=4)
+        self.assertEqual(history.records(49), [])
+
+        for n in range(6):
+            history.append(49, 1000 + n, n % 3, 0.5 if n % 2 else None, 60.0)
+
+        self.assertEqual(history.records(49), [(1002, 2, None, 60.0), (1003, 0, 0.5, 60.0),
+                                                (1004, 1, None, 60.0), (1005, 2, 0.5, 60.0)])
+        self.assertEqual(history.records(49, since=1004), [(1004, 1, None, 60.0), (1005, 2, 0.5, 60.0)])
+        self.assertEqual(os.path.getsize(history.filename(49)),
+                         check_research_sw.history_header.size + 4 * check_research_sw.history_record.size)
+
+        # Another process sees the same results, whatever its own capacity
+        other = check_research_sw.History(self.directory)
+        self.assertEqual(other.records(49), history.records(49))
+        other.append(49, 1006, 0)
+        self.assertEqual(history.records(49)[-1], (1006, 0, None, None))
+        self.assertEqual(history.ids(), [49])
+
+    # -------------------------------------------------------------------------
+    def test_open_files(self):
+        ''' Only a few history files are open at once, however many resources there are '''
+
+        saved_history_open = check_research_sw.history_open
+        check_research_sw.history_open = 3
+        try:
+            history = check_research_sw.History(self.directory, capacity=4)
+            for n in range(2):
+                for resource_id in range(1, 11):
+                    history.append(resource_id, 1000 + n, 0)
+                self.assertEqual(len(history.maps), 3)
+
+            self.assertEqual(history.ids(), list(range(1, 11)))
+            for resource_id in range(1, 11):
+                self.assertEqual(history.records(resource_id), [(1000, 0, None, None), (1001, 0, None, None)])
+            self.assertEqual(history.failures, 0)
+
+            history.close()
+            self.assertEqual(len(history.maps), 0)
+        finally:
+            check_research_sw.history_open = saved_history_open
+
+    # -------------------------------------------------------------------------
+    def test_not_kept(self):
+        ''' A history that can't be written is reported in the batch summary '''
+
+        history = check_research_sw.History(self.directory)
+        os.mkdir(history.filename(50))     # can't be opened as a file
+
+        saved_stdout, saved_stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            history.append(49, 1000, 0)
+            history.append(50, 1000, 0)
+            history.append(50, 1001, 0)
+            code = check_research_sw.report_batch([(49, 'OK', 'resource 49'), (50, 'OK', 'resource 50')], history)
+            out, err = sys.stdout.getvalue(), sys.stderr.getvalue()
+        finally:
+            sys.stdout, sys.stderr = saved_stdout, saved_stderr
+
+        self.assertEqual(history.failures, 2)
+        self.assertEqual(code, 'WARNING')
+        assert out.startswith('WARNING - Research Software batch of 2 resources - 2 OK - History not kept for 2 results '
+                              '(resource 50: '), out
+        self.assertEqual(len(err.splitlines()), 1)
+        self.assertEqual(history.records(49), [(1000, 0, None, None)])
+
+    # -------------------------------------------------------------------------
+    def test_corrupt(self):
+        ''' A file that isn't a history is started again '''
+
+        history = check_research_sw.History(self.directory, capacity=4)
+        with open(history.filename(49), 'wb') as f:
+            f.write(b'not a history file')
+
+        self.assertEqual(history.records(49), [])
+        history.append(49, 1000, 0)
+        self.assertEqual(history.records(49), [(1000, 0, None, None)])
+
+    # -------------------------------------------------------------------------
+    def test_summary(self):
+        ''' Availability, flap rate and response time percentiles '''
+
+        history = check_research_sw.History(self.directory)
+        codes = [0, 0, 2, 0, 0, 0, 1, 1, 0, 0]
+        for n, code in enumerate(codes):
+            history.append(49, 1000 + n, code, 0.1 * (n + 1))
+
+        summary = history.summary(49, window=100, now=1050)
+        self.assertEqual(summary['checks'], 10)
+        self.assertAlmostEqual(summary['availability'], 70.0)
+        self.assertAlmostEqual(summary['flapping'], 400.0 / 9)
+        self.assertAlmostEqual(summary['p50'], check_research_sw.percentile([0.1 * n for n in range(1, 11)], 50))
+
+        # Only checks in the window count
+        summary = history.summary(49, window=2, now=1009)
+        self.assertEqual(summary['checks'], 3)
+        self.assertAlmostEqual(summary['availability'], 2 * 100.0 / 3)
+        self.assertEqual(history.summary(50, now=1050),
+                         {'checks': 0, 'availability': None, 'flapping': None, 'p50': None, 'p90': None, 'p99': None})
+
+        self.assertEqual(history.report([49, 50], window=2)[1],
+                         'Research Software resource 50 - 0 checks, availability n/a, flap rate n/a, '
+                         'response time p50 n/a p90 n/a p99 n/a')
+
+    # -------------------------------------------------------------------------
+    def test_check(self):
+        ''' Checks add their results to the history '''
+
+        response = json.dumps(TestJSONErrors.json_response_data[0]['json_response']).encode()
+        get = lambda url, timeout, headers=None: check_research_sw.Response(httplib.OK, {}, response)
+        history = check_research_sw.History(self.directory)
+
+        perf = {}
+        self.assertEqual(check_research_sw.check_resource(49, get, perf=perf, history=history),
+                         check_research_sw.check_resource(49, get))
+        records = history.records(49)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0][1], check_research_sw.codelist['OK'])
+        self.assertEqual(records[0][2], perf['time'])
+        self.assertEqual(history.perf(49), {'availability': 100.0})
+
+        def fail(url, timeout, headers=None):
+            raise check_research_sw.TimedOut('timed out')
+
+        check_research_sw.check_resource(49, fail, history=history)
+        self.assertEqual(history.records(49)[-1][1], check_research_sw.codelist['CRITICAL'])
+        self.assertEqual(history.perf(49), {'availability': 50.0, 'flapping': 100.0})
+        assert 'availability=50' in check_research_sw.format_perfdata(history.perf(49))
+
+# ------------------------------------------------------------------------------
+class TestPassive(unittest.TestCase):
+    ''' Test submitting results to Nagios as passive checks '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'nagios.cmd')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def written(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    # -------------------------------------------------------------------------
+    def test_commands(self):
+        ''' Results are written to the command file in batches '''
+
+        open(self.path, 'w').close()
+        writer = check_research_sw.PassiveWriter(self.path, 'science', batch=2, interval=60)
+
+        writer.submit(49, 'OK', 'OK - Research Software resource 49 | time=0.1s;;;0;', when=1389648364)
+        self.assertEqual(self.written(), [])
+        writer.submit(50, 'CRITICAL', 'CRITICAL - Research Software resource 50 - Status: Down ', when=1389648365)
+        self.assertEqual(self.written(), [
+            '[1389648364] PROCESS_SERVICE_CHECK_RESULT;science;Research Software 49;0;'
+            'OK - Research Software resource 49 | time=0.1s;;;0;',
+            '[1389648365] PROCESS_SERVICE_CHECK_RESULT;science;Research Software 50;2;'
+            'CRITICAL - Research Software resource 50 - Status: Down '])
+
+        # A result that has waited long enough is written with the next one
+        writer.interval = 0
+        writer.submit(51, 'OK', 'OK - Research Software resource 51 ')
+        self.assertEqual(len(self.written()), 3)
+        self.assertEqual(writer.written, 3)
+        writer.flush()
+        self.assertEqual(len(self.written()), 3)
+
+    # -------------------------------------------------------------------------
+    def test_command_line_breaks(self):
+        ''' Line breaks in the output can't start another command '''
+
+        open(self.path, 'w').close()
+        writer = check_research_sw.PassiveWriter(self.path, 'science', batch=1)
+
+        writer.submit(49, 'OK', 'OK - Research Software resource 49 - Details: hi\r\n[1] SHUTDOWN_PROGRAM\\n',
+                      when=1389648364)
+        self.assertEqual(self.written(), [
+            '[1389648364] PROCESS_SERVICE_CHECK_RESULT;science;Research Software 49;0;'
+            'OK - Research Software resource 49 - Details: hi\\n[1] SHUTDOWN_PROGRAM\\\\n'])
+
+    # -------------------------------------------------------------------------
+    def test_pipe(self):
+        ''' Nothing is written to a command pipe nobody reads, and large batches stay whole '''
+
+        os.mkfifo(self.path)
+        writer = check_research_sw.PassiveWriter(self.path, 'science', batch=1000)
+        for resource_id in range(200):
+            writer.submit(resource_id, 'OK', 'OK - Research Software resource {0} '.format(resource_id))
+
+        with self.assertRaises(OSError):
+            writer.flush()
+        self.assertEqual(len(writer.pending), 200)
+
+        reader = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            read = []
+            thread = threading.Thread(target=writer.flush)
+            thread.start()
+            while thread.is_alive():
+                try:
+                    read.append(os.read(reader, 65536))
+                except OSError:
+                    pass
+                time.sleep(0.01)
+            thread.join()
+            read.append(os.read(reader, 65536))
+            while read[-1]:
+                read.append(os.read(reader, 65536))
+        finally:
+            os.close(reader)
+
+        lines = b''.join(read).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(writer.pending, [])
+        assert all(line.endswith(';0;OK - Research Software resource {0} '.format(n)) for (n, line) in enumerate(lines))
+
+    # -------------------------------------------------------------------------
+    def test_spool(self):
+        ''' Check result files are complete before Nagios is told about them '''
+
+        writer = check_research_sw.PassiveWriter(self.directory, 'science', 'rsw-{id}', spool=True)
+        writer.submit(49, 'WARNING', 'WARNING - Research Software resource 49 - Stale', when=1389648364.5)
+        writer.submit(50, 'OK', 'OK - Research Software resource 50 ', when=1389648365)
+        writer.flush()
+
+        names = sorted(os.listdir(self.directory))
+        self.assertEqual(len(names), 2)
+        self.assertEqual(names[1], names[0] + '.ok')
+        assert re.match('^c[a-zA-Z0-9]{6}$', names[0])
+
+        with open(os.path.join(self.directory, names[0])) as f:
+            results = f.read().split('### Nagios Service Check Result ###')
+        self.assertEqual(len(results), 3)
+        first = dict(line.split('=', 1) for line in results[1].splitlines() if line)
+        self.assertEqual(first['host_name'], 'science')
+        self.assertEqual(first['service_description'], 'rsw-49')
+        self.assertEqual(first['return_code'], '1')
+        self.assertEqual(first['start_time'], '1389648364.500000')
+        self.assertEqual(first['output'], 'WARNING - Research Software resource 49 - Stale')
+
+    # -------------------------------------------------------------------------
+    def test_submit(self):
+        ''' Each resource is submitted with the output and exit code of a single check '''
+
+        server = mock_server.start(mock_server.MockConfig('mixed'))
+        saved_urlbase = check_research_sw.urlbase
+        check_research_sw.urlbase = server.urlbase
+        open(self.path, 'w').close()
+
+        # The connections are closed once the results are in
+        saved_make_transport = check_research_sw.make_transport
+        transports = []
+
+        def make_transport(*args):
+            transports.append(saved_make_transport(*args))
+            return transports[-1]
+
+        check_research_sw.make_transport = make_transport
+        try:
+            ids = list(range(1, 21))
+            writer = check_research_sw.PassiveWriter(self.path, 'science', batch=7)
+            results = check_research_sw.submit_resources(ids + [3], writer, 4, transport='http')
+            self.assertEqual([r[0] for r in results], ids)
+            check_research_sw.make_transport = saved_make_transport
+
+            self.assertEqual(len(transports), 1)
+            self.assertEqual(sum(len(idle) for idle in transports[0].idle.values()), 0)
+
+            submitted = {}
+            for line in self.written():
+                command, host, service, code, output = line.split(';', 4)
+                submitted[int(service.split()[-1])] = (int(code), output)
+            self.assertEqual(sorted(submitted), ids)
+
+            for (resource_id, code, msg) in results:
+                single = check_research_sw.check_single(resource_id)
+                self.assertEqual(single[:2], (code, msg))
+                self.assertEqual(submitted[resource_id][0], check_research_sw.codelist[code])
+                self.assertEqual(submitted[resource_id][1].split(' | ')[0], check_research_sw.format_result(code, msg).rstrip())
+
+        finally:
+            check_research_sw.make_transport = saved_make_transport
+            check_research_sw.urlbase = saved_urlbase
+            mock_server.stop(server)
+
+    # -------------------------------------------------------------------------
+    def test_fingerprint(self):
+        ''' Fingerprints ignore the parts of a message that change every check '''
+
+        fingerprint = check_research_sw.fingerprint
+        msg = 'Research Software resource 49 - Last update: {0} - Stale: not updated for {1}, expected every 15m'
+        self.assertEqual(fingerprint('WARNING', msg.format('2014-01-13T21:26:04Z', '2d 3h')),
+                         fingerprint('WARNING', msg.format('2014-01-14T21:26:04.5Z', '45s')))
+        self.assertNotEqual(fingerprint('WARNING', msg.format('2014-01-13T21:26:04Z', '2d 3h')),
+                            fingerprint('CRITICAL', msg.format('2014-01-13T21:26:04Z', '2d 3h')))
+
+        msg = 'Research Software resource 49 - Response time {0}s over warning threshold 2s'
+        self.assertEqual(fingerprint('WARNING', msg.format('2.5')), fingerprint('WARNING', msg.format('3')))
+        self.assertNotEqual(fingerprint('WARNING', 'Research Software resource 49 - Details: Down'),
+                            fingerprint('WARNING', 'Research Software resource 49 - Details: Up'))
+        self.assertEqual(len(fingerprint('OK', 'Research Software resource 49')), 16)
+
+    # -------------------------------------------------------------------------
+    def test_changes_only(self):
+        ''' Only changes, and results due a heartbeat, are passed on '''
+
+        path = os.path.join(self.directory, 'changes')
+        changes = check_research_sw.ChangeFilter(path, heartbeat=100)
+        msg = 'Research Software resource 49 - Last update: {0}'
+
+        assert changes.changed(49, 'OK', msg.format('2014-01-13T21:26:04Z'), now=1000)
+        assert not changes.changed(49, 'OK', msg.format('2014-01-13T21:41:04Z'), now=1050)
+        assert changes.changed(49, 'CRITICAL', msg.format('2014-01-13T21:41:04Z'), now=1060)
+        assert not changes.changed(49, 'CRITICAL', msg.format('2014-01-13T21:41:04Z'), now=1159)
+        assert changes.changed(49, 'CRITICAL', msg.format('2014-01-13T21:41:04Z'), now=1160)    # heartbeat
+        assert changes.changed(50, 'CRITICAL', msg.format('2014-01-13T21:41:04Z'), now=1160)
+
+        # Nothing is remembered until it's saved
+        assert check_research_sw.ChangeFilter(path, heartbeat=100).changed(49, 'CRITICAL', msg.format('2014-01-13T21:56:04Z'), now=1170)
+        changes.save()
+        assert not check_research_sw.ChangeFilter(path, heartbeat=100).changed(49, 'CRITICAL', msg.format('2014-01-13T21:56:04Z'), now=1170)
+
+    # -------------------------------------------------------------------------
+    def test_submit_changes(self):
+        ''' A sweep in which nothing has changed submits nothing '''
+
+        server = mock_server.start(mock_server.MockConfig('mixed'))
+        saved_urlbase = check_research_sw.urlbase
+        check_research_sw.urlbase = server.urlbase
+        open(self.path, 'w').close()
+
+        try:
+            path = os.path.join(self.directory, 'changes')
+            for (ids, submitted) in ((list(range(1, 21)), 20), (list(range(1, 21)), 0), (list(range(1, 22)), 1)):
+                writer = check_research_sw.PassiveWriter(self.path, 'science')
+                results = check_research_sw.submit_resources(ids, writer, 4, transport='http',
+                                                              changes=check_research_sw.ChangeFilter(path))
+                self.assertEqual(len(results), len(ids))
+                self.assertEqual(writer.written, submitted)
+            self.assertEqual(len(self.written()), 21)
+
+        finally:
+            check_research_sw.urlbase = saved_urlbase
+            mock_server.stop(server)
+
+# ------------------------------------------------------------------------------
+class TestProfile(unittest.TestCase):
+    ''' Test timing the phases of a check '''
+
+    # -------------------------------------------------------------------------
+    def test_phases(self):
+        ''' Phases run from one mark to the next, and other threads are ignored '''
+
+        profile = check_research_sw.Profile()
+        self.assertEqual(profile.phases[-1], ('imports', check_research_sw.import_seconds))
+
+        time.sleep(0.05)
+        profile.mark('setup')
+        thread = threading.Thread(target=profile.mark, args=('batch',))
+        thread.start()
+        thread.join()
+        time.sleep(0.05)
+        profile.mark('request', [('dns', 0.01), ('wait', 0.02)])
+
+        phases = profile.phases[-4:]
+        self.assertEqual([name for (name, seconds) in phases], ['setup', 'dns', 'wait', 'request'])
+        assert 0.05 <= phases[0][1] < 0.5
+        assert 0.02 <= phases[3][1] < 0.5
+        self.assertAlmostEqual(profile.total(), sum(seconds for (name, seconds) in profile.phases))
+
+        lines = profile.format()
+        self.assertEqual(len(lines), len(profile.phases) + 2)
+        assert lines[-1].split()[0] == 'total'
+
+    # -------------------------------------------------------------------------
+    def test_main(self):
+        ''' Profiling leaves stdout and the exit code alone '''
+
+        server = mock_server.start(mock_server.MockConfig('ok'))
+        saved = (check_research_sw.urlbase, sys.argv, sys.stdout)
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'profile.jsonl')
+
+        def run(*args):
+            sys.argv = ['check_research_sw', '-u', server.urlbase] + list(args) + ['49']
+            sys.stdout = StringIO()
+            with self.assertRaises(SystemExit) as cm:
+                check_research_sw.main()
+            output = sys.stdout.getvalue()
+            sys.stdout = saved[2]
+            return (cm.exception.code, output.split(' | ')[0])
+
+        # A check that isn't profiled doesn't set up a Profile at all
+        created = []
+        saved_profile_class = check_research_sw.Profile
+
+        class Profile(saved_profile_class):
+            def __init__(self, *args):
+                created.append(args)
+                saved_profile_class.__init__(self, *args)
+
+        check_research_sw.Profile = Profile
+        try:
+            run()
+            run('--profile-file', path, '--profile-sample', '0')
+            self.assertEqual(created, [])
+            run('--profile-file', os.devnull)
+            self.assertEqual(len(created), 1)
+        finally:
+            check_research_sw.Profile = saved_profile_class
+
+        try:
+            self.assertEqual(run('--profile-file', path), run())
+            self.assertEqual(run('--profile-file', path, '--profile-sample', '0'), run())
+
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(len(records), 1)
+            self.assertEqual(records[0]['code'], 'OK')
+            self.assertEqual(records[0]['ids'], [49])
+            for phase in ('imports', 'argparse', 'setup', 'dns', 'tcp', 'wait', 'download', 'decode', 'evaluate', 'output'):
+                assert phase in records[0]['order'], phase
+            assert 'tls' not in records[0]['phases']
+            self.assertAlmostEqual(records[0]['total'], sum(records[0]['phases'].values()))
+
+        finally:
+            check_research_sw.urlbase, sys.argv, sys.stdout = saved
+            check_research_sw.profile = None
+            mock_server.stop(server)
+            shutil.rmtree(directory)
+
+# ------------------------------------------------------------------------------
+class TestEndpoints(unittest.TestCase):
+    ''' Test spreading requests over several equivalent base URLs '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.servers = []
+        self.saved = (check_research_sw.urlbase, check_research_sw.endpoints)
+
+    def tearDown(self):
+        check_research_sw.urlbase, check_research_sw.endpoints = self.saved
+        for server in self.servers:
+            mock_server.stop(server)
+        shutil.rmtree(self.directory)
+
+    def start(self, **config):
+        server = mock_server.start(mock_server.MockConfig('ok', **config))
+        self.servers.append(server)
+        return server
+
+    def down(self):
+        ''' The base URL of a web service that isn't there '''
+        server = self.start()
+        mock_server.stop(server)
+        self.servers.remove(server)
+        return server.urlbase
+
+    # -------------------------------------------------------------------------
+    def test_order(self):
+        ''' Healthy endpoints come first, fastest first '''
+
+        endpoints = check_research_sw.Endpoints(['http://a', 'http://b', 'http://c'])
+        self.assertEqual(endpoints.order(), ['http://a', 'http://b', 'http://c'])
+
+        endpoints.record('http://a', 0.3, now=1000)
+        endpoints.record('http://b', 0.1, now=1000)
+        endpoints.record('http://c', 0.2, now=1000)
+        self.assertEqual(endpoints.order(now=1000), ['http://b', 'http://c', 'http://a'])
+
+        # Latency is smoothed
+        endpoints.record('http://b', 0.5, now=1001)
+        self.assertAlmostEqual(endpoints.stats['http://b']['latency'], 0.1 + check_research_sw.endpoint_alpha * 0.4)
+        self.assertEqual(endpoints.order(now=1001), ['http://c', 'http://b', 'http://a'])
+
+        # A failure makes an endpoint look slower, and several make it unhealthy
+        endpoints.record('http://c', None, now=1002)
+        self.assertEqual(endpoints.order(now=1002), ['http://b', 'http://c', 'http://a'])
+        endpoints.record('http://c', None, now=1003)
+        endpoints.record('http://c', None, now=1004)
+        self.assertEqual(endpoints.order(now=1004), ['http://b', 'http://a', 'http://c'])
+
+        # ... until it's due another chance
+        endpoints = check_research_sw.Endpoints(['http://fast', 'http://slow'])
+        endpoints.record('http://slow', 1.0, now=1000)
+        for now in (1000, 1001, 1002):
+            endpoints.record('http://fast', 0.1, now=now)
+            endpoints.record('http://fast', None, now=now)
+        self.assertEqual(endpoints.order(now=1002), ['http://slow', 'http://fast'])
+        self.assertEqual(endpoints.order(now=1002 + check_research_sw.endpoint_retry_sec), ['http://fast', 'http://slow'])
+
+    # -------------------------------------------------------------------------
+    def test_shared(self):
+        ''' Measurements are shared through the state file, newest first '''
+
+        path = os.path.join(self.directory, 'endpoints')
+        urls = ['http://a', 'http://b']
+        first = check_research_sw.Endpoints(urls, path)
+        first.record('http://a', 0.5, now=1000)
+        first.record('http://b', 0.1, now=1000.5)    # too soon to share
+
+        second = check_research_sw.Endpoints(urls, path)
+        self.assertEqual(second.stats['http://a']['latency'], 0.5)
+        self.assertEqual(second.stats['http://b']['latency'], None)
+
+        # Failures are shared at once
+        second.record('http://a', None, now=1001)
+        first.sync()
+        self.assertEqual(first.stats['http://a']['failed'], 1001)
+        self.assertEqual(check_research_sw.Endpoints(urls, path).stats['http://b']['latency'], 0.1)
+
+    # -------------------------------------------------------------------------
+    def test_failover(self):
+        ''' Checks go to the fastest endpoint that works, and fail over within the check '''
+
+        slow = self.start(latency=0.2)
+        fast = self.start(latency=0.01)
+        broken = self.start(error_rate=1.0)
+        urls = [self.down(), broken.urlbase, slow.urlbase, fast.urlbase]
+
+        check_research_sw.urlbase = urls[0]
+        check_research_sw.endpoints = check_research_sw.Endpoints(urls)
+        transport = check_research_sw.make_transport('http')
+
+        for _ in range(10):
+            self.assertEqual(check_research_sw.check_resource(49, transport.get)[0], 'OK')
+
+        # Each endpoint was tried, and the fast one got the rest of the requests
+        self.assertEqual(broken.requests, 1)
+        self.assertEqual(slow.requests, 1)
+        self.assertEqual(fast.requests, 9)
+        self.assertEqual(check_research_sw.endpoints.order()[0], fast.urlbase)
+
+        # When they all fail, the result is the same as for a single endpoint
+        check_research_sw.endpoints = check_research_sw.Endpoints([urls[0], broken.urlbase])
+        transport = check_research_sw.make_transport('http')
+        code, msg = check_research_sw.check_resource(49, transport.get)
+        self.assertEqual(code, 'CRITICAL')
+        assert msg.endswith('HTTP response status code 500'), msg
+
+    # -------------------------------------------------------------------------
+    def test_deadline(self):
+        ''' A primary that hangs leaves time to fail over, within the timeout '''
+
+        hanging = self.start(hang_rate=1.0, hang_seconds=2)
+        fast = self.start()
+        check_research_sw.urlbase = hanging.urlbase
+        check_research_sw.endpoints = check_research_sw.Endpoints([hanging.urlbase, fast.urlbase])
+
+        # The primary gets half the time, and the second endpoint the rest
+        started = time.time()
+        self.assertEqual(check_research_sw.check_resource(49, check_research_sw.make_transport('http').get,
+                                                          timeout=0.4)[0], 'OK')
+        assert 0.2 <= time.time() - started < 0.4
+        self.assertEqual((hanging.requests, fast.requests), (1, 1))
+
+        # The next check goes straight to the endpoint that's answering
+        self.assertEqual(check_research_sw.check_resource(49, check_research_sw.make_transport('http').get,
+                                                          timeout=0.4)[0], 'OK')
+        self.assertEqual((hanging.requests, fast.requests), (1, 2))
+
+        # When they all hang, the check still ends within the timeout
+        other = self.start(hang_rate=1.0, hang_seconds=2)
+        check_research_sw.endpoints = check_research_sw.Endpoints([hanging.urlbase, other.urlbase])
+
+        started = time.time()
+        code, msg = check_research_sw.check_resource(49, check_research_sw.make_transport('http').get, timeout=0.4)
+        assert time.time() - started < 0.6
+        self.assertEqual((hanging.requests, other.requests), (2, 1))
+        assert msg.endswith(' - Timeout'), msg
+
+# ------------------------------------------------------------------------------
+class TestHashRing(unittest.TestCase):
+    ''' Test sharing resources out between pollers '''
+
+    # -------------------------------------------------------------------------
+    def test_owner(self):
+        ''' Every poller agrees on who owns each id, and they get similar shares '''
+
+        ids = list(range(1, 3001))
+        ring = check_research_sw.HashRing(['a', 'b', 'c'])
+        other = check_research_sw.HashRing(['c', 'a', 'b', 'a'])
+        self.assertEqual([ring.owner(i) for i in ids], [other.owner(i) for i in ids])
+
+        shares, wrong = ring.coverage(ids)
+        self.assertEqual(wrong, [])
+        self.assertEqual(sorted(sum(shares.values(), [])), ids)
+        for node in 'abc':
+            assert 700 < len(shares[node]) < 1300, (node, len(shares[node]))
+        self.assertEqual(ring.owned([5, 3, 1, 5], ring.owner(5))[0], 5)
+
+    # -------------------------------------------------------------------------
+    def test_rebalance(self):
+        ''' Adding or removing a poller only moves its own share '''
+
+        ids = list(range(1, 3001))
+        before = check_research_sw.HashRing(['a', 'b', 'c'])
+        after = check_research_sw.HashRing(['a', 'b', 'c', 'd'])
+
+        moved = [i for i in ids if before.owner(i) != after.owner(i)]
+        assert all(after.owner(i) == 'd' for i in moved)
+        assert 0.15 < float(len(moved)) / len(ids) < 0.35, len(moved)
+
+        smaller = check_research_sw.HashRing(['a', 'c'])
+        moved = [i for i in ids if before.owner(i) != smaller.owner(i)]
+        self.assertEqual(sorted(moved), before.owned(ids, 'b'))
+
+    # -------------------------------------------------------------------------
+    def test_coverage(self):
+        ''' The coverage report shows each id is owned exactly once '''
+
+        saved = (sys.argv, sys.stdout)
+        sys.argv = ['check_research_sw', '--shard-nodes', 'poller1,poller2,poller3', '--coverage'] + \
+                   [str(i) for i in range(1, 101)]
+        sys.stdout = StringIO()
+        try:
+            with self.assertRaises(SystemExit) as cm:
+                check_research_sw.main()
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.argv, sys.stdout = saved
+
+        self.assertEqual(cm.exception.code, check_research_sw.codelist['OK'])
+        self.assertEqual(lines[0], 'OK - Research Software shard coverage - 100 resources over 3 nodes, '
+                                   'each owned by exactly one ')
+        self.assertEqual([line.split()[0] for line in lines[1:]], ['poller1', 'poller2', 'poller3'])
+        self.assertEqual(sum(int(line.split()[2]) for line in lines[1:]), 100)
+
+# ------------------------------------------------------------------------------
+class TestGroup(unittest.TestCase):
+    ''' Test roll-up checks of a group of resources '''
+
+    # -------------------------------------------------------------------------
+    def test_rules(self):
+        ''' The exit code of a group follows its rule '''
+
+        parse_rule, rollup = check_research_sw.parse_rule, check_research_sw.rollup
+        self.assertEqual(parse_rule('worst'), ('worst',))
+        self.assertEqual(parse_rule('quorum:3'), ('quorum', 3))
+        self.assertEqual(parse_rule('percent:90:50'), ('percent', 90.0, 50.0))
+        self.assertEqual(parse_rule('percent:90'), ('percent', 90.0, 0.0))
+        self.assertEqual(parse_rule('percent:75:75'), ('percent', 75.0, 75.0))
+        for bad in ('best', 'quorum', 'quorum:0', 'percent:150', 'percent:a', 'worst:1', 'percent:50:90'):
+            with self.assertRaises(ValueError):
+                parse_rule(bad)
+
+        codes = ['OK'] * 7 + ['WARNING', 'CRITICAL', 'CRITICAL']
+        self.assertEqual(rollup(codes), 'CRITICAL')
+        self.assertEqual(rollup(['OK', 'WARNING']), 'WARNING')
+        self.assertEqual(rollup(['OK'] * 3, ('quorum', 2)), 'OK')
+        self.assertEqual(rollup(codes, ('quorum', 7)), 'WARNING')
+        self.assertEqual(rollup(codes, ('quorum', 8)), 'CRITICAL')
+        self.assertEqual(rollup(codes, ('percent', 70, 50)), 'OK')
+        self.assertEqual(rollup(codes, ('percent', 80, 50)), 'WARNING')
+        self.assertEqual(rollup(codes, ('percent', 90, 75)), 'CRITICAL')
+        self.assertEqual(rollup([], ('percent', 90, 75)), 'UNKNOWN')
+
+    # -------------------------------------------------------------------------
+    def test_read_groups(self):
+        ''' Groups are read from a file, and may span lines '''
+
+        handle, filename = tempfile.mkstemp()
+        try:
+            with os.fdopen(handle, 'w') as f:
+                f.write('# platforms\ngenomics: 1 2, 3  # the core\n\nastro: 9\ngenomics: 4\n')
+            self.assertEqual(check_research_sw.read_groups(filename), {'genomics': [1, 2, 3, 4], 'astro': [9]})
+
+            with open(filename, 'a') as f:
+                f.write('no colon here\n')
+            with self.assertRaises(ValueError):
+                check_research_sw.read_groups(filename)
+        finally:
+            os.remove(filename)
+
+    # -------------------------------------------------------------------------
+    def test_group(self):
+        ''' A group takes about as long as its slowest member, and prints one line per member '''
+
+        server = mock_server.start(mock_server.MockConfig('ok', latency=0.2))
+        saved = (check_research_sw.urlbase, sys.argv, sys.stdout)
+        sys.argv = ['check_research_sw', '-u', server.urlbase, '--group', 'genomics', '--rule', 'quorum:25'] + \
+                   [str(i) for i in range(1, 31)]
+        sys.stdout = StringIO()
+
+        try:
+            started = time.time()
+            with self.assertRaises(SystemExit) as cm:
+                check_research_sw.main()
+            elapsed = time.time() - started
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            check_research_sw.urlbase, sys.argv, sys.stdout = saved
+            mock_server.stop(server)
+
+        assert elapsed < 0.6, elapsed
+        self.assertEqual(cm.exception.code, check_research_sw.codelist['OK'])
+        self.assertEqual(lines[0], 'OK - Research Software group genomics - 30 of 30 OK ')
+        self.assertEqual(len(lines), 31)
+        assert all(line.startswith('OK - Research Software resource ') for line in lines[1:])
+
+
 # ------------------------------------------------------------------------------
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,275 @@
+'''
+Copyright 2016 - CANARIE Inc. All rights reserved
+
+Synopsis: Unit tests for the check_research_sw_async module. Requires Python 3.
+
+Blob Hash: $Id$
+
+-------------------------------------------------------------------------------
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, 
+   this list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice, 
+   this list of conditions and the following disclaimer in the documentation 
+   and/or other materials provided with the distribution.
+
+3. The name of the author may not be used to endorse or promote products 
+   derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY CANARIE Inc. "AS IS" AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF 
+MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT
+OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+
+'''
+import check_research_sw
+import check_research_sw_async
+import asyncio
+import io
+import json
+import threading
+import time
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# ------------------------------------------------------------------------------
+class StatusHandler(BaseHTTPRequestHandler):
+    ''' Stand-in for the web service
+
+        Resource 404 doesn't exist, 998 is too slow to answer, 999 returns
+        something that isn't JSON, 997 returns JSON null and 301 is redirected
+        to 49. Any other resource is OK. Each request takes 'delay' seconds to
+        answer.
+    '''
+
+    protocol_version = 'HTTP/1.1'  # keep connections open
+    delay = 0
+    lock = threading.Lock()
+    in_progress = 0
+    max_in_progress = 0
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        cls = StatusHandler
+        with cls.lock:
+            cls.in_progress += 1
+            cls.requests += 1
+            cls.max_in_progress = max(cls.max_in_progress, cls.in_progress)
+
+        try:
+            time.sleep(cls.delay)
+            resource_id = int(self.path.split('/')[-2])
+
+            if resource_id == 998:
+                time.sleep(2)
+
+            if resource_id == 301:
+                self.send_response(301)
+                self.send_header('Location', '/rs/resource/49/status')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if resource_id == 404:
+                body, status = b'Not found', 404
+            elif resource_id == 999:
+                body, status = b'<html>Not JSON</html>', 200
+            elif resource_id == 997:
+                body, status = b'null', 200
+            else:
+                body, status = json.dumps({'status': 'OK', 'lastUpdate': '2014-01-13T21:26:04Z',
+                                           'meta': {'pollingInterval': 'Every 15 minutes'}}).encode(), 200
+
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        finally:
+            with cls.lock:
+                cls.in_progress -= 1
+
+
+# ------------------------------------------------------------------------------
+class TestAsyncChecker(unittest.TestCase):
+    ''' Test the asyncio engine against a local stand-in for the web service '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StatusHandler)
+        cls.server.daemon_threads = True
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.thread.join()
+
+    def setUp(self):
+        self.saved_urlbase = check_research_sw.urlbase
+        check_research_sw.urlbase = 'http://127.0.0.1:{0}/rs'.format(self.server.server_address[1])
+        StatusHandler.delay = 0
+        StatusHandler.max_in_progress = 0
+        StatusHandler.requests = 0
+
+    def tearDown(self):
+        check_research_sw.urlbase = self.saved_urlbase
+
+    def sweep(self, ids, **kwargs):
+        ''' Check 'ids' and return the results in the order they arrived '''
+
+        async def collect():
+            checker = check_research_sw_async.AsyncChecker(**kwargs)
+            try:
+                return [result async for result in checker.sweep(ids)]
+            finally:
+                checker.close()
+
+        return asyncio.run(collect())
+
+    # -------------------------------------------------------------------------
+    def test_results(self):
+        ''' Each resource gets the same result as check_research_sw would give it '''
+
+        results = dict((r[0], r[1:]) for r in self.sweep([49, 404, 999, 997, 301], rate=0))
+
+        self.assertEqual(results[49][0], 'OK')
+        self.assertEqual(results[49][1], 'Research Software resource 49 - Last update: 2014-01-13T21:26:04Z'
+                                         ' - Polling: Every 15 minutes')
+        self.assertEqual(results[404], ('CRITICAL', 'Research Software resource 404 - HTTP response status code 404'))
+        self.assertEqual(results[999], ('CRITICAL', 'Research Software resource 999 - Invalid response'))
+        self.assertEqual(results[997], ('CRITICAL', 'Research Software resource 997 - Invalid response'))
+        self.assertEqual(results[301][0], 'OK')
+
+    # -------------------------------------------------------------------------
+    def test_errors(self):
+        ''' Timeouts and connection failures are reported like check_research_sw does '''
+
+        results = self.sweep([998], rate=0, timeout=0.5)
+        self.assertEqual(results[0][1:], ('CRITICAL', 'Research Software resource 998 - Timeout'))
+
+        # Nothing listens on the port of a server that has been closed
+        closed = ThreadingHTTPServer(('127.0.0.1', 0), StatusHandler)
+        closed.server_close()
+        check_research_sw.urlbase = 'http://127.0.0.1:{0}/rs'.format(closed.server_address[1])
+
+        results = self.sweep([49], rate=0)
+        self.assertEqual(results[0][1:], ('CRITICAL', 'Research Software resource 49 - Connection error'))
+
+    # -------------------------------------------------------------------------
+    def test_unexpected_error(self):
+        ''' An unexpected exception is reported for its resource and the sweep carries on '''
+
+        saved_evaluate_response = check_research_sw.evaluate_response
+
+        def evaluate_response(r, msg, **kwargs):
+            if '50' in msg:
+                raise KeyError('bug')
+            return saved_evaluate_response(r, msg, **kwargs)
+
+        check_research_sw.evaluate_response = evaluate_response
+        try:
+            results = dict((r[0], r[1:]) for r in self.sweep([49, 50, 51], concurrency=1, rate=0, timeout=5))
+        finally:
+            check_research_sw.evaluate_response = saved_evaluate_response
+
+        self.assertEqual(sorted(results), [49, 50, 51])
+        self.assertEqual(results[50], ('CRITICAL', 'Research Software resource 50 - Unknown error'))
+        self.assertEqual(results[51][0], 'OK')
+
+    # -------------------------------------------------------------------------
+    def test_timeout_after_slot(self):
+        ''' Time spent waiting for a connection slot doesn't count towards the timeout '''
+
+        StatusHandler.delay = 0.2
+        results = self.sweep(range(1, 11), concurrency=10, per_host=2, rate=0, timeout=0.5)
+
+        self.assertEqual([r[1] for r in results], ['OK'] * 10)
+
+    # -------------------------------------------------------------------------
+    def test_streaming_order(self):
+        ''' Results arrive as they complete, not in the order they were asked for '''
+
+        results = self.sweep([998, 49, 50], rate=0, timeout=5)
+        self.assertEqual(results[-1][0], 998)
+        self.assertEqual(sorted(r[0] for r in results[:2]), [49, 50])
+
+    # -------------------------------------------------------------------------
+    def test_connection_limit(self):
+        ''' No more than per_host requests are in progress at once '''
+
+        StatusHandler.delay = 0.05
+        results = self.sweep(range(1, 41), concurrency=20, per_host=4, rate=0)
+
+        self.assertEqual(len(results), 40)
+        self.assertEqual(StatusHandler.requests, 40)
+        assert StatusHandler.max_in_progress <= 4
+
+    # -------------------------------------------------------------------------
+    def test_rate_limit(self):
+        ''' Requests are spaced out to respect the rate limit '''
+
+        start = time.time()
+        self.sweep(range(1, 11), rate=20)
+        assert time.time() - start >= 0.45
+
+    # -------------------------------------------------------------------------
+    def test_run(self):
+        ''' run() writes a summary followed by a line per resource '''
+
+        out = io.StringIO()
+        checker = check_research_sw_async.AsyncChecker(rate=0)
+        code = asyncio.run(check_research_sw_async.run([49, 404], checker, out))
+
+        lines = out.getvalue().strip().split('\n')
+        self.assertEqual(code, 'CRITICAL')
+        self.assertEqual(len(lines), 3)
+        assert lines[0].startswith('CRITICAL - Research Software sweep of 2 resources - 1 CRITICAL, 1 OK')
+        self.assertEqual(sorted(line.split(' - ')[1] for line in lines[1:]),
+                         ['Research Software resource 404', 'Research Software resource 49'])
+
+    # -------------------------------------------------------------------------
+    def test_run_stream(self):
+        ''' With 'stream', each result is written as it arrives and the summary comes last '''
+
+        class Out(io.StringIO):
+            def __init__(self):
+                io.StringIO.__init__(self)
+                self.flushed = []
+            def flush(self):
+                self.flushed.append(self.getvalue().count('\n'))
+
+        out = Out()
+        checker = check_research_sw_async.AsyncChecker(rate=0)
+        code = asyncio.run(check_research_sw_async.run([49, 404], checker, out, stream=True))
+
+        lines = out.getvalue().strip().split('\n')
+        self.assertEqual(code, 'CRITICAL')
+        self.assertEqual(len(lines), 3)
+        assert lines[2].startswith('CRITICAL - Research Software sweep of 2 resources - 1 CRITICAL, 1 OK')
+        self.assertEqual(sorted(line.split(' - ')[1] for line in lines[:2]),
+                         ['Research Software resource 404', 'Research Software resource 49'])
+        self.assertEqual(out.flushed[:2], [1, 2])    # each result was out before the sweep ended
+
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()